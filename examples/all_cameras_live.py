@@ -1,7 +1,6 @@
 #!/usr/bin/env python
-import ptpy
-from ptpy.transports.usb import find_usb_cameras
-from threading import Thread, Event
+from ptpy import CameraFarm
+from six.moves.queue import Empty, Queue
 import sys
 import logging
 from rainbow_logging_handler import RainbowLoggingHandler
@@ -24,31 +23,34 @@ log.setLevel(level)
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
-# Set up threads and events
-finished = Event()
 
-
-def capture_thread(camera):
-    '''Initiate captures regularly for camera'''
-    with camera.session():
-        info = camera.get_device_info()
-        while not finished.is_set():
-            capture = camera.initiate_capture()
-            if capture.ResponseCode == 'OK':
-                log.info(
-                    '{}: successfully initiated capture'
-                    .format(info.SerialNumber)
-                )
-            sleep(.1)
-
-
-def download_thread(camera):
-    '''Download all non-folders in events from camera'''
-    with camera.session():
-        caminfo = camera.get_device_info()
-        while not finished.is_set():
-            event = camera.event()
-            if event and event.EventCode == 'ObjectAdded':
+def capture_and_download(camera):
+    '''Initiate a capture and download all non-folders it produced.'''
+    caminfo = camera.get_device_info()
+    capture = camera.initiate_capture()
+    if capture.ResponseCode != 'OK':
+        return 0
+    log.info(
+        '{}: successfully initiated capture'
+        .format(caminfo.SerialNumber)
+    )
+    # Wake up as soon as events for this capture are received.
+    events = Queue()
+    subscription = camera.subscribe(
+        events.put,
+        transaction_id=capture.TransactionID,
+    )
+    downloaded = 0
+    tic = time()
+    try:
+        while time() - tic < 10:
+            try:
+                event = events.get(timeout=max(0, 10 - (time() - tic)))
+            except Empty:
+                break
+            if event.EventCode == 'CaptureComplete':
+                break
+            if event.EventCode == 'ObjectAdded':
                 handle = event.Parameter[0]
                 info = camera.get_object_info(handle)
                 # Download all things that are not groups of other things.
@@ -57,64 +59,36 @@ def download_thread(camera):
                         '{}: downloading {}'
                         .format(caminfo.SerialNumber, info.Filename)
                     )
-                    tic = time()
+                    start = time()
                     obj = camera.get_object(handle)
-                    toc = time()
                     log.info('{}: {:.1f}MB/s'.format(
                         caminfo.SerialNumber,
-                        len(obj.Data) / ((toc - tic) * 1e6))
+                        len(obj.Data) / ((time() - start) * 1e6))
                     )
-                    with open(info.Filename, mode='w') as f:
+                    with open(info.Filename, mode='wb') as f:
                         f.write(obj.Data)
+                    downloaded += 1
+    finally:
+        camera.unsubscribe(subscription)
+    return downloaded
 
 
-# Find each connected USB camera try to instantiate it and set up a capture and
-# download thread for it if successful.
-threads = []
-for i, device in enumerate(find_usb_cameras()):
-
-    try:
-        camera = ptpy.PTPy(device=device)
+# Open every connected USB camera in parallel. Each one gets its own worker and
+# an open session. Cameras may be unplugged and plugged back in meanwhile.
+with CameraFarm() as farm:
+    for serial, camera in farm.cameras.items():
         info = camera.get_device_info()
-        caminfo = (info.Manufacturer, info.Model, info.SerialNumber)
-        if (
-                'InitiateCapture' not in info.OperationsSupported or
-                'GetObject' not in info.OperationsSupported
-        ):
-            raise Exception(
-                '{} {} {} does not support capture or download...'
-                .format(*caminfo)
-            )
-        log.info(
-            'Found {} {} {}'
-            .format(*caminfo)
-        )
-    except Exception as e:
-        log.error(e)
-        continue
-
-    capture = Thread(
-        name='PHOTO{:02}'.format(i),
-        target=capture_thread,
-        args=(camera,)
-    )
-    threads.append(capture)
-
-    download = Thread(
-        name='DWNLD{:02}'.format(i),
-        target=download_thread,
-        args=(camera,)
-    )
-    threads.append(download)
-
-for thread in threads:
-    thread.start()
-
-# Let the threads run for 30 seconds.
-sleep(30)
-finished.set()
+        log.info('Found {} {} {}'.format(
+            info.Manufacturer, info.Model, info.SerialNumber
+        ))
 
-# Wait for them to finish running.
-for thread in threads:
-    if thread.is_alive():
-        thread.join()
+    # Capture and download on all cameras for 30 seconds.
+    beginning = time()
+    while time() - beginning < 30:
+        futures = farm.map(capture_and_download)
+        for serial, future in futures.items():
+            try:
+                log.info('{}: {} objects'.format(serial, future.result()))
+            except Exception as e:
+                log.error('{}: {}'.format(serial, e))
+        sleep(.1)
@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+from __future__ import print_function
+from time import time
+import ptpy
+
+camera = ptpy.PTPy()
+with camera.session(), camera.eos_live_view() as live_view:
+    # Save one out of every ten frames for 10 seconds.
+    start = time()
+    for frame in live_view.frames(timeout=2):
+        if frame.number % 10 == 0:
+            with open('live_view_{}.jpg'.format(frame.number), 'wb') as f:
+                f.write(frame.data)
+        if time() - start > 10:
+            break
+    print(live_view.stats)
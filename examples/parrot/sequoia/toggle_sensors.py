@@ -1,18 +1,18 @@
 #!/usr/bin/env python
 from ptpy import PTPy
-from time import sleep
 
 camera = PTPy()
 
 with camera.session():
-    tries = 0
     keep_on = camera.get_device_prop_desc('PhotoSensorsKeepOn')
-    state = keep_on.CurrentValue
-    while keep_on.CurrentValue == state and tries < 10:
-        tries += 1
-        sleep(1)
-        attempt = camera.set_device_prop_value('PhotoSensorsKeepOn', int(not state))
-        keep_on = camera.get_device_prop_desc('PhotoSensorsKeepOn')
-        print('Tries:{}'.format(tries))
-        print('Attempt response: {}'.format(attempt))
-        print('Current value: {}'.format(keep_on))
+    mask = camera.get_device_prop_desc('PhotoSensorEnableMask')
+    result = camera.apply_sensor_configuration(
+        mask.CurrentValue,
+        keep_on=not keep_on.CurrentValue,
+    )
+    print('Response: {}'.format(result.ResponseCode))
+    print('Status: {}'.format(result.Status))
+    print('Errors: {}'.format(result.Errors))
+    print('Took {:.3f}s'.format(result.Elapsed))
+    keep_on = camera.get_device_prop_desc('PhotoSensorsKeepOn')
+    print('Current value: {}'.format(keep_on))
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
+from __future__ import print_function
 import ptpy
+from time import sleep
 
 camera = ptpy.PTPy()
 with camera.session():
+    # Events are printed as they arrive.
+    camera.subscribe(print)
     while True:
-        evt = camera.event()
-        if evt:
-            print(evt)
+        sleep(1)
@@ -1,33 +1,47 @@
 #!/usr/bin/env python
-from ptpy import PTPy
+from ptpy import BusyPolicy, IntervalCapture, PTPy
 from argparse import ArgumentParser
-from time import time, sleep
 
 parser = ArgumentParser()
 parser.add_argument(
     '-t',
     type=float,
-    help='Time between captures in seconds. Default is 0.1 seconds.'
+    help='Time between captures in seconds. Default is 0.1 seconds. '
+    'Zero captures as fast as the camera can sustain.'
 )
 parser.add_argument(
     '-n',
     type=int,
     help='Number of captures. Negative numbers mean "forever" (default)'
 )
+parser.add_argument(
+    '--catch-up',
+    action='store_true',
+    help='Trigger missed captures right away instead of skipping them.'
+)
 args = parser.parse_args()
 
-camera = PTPy()
+camera = PTPy(busy_policy=BusyPolicy())
+interval = .1 if args.t is None else args.t
 with camera.session():
-    successful = 0
-    beginning = time()
-    while True if args.n is None or args.n < 0 else successful < args.n:
-        capture = camera.initiate_capture()
-        if capture.ResponseCode == 'OK':
-            successful += 1
-            cumulative_rate = (time() - beginning) / (successful)
-            print('elapsed {:.2f}s cumulative rate {:.2f}s captured {}'.format(
-                time() - beginning,
-                cumulative_rate,
-                successful
-            ))
-            sleep(.1 if args.t is None else args.t)
+    timelapse = IntervalCapture(
+        camera,
+        interval=interval or None,
+        count=None if args.n is None or args.n < 0 else args.n,
+        overrun='catch_up' if args.catch_up else 'skip',
+    )
+    with timelapse:
+        while not timelapse.wait(timeout=1):
+            stats = timelapse.stats(0)
+            print(
+                'captured {} skipped {} failed {} rate {:.2f}Hz '
+                'jitter {:.1f}ms (max {:.1f}ms)'.format(
+                    stats.captures,
+                    stats.skipped,
+                    stats.failed,
+                    stats.rate,
+                    stats.mean_jitter * 1000,
+                    stats.max_jitter * 1000,
+                )
+            )
+    print(timelapse.stats(0))
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
+from __future__ import print_function
 import ptpy
 
 camera = ptpy.PTPy()
 with camera.session():
     capture = camera.initiate_capture()
     print(capture)
-    while True:
-        evt = camera.event()
-        if evt:
-            print(evt)
+    camera.subscribe(print, transaction_id=capture.TransactionID)
+    camera.wait_for_event(
+        'CaptureComplete',
+        transaction_id=capture.TransactionID,
+    )
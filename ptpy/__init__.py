@@ -1,5 +1,7 @@
 '''Master module that instantiates the correct extension and transport.'''
 from __future__ import absolute_import
+from .busy import BusyPolicy
+from .interval import IntervalCapture
 from .extensions.canon import Canon
 from .extensions.microsoft import Microsoft
 from .extensions.parrot import Parrot
@@ -8,6 +10,7 @@ from .extensions.sony import Sony
 from .ptp import PTP, PTPError
 from .transports.usb import USBTransport as USB
 from .transports.ip import IPTransport as IP
+from .util import Payload
 
 import os
 import sys
@@ -44,8 +47,14 @@ __all__ = (
     'IP',
     'USB',
     # Classes and errors
+    'BusyPolicy',
+    'CameraFarm',
+    'IntervalCapture',
+    'Payload',
     'PTPError',
     'PTPy',
+    # Functions
+    'open_cameras',
 )
 
 # As extensions are implemented, they should be added here, so they are
@@ -108,7 +117,7 @@ class PTPy(object):
         if extension is None and not raw:
             plain = ptpy_factory(transport)
             try:
-                plain_camera = plain(device=device)
+                plain_camera = plain(device=device, **kwargs)
             except PTPError:
                 plain_camera = None
 
@@ -134,7 +143,7 @@ class PTPy(object):
             )
         # Query the device for information on all its properties and update
         # when there are changes.
-        instance = PTPy(device=device)
+        instance = PTPy(device=device, **kwargs)
         if knowledge and not raw:
             instance._obtain_the_knowledge()
 
@@ -143,3 +152,7 @@ class PTPy(object):
     def __init__(self, *args, **kwargs):
         logger.debug('Init PTPy')
         super(PTPy, self).__init__(*args, **kwargs)
+
+
+# The farm instantiates PTPy, so it can only be imported once PTPy exists.
+from .farm import CameraFarm, open_cameras  # noqa
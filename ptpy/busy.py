@@ -0,0 +1,89 @@
+'''This module implements the policy for operations answered with DeviceBusy.
+
+Instead of sleeping for a fixed time, a busy operation is retried after short
+and growing delays. While waiting, the camera is watched for signs that it is
+ready again: events such as CaptureComplete, and the readiness probe of the
+transport or extension, e.g. the USB still image Get Device Status request or
+Nikon's DeviceReady. The time spent waiting is accounted for per operation.
+'''
+from __future__ import absolute_import
+from collections import namedtuple
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('BusyPolicy', 'BusyStats')
+__author__ = 'Luis Mario Domenzain'
+
+BusyStats = namedtuple('BusyStats', ('busy', 'retries', 'waited', 'gave_up'))
+BusyStats.__doc__ = '''Busy answers, retries and time waited (s) for an
+operation, and how many times it was still busy after its timeout.'''
+
+
+class BusyPolicy(object):
+    '''Retry operations answered with DeviceBusy for up to `timeout` seconds.
+
+    Retries wait `initial_delay` seconds, then `backoff` times longer up to
+    `max_delay`, or less if one of the readiness `events` arrives first.
+    `timeouts` maps operation names to their own timeout, where 0 disables
+    retries. Cameras only retry when given a policy:
+
+        camera = PTPy(busy_policy=BusyPolicy(timeouts={'InitiateCapture': 30}))
+        camera.initiate_capture()
+        print(camera.busy_policy.stats())
+    '''
+
+    def __init__(
+            self,
+            timeout=5.,
+            initial_delay=0.01,
+            max_delay=0.5,
+            backoff=2.,
+            events=('CaptureComplete', 'Status'),
+            timeouts=None,
+    ):
+        if not 0 < initial_delay <= max_delay:
+            raise ValueError(
+                'Busy delays must verify 0 < initial_delay <= max_delay.'
+            )
+        if backoff < 1:
+            raise ValueError('Busy backoff cannot be less than 1.')
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.events = frozenset(events)
+        self.timeouts = dict(timeouts or {})
+        self.__stats = {}
+        self.__lock = Lock()
+
+    def timeout_for(self, operation):
+        '''Time in seconds during which `operation` is retried.'''
+        return self.timeouts.get(operation, self.timeout)
+
+    def delays(self):
+        '''Iterate over the delays between retries.'''
+        delay = self.initial_delay
+        while True:
+            yield delay
+            delay = min(self.max_delay, delay * self.backoff)
+
+    def record(self, operation, retries, waited, gave_up):
+        '''Account for an operation that was answered DeviceBusy.'''
+        with self.__lock:
+            stats = self.__stats.get(operation, BusyStats(0, 0, 0., 0))
+            self.__stats[operation] = BusyStats(
+                busy=stats.busy + 1,
+                retries=stats.retries + retries,
+                waited=stats.waited + waited,
+                gave_up=stats.gave_up + bool(gave_up),
+            )
+
+    def stats(self, operation=None):
+        '''Return the `BusyStats` of an operation, or a dict of all of them.
+        '''
+        with self.__lock:
+            if operation is not None:
+                return self.__stats.get(operation, BusyStats(0, 0, 0., 0))
+            return dict(self.__stats)
@@ -0,0 +1,253 @@
+'''This module implements the event stream of a camera.
+
+Events from every source of a camera, be it the USB interrupt endpoint, the
+PTP/IP event connection or vendor specific polls, are merged into a single
+stream in the order in which they were received. Each event is stamped with
+its `Source` and the monotonic time at which it was received, `ReceivedAt`.
+
+The stream is bounded. When it is full, new events either wait for room, push
+out the oldest event or replace a queued event about the same property.
+'''
+from __future__ import absolute_import
+from .util import monotonic
+from collections import deque
+from threading import Condition
+import logging
+import six
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('EventStream', 'EVENT_POLICIES')
+__author__ = 'Luis Mario Domenzain'
+
+EVENT_POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+def _coalescing_key(event):
+    '''Identify events that only matter as the latest of their kind.'''
+    code = event.get('EventCode')
+    if 'PropertyCode' in event:
+        # EOS property records carry the property explicitly.
+        return (code, event.PropertyCode)
+    if code in ('DevicePropChanged', 0x4006):
+        parameter = event.get('Parameter')
+        if isinstance(parameter, list):
+            parameter = parameter[0] if parameter else None
+        return (code, parameter)
+    return None
+
+
+class EventStream(object):
+    '''Ordered stream of timestamped events.
+
+    It can be iterated over, blocking until events arrive:
+
+        for event in camera.event_stream:
+            print(event.Source, event.ReceivedAt, event.EventCode)
+
+    or asynchronously, from within an asyncio event loop:
+
+        async for event in camera.event_stream:
+            print(event.Source, event.ReceivedAt, event.EventCode)
+
+    Iteration stops once the stream is closed and drained.
+
+    At most `maxlen` events are held, if it is not `None`. When the stream is
+    full, the `policy` decides what happens to a new event:
+
+    - `'block'`: wait for the consumer to make room. Event sources stop
+      reading from the camera while the stream is not `accepting`.
+    - `'drop_oldest'`: discard the oldest event.
+    - `'coalesce'`: replace a queued change of the same property with the new
+      one, or discard the oldest event if there is none.
+
+    The number of `dropped` and `coalesced` events is kept for monitoring.
+
+    Until a consumer reads from the stream, it only keeps the latest
+    `maxlen` events: nobody is waiting for the rest and sources are never
+    held back.
+    '''
+
+    def __init__(self, maxlen=1024, policy='drop_oldest'):
+        if policy not in EVENT_POLICIES:
+            raise ValueError(
+                'Unknown event policy {}. Use one of {}.'
+                .format(policy, EVENT_POLICIES)
+            )
+        if maxlen is not None and maxlen < 1:
+            raise ValueError('Event streams hold at least one event.')
+        self.maxlen = maxlen
+        self.policy = policy
+        self.__events = deque()
+        self.__condition = Condition()
+        self.__closed = False
+        self.__attached = False
+        self.__async_waiters = deque()
+        self.__dropped = 0
+        self.__coalesced = 0
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__events)
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    @property
+    def attached(self):
+        '''Whether a consumer has started reading from the stream.'''
+        return self.__attached
+
+    @property
+    def dropped(self):
+        '''Number of events discarded because the stream was full.'''
+        return self.__dropped
+
+    @property
+    def coalesced(self):
+        '''Number of events replaced by a newer one.'''
+        return self.__coalesced
+
+    @property
+    def accepting(self):
+        '''Whether sources should read events from the camera.'''
+        return not (
+            self.policy == 'block' and self.__attached and self.__full()
+        )
+
+    def put(self, event, source, received_at=None):
+        '''Stamp an event and append it to the stream.
+
+        With the `'block'` policy this waits until there is room in the
+        stream or it is closed, once a consumer is attached.
+        '''
+        with self.__condition:
+            event['ReceivedAt'] = (
+                monotonic() if received_at is None else received_at
+            )
+            event['Source'] = source
+            if self.__full():
+                self.__make_room(event)
+            self.__events.append(event)
+            self.__condition.notify_all()
+            self.__wake_async()
+        return event
+
+    def __full(self):
+        return self.maxlen is not None and len(self.__events) >= self.maxlen
+
+    def __make_room(self, event):
+        if not self.__attached:
+            # Nobody reads these events yet.
+            self.__events.popleft()
+            return
+        if self.policy == 'block':
+            while self.__full() and not self.__closed:
+                self.__condition.wait()
+            return
+        if self.policy == 'coalesce':
+            key = _coalescing_key(event)
+            if key is not None:
+                for queued in self.__events:
+                    if _coalescing_key(queued) == key:
+                        self.__events.remove(queued)
+                        self.__coalesced += 1
+                        return
+        self.__events.popleft()
+        self.__dropped += 1
+        if self.__dropped == 1 or self.__dropped % 1000 == 0:
+            logger.warning(
+                'Event stream full, {} events dropped'.format(self.__dropped)
+            )
+
+    def get(self, block=True, timeout=None):
+        '''Return the next event.
+
+        Return None if there is none by the `timeout` or if the stream is
+        closed.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.__condition:
+            self.__attached = True
+            while not self.__events:
+                if not block or self.__closed:
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                self.__condition.wait(remaining)
+            event = self.__events.popleft()
+            # Let blocked sources in.
+            self.__condition.notify_all()
+            return event
+
+    def close(self):
+        '''Stop iterations once the remaining events are consumed.'''
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+            self.__wake_async()
+
+    def __iter__(self):
+        self.__attached = True
+        return self
+
+    def __next__(self):
+        event = self.get()
+        if event is None:
+            raise StopIteration
+        return event
+
+    next = __next__
+
+    if six.PY3:
+        # Asynchronous iteration only exists on Python 3.
+
+        def __aiter__(self):
+            self.__attached = True
+            return self
+
+        def __anext__(self):
+            '''Return a future for the next event in the running loop.'''
+            import asyncio
+            loop = getattr(
+                asyncio, 'get_running_loop', asyncio.get_event_loop
+            )()
+            future = loop.create_future()
+            with self.__condition:
+                self.__attached = True
+                self.__async_waiters.append((loop, future))
+                self.__wake_async()
+            return future
+
+        def __resolve(self, loop):
+            '''Hand events to the futures of `loop`, in order.'''
+            with self.__condition:
+                pending = deque()
+                for waiter in self.__async_waiters:
+                    future = waiter[1]
+                    if waiter[0] is not loop:
+                        pending.append(waiter)
+                    elif future.done():
+                        # Cancelled futures no longer wait for events.
+                        continue
+                    elif self.__events:
+                        future.set_result(self.__events.popleft())
+                        self.__condition.notify_all()
+                    elif self.__closed:
+                        future.set_exception(StopAsyncIteration())
+                    else:
+                        pending.append(waiter)
+                self.__async_waiters = pending
+
+    def __wake_async(self):
+        '''Resolve pending futures from their own loop.'''
+        for loop in set(loop for loop, _ in self.__async_waiters):
+            try:
+                loop.call_soon_threadsafe(self.__resolve, loop)
+            except RuntimeError:
+                # The loop is closed.
+                pass
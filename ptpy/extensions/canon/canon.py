@@ -3,32 +3,50 @@
 Use it in a master module that determines the vendor and automatically uses its
 extension. This is why inheritance is not explicit.
 '''
-from ...util import _main_thread_alive
+from ...reactor import AdaptivePoller
+from ...liveview import LiveView
+from ...ptp import PTPError
+from ...util import BYTE_ORDER, monotonic
+from .events import EOSEventParser
 from .properties import EOSPropertiesMixin
+from .transfers import EOSTransfers
 from contextlib import contextmanager
 from construct import (
-    Array, Byte, Container, Embedded, Enum, Pass, PrefixedArray, Range, Struct,
-    Switch, Computed
+    Array, Byte, Container, CString, Embedded, Enum, Padded, Padding, Pass,
+    PrefixedArray, Range, Struct, Switch, Computed
 )
-from six.moves.queue import Queue
-from threading import Thread, Event
-from time import sleep
 import atexit
 import logging
+import struct
 logger = logging.getLogger(__name__)
 
 __all__ = ('Canon',)
 
 
 class Canon(EOSPropertiesMixin, object):
-    '''This class implements Canon's PTP operations.'''
+    '''This class implements Canon's PTP operations.
+
+    EOS events are polled every `poll_min_interval` seconds after captures and
+    property changes, backing off to `poll_max_interval` seconds when idle.
+    '''
     def __init__(self, *args, **kwargs):
         logger.debug('Init Canon')
+        self.__eos_poller = AdaptivePoller(
+            kwargs.pop('poll_min_interval', 0.05),
+            kwargs.pop('poll_max_interval', 1.),
+        )
         super(Canon, self).__init__(*args, **kwargs)
         # TODO: expose the choice to poll or not Canon events
         self.__no_polling = False
-        self.__eos_event_shutdown = Event()
-        self.__eos_event_proc = None
+        self.__eos_event_task = None
+        self.__eos_last_poll = 0
+        self.__eos_poll_requested = False
+        self._add_poller(self.__eos_poller)
+
+    @property
+    def event_poller(self):
+        '''The `AdaptivePoller` pacing EOS event polls.'''
+        return self.__eos_poller
 
     @contextmanager
     def session(self):
@@ -45,15 +63,16 @@ class Canon(EOSPropertiesMixin, object):
             # Set up remote mode and extended event info
             self.eos_set_remote_mode(1)
             self.eos_event_mode(1)
-            # And launch a polling thread
-            self.__event_queue = Queue()
-            self.__eos_event_proc = Thread(
+            # And poll events from the reactor
+            self.__eos_event_task = self._reactor.call_every(
+                self.__eos_poller.min_interval,
+                self.__eos_poll_events,
+                blocking=True,
                 name='EOSEvtPolling',
-                target=self.__eos_poll_events
+                group=self,
             )
-            self.__eos_event_proc.daemon = False
+            self.__eos_poller.task = self.__eos_event_task
             atexit.register(self._eos_shutdown)
-            self.__eos_event_proc.start()
 
             try:
                 yield
@@ -66,11 +85,21 @@ class Canon(EOSPropertiesMixin, object):
 
     def _eos_shutdown(self):
         logger.debug('Shutdown EOS events request')
-        self.__eos_event_shutdown.set()
-
-        # Only join a running thread.
-        if self.__eos_event_proc and self.__eos_event_proc.is_alive():
-            self.__eos_event_proc.join(2)
+        # Only wait for a running poll.
+        if self.__eos_event_task is not None:
+            self.__eos_poller.task = None
+            self.__eos_event_task.cancel(timeout=2)
+
+    def _poll_triggers(self):
+        return super(Canon, self)._poll_triggers() | {
+            'EOSRemoteRelease',
+            'EOSRemoteReleaseOn',
+            'EOSRemoteReleaseOff',
+            'EOSBulbStart',
+            'EOSBulbEnd',
+            'EOSSetDevicePropValueEx',
+            'InitiateCaptureInMemory',
+        }
 
     def _PropertyCode(self, **product_properties):
         return super(Canon, self)._PropertyCode(
@@ -218,6 +247,7 @@ class Canon(EOSPropertiesMixin, object):
 
     def _ResponseCode(self, **product_responses):
         return super(Canon, self)._ResponseCode(
+            NotReady=0xA102,
             **product_responses
         )
 
@@ -492,6 +522,18 @@ class Canon(EOSPropertiesMixin, object):
                                 default=self._DataType
                             ),
                         )),
+                        'RequestObjectTransfer':
+                        Embedded(Struct(
+                            'ObjectHandle' / self._UInt32,
+                            'ObjectFormat' / self._UInt16,
+                            Padding(6),
+                            'ObjectCompressedSize' / self._UInt32,
+                            Padding(4),
+                            'Filename' / Padded(
+                                lambda ctx: ctx._._.Bytes - 0x1c,
+                                CString(encoding='ascii'),
+                            ),
+                        )),
                         # TODO: 'EmptyEvent',
                         # TODO: 'RequestGetEvent',
                         # TODO: 'ObjectAdded',
@@ -499,7 +541,6 @@ class Canon(EOSPropertiesMixin, object):
                         # TODO: 'RequestGetObjectInfoEx',
                         # TODO: 'StorageStatusChanged',
                         # TODO: 'StorageInfoChanged',
-                        # TODO: 'RequestObjectTransfer',
                         # TODO: 'ObjectInfoChangedEx',
                         # TODO: 'ObjectContentChanged',
                         # TODO: 'DevicePropChanged',
@@ -543,6 +584,16 @@ class Canon(EOSPropertiesMixin, object):
             ))
         )
 
+    def _EOSEventParser(self, endian):
+        '''Return a fast parser for the EOSGetEvent dataphase'''
+        return EOSEventParser(
+            endian,
+            self._EOSEventCode,
+            self._EOSPropertyCode,
+            self._EOSDataTypeCode,
+            self._DataType,
+        )
+
     def _EOSDeviceInfo(self):
         return Struct(
             'EventsSupported' / PrefixedArray(
@@ -586,6 +637,8 @@ class Canon(EOSPropertiesMixin, object):
         # Use DataType
         self._EOSEventRecord = self._EOSEventRecord()
         self._EOSEventRecords = self._EOSEventRecords()
+        self._EOSEventParser = self._EOSEventParser(endian)
+        self._EOSViewfinderBlock = struct.Struct(BYTE_ORDER[endian] + 'II')
 
 
     # TODO: implement GetObjectSize
@@ -652,10 +705,71 @@ class Canon(EOSPropertiesMixin, object):
     # TODO: implement EOSGetStorageIDs
     # TODO: implement EOSGetStorageInfo
     # TODO: implement EOSGetObjectInfo
-    # TODO: implement EOSGetObject
+
+    def eos_get_object(self, handle):
+        '''Get an object on EOS cameras'''
+        ptp = Container(
+            OperationCode='EOSGetObject',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[handle]
+        )
+        return self.recv(ptp)
+
     # TODO: implement EOSDeleteObject
     # TODO: implement EOSFormatStore
-    # TODO: implement EOSGetPartialObject
+
+    def eos_get_partial_object(self, handle, offset, max_bytes):
+        '''Get up to `max_bytes` of an object from `offset` on EOS cameras'''
+        ptp = Container(
+            OperationCode='EOSGetPartialObject',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[handle, offset, max_bytes]
+        )
+        return self.recv(ptp)
+
+    def eos_download(
+            self,
+            handle,
+            destination,
+            size=None,
+            chunk_size=1 << 20,
+            between_chunks=None,
+    ):
+        '''
+        Write an object to the file-like `destination` chunk by chunk.
+
+        Without a `size` the object is downloaded at once. Otherwise at most
+        `chunk_size` bytes are held in memory and `between_chunks()` is
+        called after each chunk. Return the number of bytes written.
+        '''
+        if size is None:
+            response = self.eos_get_object(handle)
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not get object {}: {}'
+                    .format(handle, response.ResponseCode)
+                )
+            destination.write(response.Data)
+            return len(response.Data)
+        written = 0
+        while written < size:
+            response = self.eos_get_partial_object(
+                handle, written, min(chunk_size, size - written)
+            )
+            data = getattr(response, 'Data', b'')
+            if response.ResponseCode != 'OK' or not data:
+                raise PTPError(
+                    'Could not get object {} at {}: {}'
+                    .format(handle, written, response.ResponseCode)
+                )
+            destination.write(data)
+            written += len(data)
+            if between_chunks is not None:
+                between_chunks()
+        return written
+
     # TODO: implement EOSGetDeviceInfoEx
 
     def eos_get_device_info(self):
@@ -687,7 +801,21 @@ class Canon(EOSPropertiesMixin, object):
         response = self.mesg(ptp)
         return response
 
-    # TODO: implement EOSSetDevicePropValueEx
+    def eos_set_device_prop_value_ex(self, device_property, value):
+        '''Set an integer EOS property on EOS cameras'''
+        code = self._code(device_property, self._EOSPropertyCode)
+        ptp = Container(
+            OperationCode='EOSSetDevicePropValueEx',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        # The dataphase is the size of the record, the property and its value
+        payload = b''.join(
+            self._UInt32.build(field) for field in (12, code, value)
+        )
+        return self.send(ptp, payload)
+
     # TODO: implement EOSGetRemoteMode
 
     def eos_set_remote_mode(self, mode):
@@ -729,7 +857,7 @@ class Canon(EOSPropertiesMixin, object):
             Parameter=[]
         )
         response = self.recv(ptp)
-        return self._parse_if_data(response, self._EOSEventRecords)
+        return self._parse_if_data(response, self._EOSEventParser)
 
     def eos_transfer_complete(self, handle):
         '''Terminate a transfer for EOS Cameras'''
@@ -745,6 +873,16 @@ class Canon(EOSPropertiesMixin, object):
     # TODO: implement EOSCancelTransfer
     # TODO: implement EOSResetTransfer
 
+    def eos_capture_to_host(self, directory='.', **kwargs):
+        '''
+        Return an `EOSTransfers` downloading new captures to `directory`.
+
+        Each capture is streamed to disk and acknowledged as soon as it is
+        announced, so the camera buffer does not fill up during bursts.
+        Keyword arguments are given to `EOSTransfers`.
+        '''
+        return EOSTransfers(self, directory=directory, **kwargs)
+
     def eos_pc_hdd_capacity(self, todo0=0xfffffff8, todo1=0x1000, todo2=0x1):
         '''Tell EOS camera about PC hard drive capacity'''
         # TODO: Figure out what to send exactly.
@@ -822,12 +960,13 @@ class Canon(EOSPropertiesMixin, object):
         return response
 
     def eos_request_device_prop_value(self, device_property):
-        '''End bulb capture on EOS cameras'''
+        '''Ask EOS cameras to report a property in a DevicePropChanged event'''
+        code = self._code(device_property, self._EOSPropertyCode)
         ptp = Container(
             OperationCode='EOSRequestDevicePropValue',
             SessionID=self._session,
             TransactionID=self._transaction,
-            Parameter=[device_property]
+            Parameter=[code]
         )
         response = self.mesg(ptp)
         return response
@@ -869,9 +1008,25 @@ class Canon(EOSPropertiesMixin, object):
         response = self.mesg(ptp)
         return response
 
-    # TODO: implement EOSInitiateViewfinder
-    # TODO: implement EOSTerminateViewfinder
-    # TODO: implement EOSGetViewFinderImage
+    def eos_initiate_viewfinder(self):
+        '''Start the viewfinder on EOS cameras'''
+        ptp = Container(
+            OperationCode='EOSInitiateViewfinder',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        return self.mesg(ptp)
+
+    def eos_terminate_viewfinder(self):
+        '''Stop the viewfinder on EOS cameras'''
+        ptp = Container(
+            OperationCode='EOSTerminateViewfinder',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        return self.mesg(ptp)
 
     def eos_get_viewfinder_image(self):
         '''Get viefinder image for EOS cameras'''
@@ -884,6 +1039,89 @@ class Canon(EOSPropertiesMixin, object):
         )
         return self.recv(ptp)
 
+    def eos_viewfinder_jpeg(self, data):
+        '''Return the JPEG in a viewfinder dataphase, without copying it.
+
+        The dataphase is a sequence of blocks, each made of its size in
+        bytes, its type and a payload. Return None if there is no image.
+        '''
+        block = self._EOSViewfinderBlock
+        view = memoryview(data)
+        offset = 0
+        while offset + block.size <= len(data):
+            size, kind = block.unpack_from(data, offset)
+            if size < block.size or offset + size > len(data):
+                break
+            # Newer bodies use other block types for the same image.
+            if kind in (1, 9, 11) and size > block.size:
+                return view[offset + block.size:offset + size]
+            offset += size
+        return None
+
+    def eos_live_view(self, **kwargs):
+        '''
+        Return a `LiveView` streaming viewfinder images from EOS cameras.
+
+        Live view needs an open session. Frames are fetched as fast as the
+        camera produces them, while EOS events keep being polled between
+        frames. Keyword arguments are given to `LiveView`:
+
+            with camera.session(), camera.eos_live_view() as live_view:
+                for frame in live_view.frames(timeout=2):
+                    show(frame.data)
+                print(live_view.stats)
+        '''
+        kwargs.setdefault('name', 'EOSLiveView')
+        return LiveView(
+            self.__eos_viewfinder_frame,
+            setup=self.__eos_start_live_view,
+            teardown=self.__eos_stop_live_view,
+            between_frames=self._eos_poll_if_due,
+            **kwargs
+        )
+
+    def __eos_start_live_view(self):
+        response = self.eos_initiate_viewfinder()
+        if response.ResponseCode != 'OK':
+            # Older bodies start the viewfinder with the output device only.
+            logger.debug(
+                'EOSInitiateViewfinder: {}'.format(response.ResponseCode)
+            )
+        # Send the viewfinder to the host.
+        response = self.eos_set_device_prop_value_ex('EVFOutputDevice', 2)
+        if response.ResponseCode != 'OK':
+            raise PTPError(
+                'Could not start live view: {}'.format(response.ResponseCode)
+            )
+
+    def __eos_stop_live_view(self):
+        self.eos_set_device_prop_value_ex('EVFOutputDevice', 0)
+        self.eos_terminate_viewfinder()
+
+    def __eos_viewfinder_frame(self):
+        response = self.eos_get_viewfinder_image()
+        if response.ResponseCode != 'OK' or not hasattr(response, 'Data'):
+            # The camera has no new frame yet.
+            return None
+        return self.eos_viewfinder_jpeg(response.Data)
+
+    def _eos_poll_if_due(self):
+        '''Have events polled now if the event poller is due.
+
+        Long running loops call this between transfers, since the periodic
+        poll yields to them. The requested poll runs in the lane of the
+        camera, so it never overlaps another one, and waits for the running
+        transfer instead of yielding to it.
+        '''
+        elapsed = monotonic() - self.__eos_last_poll
+        if (
+                self.__eos_event_task is not None and
+                not self.__eos_event_task.cancelled and
+                elapsed >= self.__eos_poller.interval
+        ):
+            self.__eos_poll_requested = True
+            self.__eos_event_task.run_soon()
+
     def eos_do_af(self):
         '''Perform auto-focus with AF lenses set to AF'''
 
@@ -948,33 +1186,28 @@ class Canon(EOSPropertiesMixin, object):
     # TODO: implement EOSFAPIMessageTX
     # TODO: implement EOSFAPIMessageRX
 
-    def event(self, wait=False):
-        '''Check Canon or PTP events
+    def __eos_poll_events(self):
+        '''Poll events, adding them to the event stream.
 
-        If `wait` this function is blocking. Otherwise it may return None.
+        Return the delay until the next poll.
         '''
-        # TODO: Do something reasonable on wait=True
-        evt = None
-        timeout = None if wait else 0.001
-        # TODO: Join queues to preserve order of Canon and PTP events.
-        if not self.__event_queue.empty():
-            evt = self.__event_queue.get(block=not wait, timeout=timeout)
-        else:
-            evt = super(Canon, self).event(wait=wait)
-
-        return evt
-
-    def __eos_poll_events(self):
-        '''Poll events, adding them to a queue.'''
-        while not self.__eos_event_shutdown.is_set() and _main_thread_alive():
-            try:
-                evts = self.eos_get_event()
-                if evts:
-                    for evt in evts:
-                        logger.debug('Event queued')
-                        logger.debug(evt)
-                        self.__event_queue.put(evt)
-            except Exception as e:
-                logger.error(e)
-            sleep(0.2)
-        self.__eos_event_shutdown.clear()
+        poller = self.__eos_poller
+        requested, self.__eos_poll_requested = self.__eos_poll_requested, False
+        if not self.event_stream.accepting or (
+                self._transfer_in_flight and not requested
+        ):
+            # Yield to the consumer or to the running transfer.
+            return poller.min_interval
+        self.__eos_last_poll = monotonic()
+        evts = None
+        try:
+            evts = self.eos_get_event()
+            received_at = monotonic()
+            if evts:
+                for evt in evts:
+                    logger.debug('Event received')
+                    logger.debug(evt)
+                    self._event_received(evt, 'EOS', received_at)
+        except Exception as e:
+            logger.error(e)
+        return poller.next_delay(found=bool(evts))
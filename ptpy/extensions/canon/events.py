@@ -0,0 +1,130 @@
+'''This module implements a fast parser for EOS event records.
+
+The dataphase of EOSGetEvent is a sequence of records, each made of its length
+in bytes, its event code and a payload, terminated by an empty record. The
+parser walks the records by their length and only decodes the payload of the
+record types it knows about. Other records keep their payload as a memoryview
+on the dataphase, which is only copied if it is used.
+'''
+from ...util import BYTE_ORDER
+from construct import Container
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('EOSEventParser',)
+
+_NUMERIC = {
+    'Int8': 'b',
+    'UInt8': 'B',
+    'Int16': 'h',
+    'UInt16': 'H',
+    'Int32': 'i',
+    'UInt32': 'I',
+    'Int64': 'q',
+    'UInt64': 'Q',
+}
+
+
+class EOSEventParser(object):
+    '''Parse the dataphase of EOSGetEvent into a list of event records.
+
+    The records are Containers with the same fields as `_EOSEventRecord`,
+    except that unknown record payloads are memoryviews instead of lists of
+    bytes. The terminating empty record is not returned.
+    '''
+
+    def __init__(
+            self,
+            endian,
+            event_code,
+            property_code,
+            data_type_codes,
+            data_type,
+    ):
+        order = BYTE_ORDER[endian]
+        self.__header = struct.Struct(order + 'II')
+        self.__code = struct.Struct(order + 'I')
+        self.__numeric = {
+            name: struct.Struct(order + fmt) for name, fmt in _NUMERIC.items()
+        }
+        self.__event_names = event_code.decoding
+        self.__property_names = property_code.decoding
+        self.__data_type_codes = data_type_codes
+        self.__data_type = data_type
+        self.__u16 = struct.Struct(order + 'H')
+        self.__payloads = {
+            'DevicePropChanged': self.__device_prop_changed,
+            'AvailListChanged': self.__avail_list_changed,
+            'RequestObjectTransfer': self.__request_object_transfer,
+        }
+
+    def parse(self, data):
+        records = []
+        length = len(data)
+        view = memoryview(data)
+        header = self.__header
+        offset = 0
+        while offset + header.size <= length:
+            size, code = header.unpack_from(data, offset)
+            if code == 0 or size < header.size or offset + size > length:
+                if code != 0:
+                    logger.debug(
+                        'Truncated EOS event record at {}'.format(offset)
+                    )
+                break
+            name = self.__event_names.get(code, code)
+            record = Container(Bytes=size, EventCode=name)
+            decode = self.__payloads.get(name)
+            start = offset + header.size
+            if decode is None:
+                record['Record'] = view[start:offset + size]
+            else:
+                decode(record, data, start, offset + size)
+            records.append(record)
+            offset += size
+        return records
+
+    def __property(self, record, data, start):
+        code = self.__code.unpack_from(data, start)[0]
+        record['PropertyCode'] = self.__property_names.get(code, code)
+
+    def __device_prop_changed(self, record, data, start, end):
+        self.__property(record, data, start)
+        start += self.__code.size
+        data_type = self.__data_type_codes.get(record.PropertyCode)
+        record['DataTypeCode'] = data_type
+        numeric = self.__numeric.get(data_type)
+        if data_type is None:
+            record['Value'] = list(bytearray(data[start:end]))
+        elif numeric is not None and end - start >= numeric.size:
+            record['Value'] = numeric.unpack_from(data, start)[0]
+        else:
+            record['Value'] = self.__data_type.parse(
+                data[start:end],
+                DataTypeCode=data_type,
+            )
+
+    def __request_object_transfer(self, record, data, start, end):
+        # Fields are found at fixed offsets from the start of the record.
+        record_start = start - self.__header.size
+        if end - record_start < 0x1c:
+            record['Record'] = memoryview(data)[start:end]
+            return
+        record['ObjectHandle'] = self.__code.unpack_from(
+            data, record_start + 0x08
+        )[0]
+        record['ObjectFormat'] = self.__u16.unpack_from(
+            data, record_start + 0x0c
+        )[0]
+        record['ObjectCompressedSize'] = self.__code.unpack_from(
+            data, record_start + 0x14
+        )[0]
+        name = bytes(data[record_start + 0x1c:end]).split(b'\0', 1)[0]
+        record['Filename'] = name.decode('ascii', 'replace')
+
+    def __avail_list_changed(self, record, data, start, end):
+        self.__property(record, data, start)
+        start += self.__code.size
+        record['Enumeration'] = list(bytearray(data[start:end]))
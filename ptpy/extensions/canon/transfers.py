@@ -0,0 +1,229 @@
+'''This module implements the capture to host pipeline of EOS cameras.
+
+When an EOS camera captures to the host, each new object is announced with a
+RequestObjectTransfer event. The host downloads the object and acknowledges it
+with EOSTransferComplete, which frees the buffer of the camera for the next
+shot. Objects are downloaded in chunks straight to disk, so bursts do not need
+to fit in memory.
+'''
+from ...ptp import PTPError
+from ...util import monotonic, object_filename
+from collections import namedtuple
+from six.moves.queue import Queue, Empty
+from threading import Condition, Event, Thread
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('EOSTransfer', 'EOSTransfers')
+
+EOSTransfer = namedtuple('EOSTransfer', ('handle', 'path', 'size', 'elapsed'))
+EOSTransfer.__doc__ = '''Object downloaded from an EOS camera.'''
+
+
+class EOSTransfers(object):
+    '''Download the objects an EOS camera sends to the host.
+
+    Objects are written to `directory` by a dedicated thread, in chunks of
+    `chunk_size` bytes, and acknowledged as soon as they are on disk. Unless
+    `capture_to_host` is False, the camera is told to send new captures to
+    the host on `start`, and back to where they went before on `stop`. An EOS
+    session must be open:
+
+        with camera.session(), camera.eos_capture_to_host('shots') as shots:
+            camera.eos_remote_release()
+            print(shots.wait(count=1, timeout=10))
+    '''
+
+    def __init__(
+            self,
+            camera,
+            directory='.',
+            chunk_size=1 << 20,
+            capture_to_host=True,
+    ):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.__camera = camera
+        self.__capture_to_host = capture_to_host
+        self.__requests = Queue()
+        self.__done = Condition()
+        self.__completed = []
+        self.__failed = []
+        self.__shutdown = Event()
+        self.__subscription = None
+        self.__thread = None
+        self.__redirected = False
+        self.__destination = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def completed(self):
+        '''Downloaded objects, as `EOSTransfer`.'''
+        with self.__done:
+            return list(self.__completed)
+
+    @property
+    def failed(self):
+        '''Objects that could not be downloaded, with the error.'''
+        with self.__done:
+            return list(self.__failed)
+
+    @property
+    def pending(self):
+        return self.__requests.qsize()
+
+    def start(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        camera = self.__camera
+        if self.__capture_to_host and not self.__redirected:
+            self.__destination = self.__capture_destination()
+            # Tell the camera to send captures to the host, which has room.
+            response = camera.eos_set_device_prop_value_ex(
+                'CaptureDestination', 4
+            )
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not capture to host: {}'
+                    .format(response.ResponseCode)
+                )
+            self.__redirected = True
+            camera.eos_pc_hdd_capacity()
+        self.__shutdown.clear()
+        self.__subscription = camera.subscribe(
+            self.__requests.put,
+            code='RequestObjectTransfer',
+        )
+        self.__thread = Thread(name='EOSTransfers', target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        '''Stop after the pending transfers, waiting at most `timeout`.'''
+        if self.__subscription is not None:
+            self.__camera.unsubscribe(self.__subscription)
+            self.__subscription = None
+        self.__shutdown.set()
+        if self.__thread is not None and self.__thread.is_alive():
+            self.__thread.join(timeout)
+        if self.__redirected:
+            self.__redirected = False
+            self.__restore_capture_destination()
+
+    def wait(self, count=1, timeout=None):
+        '''Wait for `count` objects in total to be downloaded.
+
+        Return the downloaded objects.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.__done:
+            while len(self.__completed) + len(self.__failed) < count:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                self.__done.wait(remaining)
+            return list(self.__completed)
+
+    def __capture_destination(self, timeout=1):
+        '''Read the current CaptureDestination, or None if it is unknown.
+
+        EOS cameras report property values as events when asked to.
+        '''
+        camera = self.__camera
+        values = Queue()
+
+        def destination(event):
+            if event.get('PropertyCode') == 'CaptureDestination':
+                values.put(event.Value)
+        subscription = camera.subscribe(destination, code='DevicePropChanged')
+        try:
+            camera.eos_request_device_prop_value('CaptureDestination')
+            camera.event_poller.kick()
+            value = values.get(timeout=timeout)
+        except Empty:
+            return None
+        finally:
+            camera.unsubscribe(subscription)
+        if isinstance(value, list):
+            # Properties without a known type are given as little endian
+            # bytes.
+            value = sum(byte << (8 * i) for i, byte in enumerate(value))
+        return value
+
+    def __restore_capture_destination(self):
+        if self.__destination is None:
+            logger.warning(
+                'Captures are still sent to the host: the previous '
+                'CaptureDestination is unknown.'
+            )
+            return
+        response = self.__camera.eos_set_device_prop_value_ex(
+            'CaptureDestination', self.__destination
+        )
+        if response.ResponseCode != 'OK':
+            logger.warning(
+                'Could not restore CaptureDestination: {}'
+                .format(response.ResponseCode)
+            )
+
+    def __run(self):
+        while True:
+            try:
+                request = self.__requests.get(timeout=0.1)
+            except Empty:
+                if self.__shutdown.is_set():
+                    return
+                continue
+            self.__transfer(request)
+
+    def __transfer(self, request):
+        camera = self.__camera
+        handle = request.get('ObjectHandle')
+        if handle is None:
+            logger.warning('Undecoded transfer request {}'.format(request))
+            return
+        name = object_filename(request.get('Filename'), handle)
+        path = os.path.join(self.directory, name)
+        start = monotonic()
+        try:
+            # Only complete files get their final name.
+            with open(path + '.part', 'wb') as f:
+                size = camera.eos_download(
+                    handle,
+                    f,
+                    size=request.ObjectCompressedSize or None,
+                    chunk_size=self.chunk_size,
+                    between_chunks=camera._eos_poll_if_due,
+                )
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(path + '.part', path)
+            response = camera.eos_transfer_complete(handle)
+            if response.ResponseCode != 'OK':
+                logger.warning(
+                    'Transfer of {} not acknowledged: {}'
+                    .format(name, response.ResponseCode)
+                )
+        except Exception as e:
+            logger.error('Could not download {}: {}'.format(name, e))
+            with self.__done:
+                self.__failed.append((request, e))
+                self.__done.notify_all()
+            return
+        transfer = EOSTransfer(handle, path, size, monotonic() - start)
+        logger.debug('Downloaded {}'.format(transfer))
+        with self.__done:
+            self.__completed.append(transfer)
+            self.__done.notify_all()
@@ -3,14 +3,205 @@
 Use it in a master module that determines the vendor and automatically uses its
 extension. This is why inheritance is not explicit.
 '''
+from ..util import BYTE_ORDER
+from array import array
+from construct import Container, Enum, Pass
+from dateutil.parser import parse as iso8601
 import logging
+import struct
 logger = logging.getLogger(__name__)
 
-__all__ = ('Microsoft',)
+__all__ = ('Microsoft', 'ObjectPropList', 'ObjectPropListParser')
+
+_NUMERIC = {
+    0x0001: 'b',
+    0x0002: 'B',
+    0x0003: 'h',
+    0x0004: 'H',
+    0x0005: 'i',
+    0x0006: 'I',
+    0x0007: 'q',
+    0x0008: 'Q',
+}
+_INT128 = (0x0009, 0x000A)
+_STRING = 0xFFFF
+_ARRAY = 0x4000
+
+
+class ObjectPropList(object):
+    '''Object properties from GetObjPropList, stored by column.
+
+    `handles` holds every listed object once, in the order of the dataset.
+    Each property is a column aligned with `handles`, where objects without
+    that property hold None:
+
+        listing = camera.get_obj_prop_list(all_objects=True)
+        for handle, name, size in zip(
+                listing.handles,
+                listing['ObjectFileName'],
+                listing['ObjectSize'],
+        ):
+            print(handle, name, size)
+    '''
+
+    def __init__(self):
+        self.handles = array('L')
+        self.__columns = {}
+        self.__index = {}
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __contains__(self, handle):
+        return handle in self.__index
+
+    @property
+    def properties(self):
+        return list(self.__columns)
+
+    def __getitem__(self, object_property):
+        column = self.__columns[object_property]
+        if len(column) < len(self.handles):
+            column.extend([None] * (len(self.handles) - len(column)))
+        return column
+
+    def get(self, object_property, default=None):
+        if object_property not in self.__columns:
+            return default
+        return self[object_property]
+
+    def row(self, handle):
+        '''Return the properties of a single object as a Container.'''
+        index = self.__index[handle]
+        properties = Container(ObjectHandle=handle)
+        for name, column in self.__columns.items():
+            if index < len(column) and column[index] is not None:
+                properties[name] = column[index]
+        return properties
+
+    def rows(self):
+        for handle in self.handles:
+            yield self.row(handle)
+
+    def _add(self, handle, object_property, value):
+        index = self.__index.get(handle)
+        if index is None:
+            index = self.__index[handle] = len(self.handles)
+            self.handles.append(handle)
+        column = self.__columns.get(object_property)
+        if column is None:
+            column = self.__columns[object_property] = []
+        if len(column) <= index:
+            column.extend([None] * (index + 1 - len(column)))
+        column[index] = value
+
+
+class ObjectPropListParser(object):
+    '''Parse the dataphase of GetObjPropList into an `ObjectPropList`.
+
+    The dataset is a count followed by one element per object property, each
+    made of the object handle, the property code, its data type and its
+    value. Elements are decoded with precompiled structs, since listings can
+    hold hundreds of thousands of them.
+    '''
+
+    def __init__(self, endian, object_property_code, object_format_code):
+        order = BYTE_ORDER[endian]
+        self.__count = struct.Struct(order + 'I')
+        self.__element = struct.Struct(order + 'IHH')
+        self.__numeric = {
+            code: struct.Struct(order + fmt) for code, fmt in _NUMERIC.items()
+        }
+        self.__int128 = struct.Struct(order + 'QQ')
+        self.__little = endian != 'big'
+        self.__encoding = 'utf-16-be' if endian == 'big' else 'utf-16-le'
+        self.__property_names = object_property_code.decoding
+        self.__format_names = object_format_code.decoding
+
+    def parse(self, data):
+        listing = ObjectPropList()
+        length = len(data)
+        if length < self.__count.size:
+            return listing
+        count = self.__count.unpack_from(data, 0)[0]
+        offset = self.__count.size
+        element = self.__element
+        names = self.__property_names
+        for _ in range(count):
+            if offset + element.size > length:
+                logger.debug('Truncated object property list')
+                break
+            handle, code, data_type = element.unpack_from(data, offset)
+            offset += element.size
+            try:
+                value, offset = self.__value(data, offset, data_type)
+            except struct.error:
+                logger.debug('Truncated object property list')
+                break
+            if value is None and offset < 0:
+                logger.warning(
+                    'Unknown data type {} in object property list'
+                    .format(hex(data_type))
+                )
+                break
+            name = names.get(code, code)
+            if name == 'ObjectFormat':
+                value = self.__format_names.get(value, value)
+            elif isinstance(name, str) and name.startswith('Date'):
+                value = self.__date(value)
+            listing._add(handle, name, value)
+        return listing
+
+    def __value(self, data, offset, data_type):
+        '''Return a value and the offset after it, or (None, -1).'''
+        numeric = self.__numeric.get(data_type)
+        if numeric is not None:
+            return numeric.unpack_from(data, offset)[0], offset + numeric.size
+        if data_type == _STRING:
+            return self.__string(data, offset)
+        if data_type in _INT128:
+            return self.__wide(data, offset, data_type)
+        base = data_type & ~_ARRAY
+        if data_type & _ARRAY and (base in self.__numeric or base in _INT128):
+            count = self.__count.unpack_from(data, offset)[0]
+            offset += self.__count.size
+            values = []
+            for _ in range(count):
+                value, offset = self.__value(data, offset, base)
+                values.append(value)
+            return values, offset
+        return None, -1
+
+    def __string(self, data, offset):
+        characters = bytearray(data[offset:offset + 1])
+        if not characters:
+            raise struct.error('Truncated string')
+        end = offset + 1 + 2 * characters[0]
+        if end > len(data):
+            raise struct.error('Truncated string')
+        text = bytes(data[offset + 1:end]).decode(self.__encoding, 'replace')
+        return text.split(u'\x00')[0], end
+
+    def __wide(self, data, offset, data_type):
+        low, high = self.__int128.unpack_from(data, offset)
+        if not self.__little:
+            low, high = high, low
+        value = (high << 64) | low
+        if data_type == 0x0009 and value >= 1 << 127:
+            value -= 1 << 128
+        return value, offset + self.__int128.size
+
+    def __date(self, value):
+        if not value:
+            return None
+        try:
+            return iso8601(value)
+        except (ValueError, OverflowError):
+            return value
 
 
 class Microsoft(object):
-    '''This class implements Canon's PTP operations.'''
+    '''This class implements Microsoft's MTP operations.'''
 
     def __init__(self, *args, **kwargs):
         logger.debug('Init Microsoft')
@@ -45,6 +236,7 @@ class Microsoft(object):
             SetObjectReferences=0x9811,
             UpdateDeviceFirmware=0x9812,
             Skip=0x9820,
+            GetPartialObject64=0x95C1,
             # microsoft.com/WMDRMPD
             GetSecureTimeChallenge=0x9101,
             GetSecureTimeResponse=0x9102,
@@ -83,6 +275,80 @@ class Microsoft(object):
             **product_operations
         )
 
+    def _ObjectPropertyCode(self, **product_object_properties):
+        return Enum(
+            self._UInt16,
+            default=Pass,
+            StorageID=0xDC01,
+            ObjectFormat=0xDC02,
+            ProtectionStatus=0xDC03,
+            ObjectSize=0xDC04,
+            AssociationType=0xDC05,
+            AssociationDesc=0xDC06,
+            ObjectFileName=0xDC07,
+            DateCreated=0xDC08,
+            DateModified=0xDC09,
+            Keywords=0xDC0A,
+            ParentObject=0xDC0B,
+            AllowedFolderContents=0xDC0C,
+            Hidden=0xDC0D,
+            SystemObject=0xDC0E,
+            PersistentUniqueObjectIdentifier=0xDC41,
+            SyncID=0xDC42,
+            PropertyBag=0xDC43,
+            Name=0xDC44,
+            CreatedBy=0xDC45,
+            Artist=0xDC46,
+            DateAuthored=0xDC47,
+            Description=0xDC48,
+            URLReference=0xDC49,
+            LanguageLocale=0xDC4A,
+            CopyrightInformation=0xDC4B,
+            Source=0xDC4C,
+            OriginLocation=0xDC4D,
+            DateAdded=0xDC4E,
+            NonConsumable=0xDC4F,
+            CorruptUnplayable=0xDC50,
+            ProducerSerialNumber=0xDC51,
+            RepresentativeSampleFormat=0xDC81,
+            RepresentativeSampleSize=0xDC82,
+            RepresentativeSampleHeight=0xDC83,
+            RepresentativeSampleWidth=0xDC84,
+            RepresentativeSampleDuration=0xDC85,
+            RepresentativeSampleData=0xDC86,
+            Width=0xDC87,
+            Height=0xDC88,
+            Duration=0xDC89,
+            Rating=0xDC8A,
+            Track=0xDC8B,
+            Genre=0xDC8C,
+            Credits=0xDC8D,
+            Lyrics=0xDC8E,
+            SubscriptionContentID=0xDC8F,
+            ProducedBy=0xDC90,
+            UseCount=0xDC91,
+            SkipCount=0xDC92,
+            LastAccessed=0xDC93,
+            ParentalRating=0xDC94,
+            MetaGenre=0xDC95,
+            Composer=0xDC96,
+            EffectiveRating=0xDC97,
+            Subtitle=0xDC98,
+            OriginalReleaseDate=0xDC99,
+            AlbumName=0xDC9A,
+            AlbumArtist=0xDC9B,
+            Mood=0xDC9C,
+            DRMStatus=0xDC9D,
+            SubDescription=0xDC9E,
+            IsCropped=0xDCD1,
+            IsColourCorrected=0xDCD2,
+            ImageBitDepth=0xDCD3,
+            Fnumber=0xDCD4,
+            ExposureTime=0xDCD5,
+            ExposureIndex=0xDCD6,
+            **product_object_properties
+        )
+
     def _ResponseCode(self, **product_responses):
         return super(Microsoft, self)._ResponseCode(
             MicrosoftUndefined=0xA800,
@@ -179,3 +445,76 @@ class Microsoft(object):
             Section=0xbe82,
             **product_object_formats
         )
+
+    def _set_endian(self, endian):
+        logger.debug('Set Microsoft endianness')
+        super(Microsoft, self)._set_endian(endian)
+        self._ObjectPropertyCode = self._ObjectPropertyCode()
+        self._ObjectPropListParser = ObjectPropListParser(
+            endian,
+            self._ObjectPropertyCode,
+            self._ObjectFormatCode,
+        )
+
+    def get_obj_prop_list(
+            self,
+            object_handle=0,
+            object_format=0,
+            object_property=None,
+            property_group=0,
+            depth=0,
+            all_objects=False,
+            all_levels=False,
+    ):
+        '''Return the properties of many objects as an `ObjectPropList`.
+
+        A single transaction describes `object_handle` and the objects up to
+        `depth` levels below it, or `all_levels` below it. With `all_objects`
+        every object on the device is listed. Only objects of `object_format`
+        are listed, if given. Every property is returned unless an
+        `object_property` or a `property_group` is given.
+        '''
+        code = self._code(object_format, self._ObjectFormatCode)
+        if object_property is not None:
+            object_property = self._code(
+                object_property, self._ObjectPropertyCode
+            )
+        elif not property_group:
+            object_property = 0xFFFFFFFF
+        ptp = Container(
+            OperationCode='GetObjPropList',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[
+                0xFFFFFFFF if all_objects else object_handle,
+                code,
+                object_property or 0,
+                property_group,
+                0xFFFFFFFF if all_levels else depth,
+            ]
+        )
+        response = self.recv(ptp)
+        return self._parse_if_data(response, self._ObjectPropListParser)
+
+    def get_partial_object_64(self, handle, offset, max_bytes):
+        '''Get up to `max_bytes` of an object from a 64 bit `offset`.'''
+        ptp = Container(
+            OperationCode='GetPartialObject64',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[
+                handle,
+                offset & 0xFFFFFFFF,
+                offset >> 32,
+                min(max_bytes, 0xFFFFFFFF),
+            ]
+        )
+        return self.recv(ptp)
+
+    def _get_partial_object_at(self, handle, offset, max_bytes):
+        # Only MTP 1.1 devices support GetPartialObject64.
+        if offset + max_bytes <= 0xFFFFFFFF:
+            return super(Microsoft, self)._get_partial_object_at(
+                handle, offset, max_bytes
+            )
+        return self.get_partial_object_64(handle, offset, max_bytes)
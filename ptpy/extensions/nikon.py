@@ -2,14 +2,16 @@
 Use it in a master module that determines the vendor and automatically uses its
 extension. This is why inheritance is not explicit.
 '''
-from ..util import _main_thread_alive
+from ..busy import BusyPolicy
+from ..liveview import LiveView
+from ..ptp import PTPError
+from ..reactor import AdaptivePoller
+from ..util import monotonic
 from construct import (
     Container, PrefixedArray, Struct,
 )
 from contextlib import contextmanager
-from six.moves.queue import Queue
-from threading import Thread, Event
-from time import sleep
+from six.moves.queue import Queue, Empty
 import atexit
 import logging
 logger = logging.getLogger(__name__)
@@ -18,15 +20,32 @@ __all__ = ('Nikon',)
 
 
 class Nikon(object):
-    '''This class implements Nikon's PTP operations.'''
+    '''This class implements Nikon's PTP operations.
+
+    Nikon events are checked every `poll_min_interval` seconds after captures
+    and property changes, backing off to `poll_max_interval` seconds when
+    idle.
+    '''
 
     def __init__(self, *args, **kwargs):
         logger.debug('Init Nikon')
+        self.__nikon_poller = AdaptivePoller(
+            kwargs.pop('poll_min_interval', 0.1),
+            kwargs.pop('poll_max_interval', 3.),
+        )
+        self.__device_ready_supported = None
         super(Nikon, self).__init__(*args, **kwargs)
         # TODO: expose the choice to poll or not Nikon events
         self.__no_polling = False
-        self.__nikon_event_shutdown = Event()
-        self.__nikon_event_proc = None
+        self.__nikon_event_task = None
+        self.__nikon_last_poll = 0
+        self.__nikon_poll_requested = False
+        self._add_poller(self.__nikon_poller)
+
+    @property
+    def event_poller(self):
+        '''The `AdaptivePoller` pacing Nikon event checks.'''
+        return self.__nikon_poller
 
     @contextmanager
     def session(self):
@@ -40,15 +59,16 @@ class Nikon(object):
             return
         # Within a normal PTP session
         with super(Nikon, self).session():
-            # launch a polling thread
-            self.__event_queue = Queue()
-            self.__nikon_event_proc = Thread(
+            # poll events from the reactor
+            self.__nikon_event_task = self._reactor.call_every(
+                self.__nikon_poller.min_interval,
+                self.__nikon_poll_events,
+                blocking=True,
                 name='NikonEvtPolling',
-                target=self.__nikon_poll_events
+                group=self,
             )
-            self.__nikon_event_proc.daemon = False
+            self.__nikon_poller.task = self.__nikon_event_task
             atexit.register(self._nikon_shutdown)
-            self.__nikon_event_proc.start()
 
             try:
                 yield
@@ -61,11 +81,18 @@ class Nikon(object):
 
     def _nikon_shutdown(self):
         logger.debug('Shutdown Nikon events')
-        self.__nikon_event_shutdown.set()
+        # Only wait for a running poll.
+        if self.__nikon_event_task is not None:
+            self.__nikon_poller.task = None
+            self.__nikon_event_task.cancel(timeout=2)
 
-        # Only join a running thread.
-        if self.__nikon_event_proc and self.__nikon_event_proc.is_alive():
-            self.__nikon_event_proc.join(2)
+    def _poll_triggers(self):
+        return super(Nikon, self)._poll_triggers() | {
+            'Capture',
+            'AFCaptureSDRAM',
+            'InitiateCaptureRecInMedia',
+            'TerminateCapture',
+        }
 
     def _PropertyCode(self, **product_properties):
         props = {
@@ -393,6 +420,7 @@ class Nikon(object):
             TerminateCapture=0x920C,
             GetDevicePTPIPInfo=0x90E0,
             GetPartialObjectHiSpeed=0x9400,
+            GetPartialObjectEx=0x9431,
             GetDevicePropEx=0x9504,
             **product_operations
         )
@@ -477,33 +505,251 @@ class Nikon(object):
         )
         return self.mesg(ptp)
 
-    def event(self, wait=False):
-        '''Check Nikon or PTP events
+    def device_ready(self):
+        '''Check whether the camera is done with the last operation'''
+        ptp = Container(
+            OperationCode='DeviceReady',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        # DeviceBusy is an answer here, not a reason to retry.
+        return self.mesg(ptp, retry=False)
+
+    def _ready(self):
+        '''Ask DeviceReady whether the camera is done, if it implements it.'''
+        if self.__device_ready_supported is False:
+            return super(Nikon, self)._ready()
+        code = self.device_ready().ResponseCode
+        if code == 'OK':
+            return True
+        if code == 'DeviceBusy':
+            return False
+        self.__device_ready_supported = False
+        return super(Nikon, self)._ready()
+
+    def wait_until_ready(self, timeout=5):
+        '''Wait while the camera reports DeviceBusy.
 
-        If `wait` this function is blocking. Otherwise it may return None.
+        DeviceReady is asked again after the delays of the `busy_policy`, or
+        as soon as one of its readiness events arrives. Return the last
+        DeviceReady response.
         '''
-        # TODO: Do something reasonable on wait=True
-        evt = None
-        timeout = None if wait else 0.001
-        # TODO: Join queues to preserve order of Nikon and PTP events.
-        if not self.__event_queue.empty():
-            evt = self.__event_queue.get(block=not wait, timeout=timeout)
-        else:
-            evt = super(Nikon, self).event(wait=wait)
+        policy = self.busy_policy or BusyPolicy()
+        delays = policy.delays()
+        deadline = monotonic() + timeout
+        while True:
+            response = self.device_ready()
+            if (
+                    response.ResponseCode != 'DeviceBusy' or
+                    monotonic() >= deadline
+            ):
+                return response
+            self._wait_while_busy(policy, next(delays), deadline)
 
-        return evt
+    def del_image_sdram(self, handle):
+        '''Free an object captured to SDRAM'''
+        ptp = Container(
+            OperationCode='DelImageSDRAM',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[handle]
+        )
+        return self.mesg(ptp)
 
-    def __nikon_poll_events(self):
-        '''Poll events, adding them to a queue.'''
-        while (not self.__nikon_event_shutdown.is_set() and
-               _main_thread_alive()):
+    def capture_to_sdram(self, timeout=10, delete=True):
+        '''
+        Autofocus, capture to SDRAM and return the downloaded object.
+
+        The object is downloaded as soon as the camera announces it, without
+        being written to a card. Return a Container with its `ObjectHandle`
+        and `Data`, or None if nothing is announced within `timeout` seconds.
+        Unless `delete` is False the object is then freed from SDRAM.
+        '''
+        added = Queue()
+        # Subscribe first, since Nikon events carry no transaction.
+        subscriptions = [
+            self.subscribe(added.put, code=code)
+            for code in ('ObjectAddedInSDRAM', 'ObjectAdded')
+        ]
+        try:
+            response = self.af_capture_sdram()
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not capture to SDRAM: {}'
+                    .format(response.ResponseCode)
+                )
             try:
-                evts = self.check_events()
-                if evts:
-                    for evt in evts:
-                        logger.debug('Event queued')
-                        self.__event_queue.put(evt)
-            except Exception as e:
-                logger.error(e)
-            sleep(3)
-        self.__nikon_event_shutdown.clear()
+                event = added.get(timeout=timeout)
+            except Empty:
+                return None
+        finally:
+            for subscription in subscriptions:
+                self.unsubscribe(subscription)
+        handle = event.get('Parameter')
+        if isinstance(handle, list):
+            handle = handle[0] if handle else None
+        if not handle:
+            # Objects in SDRAM are not always announced with their handle.
+            handle = 0xFFFF0001
+        self.wait_until_ready()
+        response = self.get_object(handle)
+        if response.ResponseCode != 'OK':
+            raise PTPError(
+                'Could not get SDRAM object {}: {}'
+                .format(handle, response.ResponseCode)
+            )
+        if delete:
+            self.del_image_sdram(handle)
+        return Container(ObjectHandle=handle, Data=response.Data)
+
+    def get_partial_object_ex(self, handle, offset, max_bytes):
+        '''Get up to `max_bytes` of an object from a 64 bit `offset`.'''
+        ptp = Container(
+            OperationCode='GetPartialObjectEx',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[
+                handle,
+                offset & 0xFFFFFFFF,
+                offset >> 32,
+                max_bytes & 0xFFFFFFFF,
+                max_bytes >> 32,
+            ]
+        )
+        return self.recv(ptp)
+
+    def _get_partial_object_at(self, handle, offset, max_bytes):
+        if offset + max_bytes <= 0xFFFFFFFF:
+            return super(Nikon, self)._get_partial_object_at(
+                handle, offset, max_bytes
+            )
+        return self.get_partial_object_ex(handle, offset, max_bytes)
+
+    def start_live_view(self):
+        '''Start live view on Nikon cameras'''
+        ptp = Container(
+            OperationCode='StartLiveView',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        return self.mesg(ptp)
+
+    def end_live_view(self):
+        '''End live view on Nikon cameras'''
+        ptp = Container(
+            OperationCode='EndLiveView',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        return self.mesg(ptp)
+
+    def get_live_view_img(self):
+        '''Get a live view image and its header on Nikon cameras'''
+        ptp = Container(
+            OperationCode='GetLiveViewImg',
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[]
+        )
+        return self.recv(ptp)
+
+    def live_view_jpeg(self, data):
+        '''
+        Return the JPEG in a GetLiveViewImg dataphase as a memoryview.
+
+        The size of the header preceding the image depends on the model, so
+        the image is found by its start of image marker.
+        '''
+        start = bytes(data[:4096]).find(b'\xff\xd8')
+        if start < 0:
+            start = bytes(data).find(b'\xff\xd8')
+        if start < 0:
+            return None
+        return memoryview(data)[start:]
+
+    def live_view(self, **kwargs):
+        '''
+        Return a `LiveView` streaming live view images from Nikon cameras.
+
+        Live view needs an open session. Frames are fetched as fast as the
+        camera produces them, while Nikon events keep being checked between
+        frames. Keyword arguments are given to `LiveView`:
+
+            with camera.session(), camera.live_view() as live_view:
+                for frame in live_view.frames(timeout=2):
+                    show(frame.data)
+        '''
+        kwargs.setdefault('name', 'NikonLiveView')
+        return LiveView(
+            self.__nikon_live_view_frame,
+            setup=self.__nikon_start_live_view,
+            teardown=self.end_live_view,
+            between_frames=self._nikon_poll_if_due,
+            **kwargs
+        )
+
+    def __nikon_start_live_view(self):
+        response = self.start_live_view()
+        if response.ResponseCode not in ('OK', 'DeviceBusy'):
+            raise PTPError(
+                'Could not start live view: {}'.format(response.ResponseCode)
+            )
+        response = self.wait_until_ready()
+        # Bodies without DeviceReady are taken to be ready, as in `_ready`.
+        if response.ResponseCode not in ('OK', 'OperationNotSupported'):
+            raise PTPError(
+                'Live view not ready: {}'.format(response.ResponseCode)
+            )
+
+    def __nikon_live_view_frame(self):
+        response = self.get_live_view_img()
+        if response.ResponseCode != 'OK' or not hasattr(response, 'Data'):
+            # The camera has no new frame yet.
+            return None
+        return self.live_view_jpeg(response.Data)
+
+    def _nikon_poll_if_due(self):
+        '''Have events checked now if the event poller is due.
+
+        Long running loops call this between transfers, since the periodic
+        check yields to them. The requested check runs in the lane of the
+        camera, so it never overlaps another one, and waits for the running
+        transfer instead of yielding to it.
+        '''
+        elapsed = monotonic() - self.__nikon_last_poll
+        if (
+                self.__nikon_event_task is not None and
+                not self.__nikon_event_task.cancelled and
+                elapsed >= self.__nikon_poller.interval
+        ):
+            self.__nikon_poll_requested = True
+            self.__nikon_event_task.run_soon()
+
+    def __nikon_poll_events(self):
+        '''Poll events, adding them to the event stream.
+
+        Return the delay until the next poll.
+        '''
+        poller = self.__nikon_poller
+        requested = self.__nikon_poll_requested
+        self.__nikon_poll_requested = False
+        if not self.event_stream.accepting or (
+                self._transfer_in_flight and not requested
+        ):
+            # Yield to the consumer or to the running transfer.
+            return poller.min_interval
+        self.__nikon_last_poll = monotonic()
+        evts = None
+        try:
+            evts = self.check_events()
+            received_at = monotonic()
+            if evts:
+                for evt in evts:
+                    logger.debug('Event received')
+                    self._event_received(evt, 'Nikon', received_at)
+        except Exception as e:
+            logger.error(e)
+        return poller.next_delay(found=bool(evts))
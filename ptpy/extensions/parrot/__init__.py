@@ -0,0 +1,3 @@
+from .parrot import Parrot
+
+__all__ = ('Parrot',)
@@ -0,0 +1,303 @@
+'''This module implements the multispectral capture pipeline of Sequoia.
+
+A single capture of a Sequoia produces an RGB image and a TIFF per band, each
+announced with an ObjectAdded event for the transaction of InitiateCapture.
+Objects are downloaded back to back by one thread while another writes them
+to disk, so that the next download never waits for the disk. Once every
+object of a capture is on disk, a `CaptureSet` record is emitted.
+'''
+from ...ptp import PTPError
+from ...util import monotonic, object_filename
+from collections import OrderedDict, namedtuple
+from six.moves.queue import Queue
+from threading import Condition, Thread
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('CaptureSet', 'MultispectralCapture')
+
+CaptureSet = namedtuple(
+    'CaptureSet',
+    ('transaction_id', 'paths', 'size', 'latency', 'download', 'elapsed'),
+)
+CaptureSet.__doc__ = '''Objects of one capture written to disk.
+
+`latency` is the time from the capture to its first ObjectAdded event,
+`download` the total time spent downloading its objects and `elapsed` the time
+from the capture until its last object was written, all in seconds.
+'''
+
+
+class _Pending(object):
+    '''Objects of a capture that are not all written yet.'''
+
+    def __init__(self, started):
+        self.started = started
+        self.first_object = None
+        self.announced = 0
+        self.failed = 0
+        self.paths = []
+        self.size = 0
+        self.download = 0.
+        self.capture_complete = False
+
+
+class MultispectralCapture(object):
+    '''Capture with a Sequoia and download each capture set to `directory`.
+
+    Objects are grouped by the transaction of the capture that produced
+    them. A set is complete when the camera sends CaptureComplete, or when
+    `objects_per_capture` objects are announced if given, and all of them
+    are written. At most `read_ahead` downloaded objects wait for the writer.
+    `on_complete(capture_set)` is called for each complete set, from the
+    writer thread. A session must be open:
+
+        with camera.session(), camera.multispectral_capture('flight') as mc:
+            for _ in range(10):
+                mc.capture()
+            print(mc.wait(count=10, timeout=60))
+    '''
+
+    def __init__(
+            self,
+            camera,
+            directory='.',
+            objects_per_capture=None,
+            read_ahead=4,
+            on_complete=None,
+    ):
+        self.directory = directory
+        self.objects_per_capture = objects_per_capture
+        self.on_complete = on_complete
+        self.__camera = camera
+        self.__downloads = Queue()
+        self.__writes = Queue(maxsize=read_ahead)
+        self.__done = Condition()
+        self.__pending = OrderedDict()
+        self.__completed = []
+        self.__failed = []
+        self.__subscriptions = []
+        self.__threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def completed(self):
+        '''Complete capture sets, as `CaptureSet`.'''
+        with self.__done:
+            return list(self.__completed)
+
+    @property
+    def failed(self):
+        '''Objects that could not be downloaded, with the error.'''
+        with self.__done:
+            return list(self.__failed)
+
+    def start(self):
+        if self.__threads:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        camera = self.__camera
+        self.__subscriptions = [
+            camera.subscribe(self.__object_added, code='ObjectAdded'),
+            camera.subscribe(self.__capture_complete, code='CaptureComplete'),
+        ]
+        self.__threads = [
+            Thread(name='MultispectralDownload', target=self.__download),
+            Thread(name='MultispectralWrite', target=self.__write),
+        ]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        '''Stop after the pending objects, waiting at most `timeout`.'''
+        for subscription in self.__subscriptions:
+            self.__camera.unsubscribe(subscription)
+        self.__subscriptions = []
+        threads, self.__threads = self.__threads, []
+        if threads:
+            self.__downloads.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def capture(self, storage_id=0, object_format=0):
+        '''Initiate a capture whose objects are downloaded when announced.'''
+        started = monotonic()
+        response = self.__camera.initiate_capture(storage_id, object_format)
+        if response.ResponseCode != 'OK':
+            raise PTPError(
+                'Could not capture: {}'.format(response.ResponseCode)
+            )
+        transaction_id = response.TransactionID
+        with self.__done:
+            # Events may have been received before the response, and the set
+            # may even be complete already.
+            pending = self.__pending.get(transaction_id)
+            if pending is not None:
+                pending.started = started
+            elif not any(
+                    s.transaction_id == transaction_id
+                    for s in self.__completed
+            ):
+                self.__pending[transaction_id] = _Pending(started)
+        return response
+
+    def wait(self, count=1, timeout=None):
+        '''Wait for `count` capture sets in total to be complete.
+
+        Return the complete capture sets.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.__done:
+            while len(self.__completed) < count:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                self.__done.wait(remaining)
+            return list(self.__completed)
+
+    def __key(self, event):
+        '''Return the transaction of an event, under the lock.'''
+        transaction_id = event.get('TransactionID')
+        if not transaction_id and self.__pending:
+            # Events without a transaction belong to the oldest capture.
+            transaction_id = next(iter(self.__pending))
+        return transaction_id
+
+    def __get(self, transaction_id):
+        '''Return the pending set of a transaction, under the lock.'''
+        pending = self.__pending.get(transaction_id)
+        if pending is None:
+            pending = self.__pending[transaction_id] = _Pending(monotonic())
+        return pending
+
+    def __object_added(self, event):
+        parameter = event.Parameter
+        handle = parameter[0] if isinstance(parameter, list) else parameter
+        with self.__done:
+            transaction_id = self.__key(event)
+            pending = self.__get(transaction_id)
+            pending.announced += 1
+            if pending.first_object is None:
+                pending.first_object = monotonic()
+        self.__downloads.put((transaction_id, handle))
+
+    def __capture_complete(self, event):
+        with self.__done:
+            transaction_id = self.__key(event)
+            self.__get(transaction_id).capture_complete = True
+            capture_set = self.__check(transaction_id)
+        self.__emit(capture_set)
+
+    def __download(self):
+        camera = self.__camera
+        while True:
+            request = self.__downloads.get()
+            if request is None:
+                self.__writes.put(None)
+                return
+            transaction_id, handle = request
+            start = monotonic()
+            try:
+                info = camera.get_object_info(handle)
+                response = camera.get_object(handle)
+                if response.ResponseCode != 'OK':
+                    raise PTPError(
+                        'Could not get object {}: {}'
+                        .format(handle, response.ResponseCode)
+                    )
+            except Exception as e:
+                logger.error('Could not download {}: {}'.format(handle, e))
+                with self.__done:
+                    self.__failed.append((handle, e))
+                    self.__get(transaction_id).failed += 1
+                    capture_set = self.__check(transaction_id)
+                self.__emit(capture_set)
+                continue
+            name = object_filename(
+                info.Filename if info is not None else None, handle
+            )
+            # Waits when the writer is `read_ahead` objects behind.
+            self.__writes.put(
+                (transaction_id, name, response.Data, monotonic() - start)
+            )
+
+    def __write(self):
+        while True:
+            request = self.__writes.get()
+            if request is None:
+                return
+            transaction_id, name, data, download = request
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path + '.part', 'wb') as f:
+                    f.write(data)
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(path + '.part', path)
+            except Exception as e:
+                logger.error('Could not write {}: {}'.format(path, e))
+                with self.__done:
+                    self.__failed.append((name, e))
+                    self.__get(transaction_id).failed += 1
+                    capture_set = self.__check(transaction_id)
+                self.__emit(capture_set)
+                continue
+            with self.__done:
+                pending = self.__get(transaction_id)
+                pending.paths.append(path)
+                pending.size += len(data)
+                pending.download += download
+                capture_set = self.__check(transaction_id)
+            self.__emit(capture_set)
+
+    def __check(self, transaction_id):
+        '''Complete the set of a transaction if it is done, under the lock.'''
+        pending = self.__pending.get(transaction_id)
+        if pending is None:
+            return None
+        expected = self.objects_per_capture
+        if len(pending.paths) + pending.failed < pending.announced:
+            return None
+        if not (
+                pending.capture_complete or
+                expected is not None and pending.announced >= expected
+        ):
+            return None
+        del self.__pending[transaction_id]
+        now = monotonic()
+        capture_set = CaptureSet(
+            transaction_id=transaction_id,
+            paths=pending.paths,
+            size=pending.size,
+            latency=(
+                pending.first_object - pending.started
+                if pending.first_object is not None else None
+            ),
+            download=pending.download,
+            elapsed=now - pending.started,
+        )
+        self.__completed.append(capture_set)
+        self.__done.notify_all()
+        return capture_set
+
+    def __emit(self, capture_set):
+        if capture_set is None:
+            return
+        logger.debug('Capture set complete {}'.format(capture_set))
+        if self.on_complete is not None:
+            try:
+                self.on_complete(capture_set)
+            except Exception as e:
+                logger.error('Capture set callback failed: {}'.format(e))
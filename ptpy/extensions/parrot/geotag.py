@@ -0,0 +1,223 @@
+'''This module pushes geotags to Sequoia cameras at a high rate.
+
+Fixes from an external receiver are encoded with a precompiled struct and sent
+by a dedicated thread. Only the latest fix is kept: while the camera is busy,
+newer fixes replace the pending one, so the camera never receives fixes that
+waited behind a capture.
+'''
+from ...util import BYTE_ORDER, monotonic
+from collections import deque, namedtuple
+from construct import Container
+from threading import Condition, Thread
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('GeotagEncoder', 'GeotagFeeder', 'GeotagStats')
+
+GeotagStats = namedtuple(
+    'GeotagStats',
+    ('sent', 'coalesced', 'stale', 'errors', 'rate', 'age', 'mean_age'),
+)
+GeotagStats.__doc__ = '''Geotag counters, rate (Hz) and ages at send (s).'''
+
+# Fields of the geotag dataphase with their scale in the dataphase.
+_FIELDS = (
+    ('ValidityMask', None),
+    ('Timestamp', None),
+    ('Latitude', 10**7),
+    ('Longitude', 10**7),
+    ('Altitude', 1000),
+    ('Satellites', None),
+    ('AccuracyXY', 1000),
+    ('AccuracyZ', 1000),
+    ('NorthSpeed', 1000),
+    ('EastSpeed', 1000),
+    ('UpSpeed', 1000),
+    ('Roll', 1000),
+    ('Pitch', 1000),
+    ('Yaw', 1000),
+)
+
+
+class GeotagEncoder(object):
+    '''Build and parse geotag dataphases like `Parrot._Geotag`, but faster.
+
+    Geotags are Containers, or any object with the field attributes, in
+    degrees, meters, meters per second and degrees for the attitude.
+    '''
+
+    def __init__(self, endian):
+        self.__struct = struct.Struct(
+            BYTE_ORDER[endian] + 'IqiiiIIIiiiiii'
+        )
+        self.size = self.__struct.size
+
+    def build(self, geotag):
+        return self.__struct.pack(*[
+            getattr(geotag, name) if scale is None
+            else int(getattr(geotag, name) * scale)
+            for name, scale in _FIELDS
+        ])
+
+    def parse(self, data):
+        values = self.__struct.unpack_from(data)
+        return Container(**{
+            name: value if scale is None else value / float(scale)
+            for (name, scale), value in zip(_FIELDS, values)
+        })
+
+
+class GeotagFeeder(object):
+    '''Send the latest geotag pushed to a Sequoia camera.
+
+    `push` returns immediately. A dedicated thread sends the latest fix as
+    soon as the camera is free, and waits while any transaction is running.
+    Fixes replaced before being sent are counted as `coalesced`. Fixes older
+    than `max_age` seconds once the camera is held are dropped as `stale`. The
+    rate is measured over the last `window` seconds. A session must be open:
+
+        with camera.session(), camera.geotag_feeder() as feeder:
+            for fix in receiver:
+                feeder.push(fix)
+            print(feeder.stats)
+    '''
+
+    def __init__(self, camera, max_age=1., window=2., name='GeotagFeeder'):
+        self.max_age = max_age
+        self.__camera = camera
+        self.__window = window
+        self.__name = name
+        self.__condition = Condition()
+        self.__pending = None
+        self.__shutdown = False
+        self.__thread = None
+        self.__sent_at = deque()
+        self.__sent = 0
+        self.__coalesced = 0
+        self.__stale = 0
+        self.__errors = 0
+        self.__age = 0.
+        self.__total_age = 0.
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.__shutdown = False
+        self.__thread = Thread(name=self.__name, target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=2):
+        with self.__condition:
+            self.__shutdown = True
+            self.__condition.notify_all()
+        if self.__thread is not None and self.__thread.is_alive():
+            self.__thread.join(timeout)
+
+    def push(self, geotag, timestamp=None):
+        '''Send `geotag` next, replacing any fix not sent yet.
+
+        `timestamp` is the monotonic time at which the fix was received and
+        defaults to now.
+        '''
+        if timestamp is None:
+            timestamp = monotonic()
+        with self.__condition:
+            if self.__pending is not None:
+                self.__coalesced += 1
+            self.__pending = (geotag, timestamp)
+            self.__condition.notify_all()
+
+    @property
+    def stats(self):
+        with self.__condition:
+            sent_at = list(self.__sent_at)
+            rate = 0.
+            if len(sent_at) > 1 and sent_at[-1] > sent_at[0]:
+                rate = (len(sent_at) - 1) / (sent_at[-1] - sent_at[0])
+            return GeotagStats(
+                sent=self.__sent,
+                coalesced=self.__coalesced,
+                stale=self.__stale,
+                errors=self.__errors,
+                rate=rate,
+                age=self.__age,
+                mean_age=(
+                    self.__total_age / self.__sent if self.__sent else 0.
+                ),
+            )
+
+    def __next(self):
+        '''Wait for the camera to be free and return the latest fix.'''
+        camera = self.__camera
+        with self.__condition:
+            while not self.__shutdown and (
+                    self.__pending is None or camera._operation_in_flight
+            ):
+                # Keep coalescing while a transaction occupies the camera.
+                self.__condition.wait(
+                    None if self.__pending is None else 0.01
+                )
+            if self.__shutdown:
+                return None
+            pending, self.__pending = self.__pending, None
+            return pending
+
+    def __latest(self, pending):
+        '''Replace `pending` by a fix pushed while waiting for the camera.'''
+        with self.__condition:
+            if self.__pending is not None:
+                self.__coalesced += 1
+                pending, self.__pending = self.__pending, None
+            return pending
+
+    def __run(self):
+        camera = self.__camera
+        while True:
+            pending = self.__next()
+            if pending is None:
+                return
+            # Another transaction may have started since, so the age is only
+            # known once the camera is held.
+            with camera._operation_lock:
+                geotag, timestamp = self.__latest(pending)
+                age = monotonic() - timestamp
+                if self.max_age is not None and age > self.max_age:
+                    with self.__condition:
+                        self.__stale += 1
+                    continue
+                try:
+                    data = camera._GeotagEncoder.build(geotag)
+                    response = camera.set_geotag(data)
+                    ok = response.ResponseCode == 'OK'
+                    if not ok:
+                        logger.warning(
+                            'Geotag refused: {}'.format(response.ResponseCode)
+                        )
+                except Exception as e:
+                    logger.error('Could not send geotag: {}'.format(e))
+                    ok = False
+            now = monotonic()
+            with self.__condition:
+                if not ok:
+                    self.__errors += 1
+                    continue
+                self.__sent += 1
+                self.__age = age
+                self.__total_age += age
+                self.__sent_at.append(now)
+                while self.__sent_at[0] < now - self.__window:
+                    self.__sent_at.popleft()
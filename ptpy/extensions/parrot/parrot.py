@@ -3,6 +3,11 @@
 Use it in a master module that determines the vendor and automatically uses its
 extension.
 '''
+from ...ptp import PTPError
+from ...util import as_payload, monotonic
+from .capture import MultispectralCapture
+from .geotag import GeotagEncoder, GeotagFeeder
+from .telemetry import TELEMETRY_CHANNELS, TelemetryDecoder, TelemetrySampler
 from construct import (
     Container, Enum, ExprAdapter, Pass, Struct,
 )
@@ -291,20 +296,20 @@ class Parrot(object):
                 Yaw=int(obj.Yaw * 1000),
             ),
             decoder=lambda obj, ctx: Container(
-                obj.ValidityMask,
-                obj.Timestamp,
-                obj.Latitude / 10.**7.,
-                obj.Longitude / 10.**7.,
-                obj.Altitude / 1000.,
-                obj.Satellites,
-                obj.AccuracyXY / 1000.,
-                obj.AccuracyZ / 1000.,
-                obj.NorthSpeed / 1000.,
-                obj.EastSpeed / 1000.,
-                obj.UpSpeed / 1000.,
-                obj.Roll / 1000.,
-                obj.Pitch / 1000.,
-                obj.Yaw / 1000.,
+                ValidityMask=obj.ValidityMask,
+                Timestamp=obj.Timestamp,
+                Latitude=obj.Latitude / 10.**7.,
+                Longitude=obj.Longitude / 10.**7.,
+                Altitude=obj.Altitude / 1000.,
+                Satellites=obj.Satellites,
+                AccuracyXY=obj.AccuracyXY / 1000.,
+                AccuracyZ=obj.AccuracyZ / 1000.,
+                NorthSpeed=obj.NorthSpeed / 1000.,
+                EastSpeed=obj.EastSpeed / 1000.,
+                UpSpeed=obj.UpSpeed / 1000.,
+                Roll=obj.Roll / 1000.,
+                Pitch=obj.Pitch / 1000.,
+                Yaw=obj.Yaw / 1000.,
             ),
         )
 
@@ -323,6 +328,11 @@ class Parrot(object):
         self._LEDsEnable = self._LEDsEnable()
         self._MagnetoStatus = self._MagnetoStatus()
         self._Geotag = self._Geotag()
+        self._GeotagEncoder = GeotagEncoder(endian)
+        self._Telemetry = {
+            name: TelemetryDecoder(channel, endian)
+            for name, channel in TELEMETRY_CHANNELS.items()
+        }
 
     def get_sunshine_values(self):
         ptp = Container(
@@ -405,14 +415,137 @@ class Parrot(object):
         return self._parse_if_data(response, self._IMU)
 
     def get_status_mask(self, imu_id=0):
+        response = self.__request_status_mask(imu_id)
+        return self._parse_if_data(response, self._Status)
+
+    def __request_status_mask(self, imu_id=0):
         ptp = Container(
             OperationCode='GetStatusMask',
             SessionID=self._session,
             TransactionID=self._transaction,
             Parameter=[imu_id]
         )
+        return self.recv(ptp)
+
+    def get_telemetry(self, channel, imu_id=0):
+        '''Return the values of a telemetry channel as a flat tuple.
+
+        The values are in the order of the columns of
+        `TELEMETRY_CHANNELS[channel]`, without building Containers.
+        '''
+        decoder = self._Telemetry[channel]
+        ptp = Container(
+            OperationCode=decoder.channel.operation,
+            SessionID=self._session,
+            TransactionID=self._transaction,
+            Parameter=[imu_id] if decoder.channel.per_imu else []
+        )
         response = self.recv(ptp)
-        return self._parse_if_data(response, self._Status)
+        return self._parse_if_data(response, decoder)
+
+    def multispectral_capture(self, directory='.', **kwargs):
+        '''
+        Return a `MultispectralCapture` downloading captures to `directory`.
+
+        The RGB image and band TIFFs of each capture are downloaded as soon
+        as they are announced. Keyword arguments are given to
+        `MultispectralCapture`.
+        '''
+        return MultispectralCapture(self, directory=directory, **kwargs)
+
+    def telemetry_sampler(self, rates, **kwargs):
+        '''
+        Return a `TelemetrySampler` polling channels at `rates` in Hz.
+
+        Keyword arguments are given to `TelemetrySampler`.
+        '''
+        return TelemetrySampler(self, rates, **kwargs)
+
+    def apply_sensor_configuration(self, mask, keep_on=None, timeout=10):
+        '''
+        Enable the sensors in `mask` and keep them on if `keep_on` is given.
+
+        While the camera is busy, wait for its next Status event or a short
+        and growing delay, whichever comes first, instead of whole seconds.
+        With `keep_on`, wait until the status mask shows the sensors running.
+        Raise PTPError if the camera is not ready within `timeout` seconds.
+
+        Return a Container with the `ResponseCode`, the `Status` mask, the
+        `Errors` flagged by the cameras and the `Elapsed` time. An invalid
+        `mask` is reported as InvalidDevicePropValue.
+        '''
+        start = monotonic()
+        deadline = start + timeout
+        response = self.__set_sensor_property(
+            'PhotoSensorEnableMask', mask, deadline
+        )
+        if response.ResponseCode == 'OK' and keep_on is not None:
+            response = self.__set_sensor_property(
+                'PhotoSensorsKeepOn', int(bool(keep_on)), deadline
+            )
+        status = None
+        if response.ResponseCode == 'OK':
+            status = self.__wait_for_sensors(bool(keep_on), deadline)
+        return Container(
+            ResponseCode=response.ResponseCode,
+            Status=status,
+            Errors=sorted(
+                name for name, flag in (status or {}).items()
+                if flag and name.startswith('Cam') and name.endswith('Error')
+            ),
+            Elapsed=monotonic() - start,
+        )
+
+    def __set_sensor_property(self, name, value, deadline):
+        '''Set a sensor property, retrying while the camera is busy.'''
+        delay = 0.01
+        while True:
+            ptp = Container(
+                OperationCode='SetDevicePropValue',
+                SessionID=self._session,
+                TransactionID=self._transaction,
+                Parameter=[self._code(name, self._PropertyCode)],
+            )
+            response = self.send(ptp, self._UInt32.build(value))
+            if response.ResponseCode != 'DeviceBusy':
+                return response
+            delay = self.__wait_for_status(deadline, delay)
+            if delay is None:
+                raise PTPError(
+                    'Camera still busy setting {} to {}'.format(name, value)
+                )
+
+    def __wait_for_sensors(self, running, deadline):
+        '''Return the status mask once sensors are running, if required.'''
+        delay = 0.01
+        while True:
+            response = self.__request_status_mask()
+            code = response.ResponseCode
+            status = None
+            if code == 'OK':
+                status = self._parse_if_data(response, self._Status)
+                if status is None or not running or status.CameraRunning:
+                    return status
+            elif code != 'DeviceBusy':
+                raise PTPError(
+                    'Could not get the status mask: {}'.format(code)
+                )
+            delay = self.__wait_for_status(deadline, delay)
+            if delay is None:
+                raise PTPError(
+                    'Sensors not running: {}'.format(status or code)
+                )
+
+    def __wait_for_status(self, deadline, delay):
+        '''Wait for a Status event for at most `delay` seconds.
+
+        Return the next delay, or None once past the `deadline`.
+        '''
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return None
+        self.wait_for_event('Status', timeout=min(delay, remaining))
+        return min(2 * delay, 0.5)
 
     def eject_storage(self, storage_id):
         ptp = Container(
@@ -451,18 +584,23 @@ class Parrot(object):
         response = self.recv(ptp)
         return self._parse_if_data(response, self._MagnetoStatus)
 
-    def send_firmware(self, firmware):
-        '''Send PLF for update'''
+    def send_firmware(self, firmware, progress=None):
+        '''Send PLF for update
+
+        The PLF can be bytes, a file, an mmap or a `Payload`, and is streamed
+        in chunks. `progress(sent, size)` is called as they are sent.
+        '''
+        firmware = as_payload(firmware, progress=progress)
         ptp = Container(
             OperationCode='SendFirmwareUpdate',
             SessionID=self._session,
             TransactionID=self._transaction,
-            Parameter=[len(firmware)]
+            Parameter=[firmware.size]
         )
         return self.send(ptp, firmware)
 
     def set_geotag(self, geotag):
-        geotag = self._build_if_not_data(geotag, self._Geotag)
+        geotag = self._build_if_not_data(geotag, self._GeotagEncoder)
         ptp = Container(
             OperationCode='SetGeotag',
             SessionID=self._session,
@@ -470,3 +608,11 @@ class Parrot(object):
             Parameter=[]
         )
         return self.send(ptp, geotag)
+
+    def geotag_feeder(self, **kwargs):
+        '''
+        Return a `GeotagFeeder` sending the latest pushed geotag.
+
+        Keyword arguments are given to `GeotagFeeder`.
+        '''
+        return GeotagFeeder(self, **kwargs)
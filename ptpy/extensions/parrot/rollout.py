@@ -0,0 +1,161 @@
+'''This module updates the firmware of many Parrot cameras at once.
+
+The PLF is mapped in memory once and every camera streams it from the same
+pages. Updates run concurrently, at most `parallel` at a time, and can share a
+bandwidth budget so that cameras on the same bus do not starve each other.
+'''
+from ...ptp import PTPError
+from ...util import Payload, monotonic
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+import logging
+import mmap
+import six
+import time
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('BandwidthLimiter', 'FirmwareUpdate', 'rollout_firmware')
+
+FirmwareUpdate = namedtuple(
+    'FirmwareUpdate',
+    ('device', 'response_code', 'size', 'elapsed', 'throughput', 'verified',
+     'error'),
+)
+FirmwareUpdate.__doc__ = '''Outcome of a firmware update on one camera.
+
+`throughput` is in bytes per second. `verified` is None unless a
+verification was requested. `error` is None on success, or the exception the
+update failed with, a `PTPError` if the camera refused the firmware.
+'''
+
+
+class BandwidthLimiter(object):
+    '''Share `rate` bytes per second between concurrent transfers.
+
+    Transfers call `consume` between chunks, after sending data, and wait
+    until the budget allows it. Up to `burst` bytes, one second worth by
+    default, can be sent without waiting.
+    '''
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('The bandwidth must be positive.')
+        self.rate = float(rate)
+        self.burst = float(rate if burst is None else burst)
+        self.__granted_until = 0.
+        self.__lock = Lock()
+
+    def consume(self, count):
+        with self.__lock:
+            now = monotonic()
+            # Transfers queue up behind the bytes granted before them.
+            self.__granted_until = max(
+                self.__granted_until, now - self.burst / self.rate
+            ) + count / self.rate
+            delay = self.__granted_until - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+@contextmanager
+def _mapped(firmware):
+    '''Map a PLF path or file in memory, or use a buffer as it is.'''
+    if isinstance(firmware, six.string_types):
+        with open(firmware, 'rb') as f:
+            with _mapped(f) as view:
+                yield view
+        return
+    if not hasattr(firmware, 'fileno'):
+        yield firmware
+        return
+    mapped = mmap.mmap(firmware.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        yield mapped
+    finally:
+        mapped.close()
+
+
+def rollout_firmware(
+        cameras,
+        firmware,
+        parallel=4,
+        bandwidth=None,
+        verify=None,
+        progress=None,
+):
+    '''Send `firmware` to many cameras concurrently.
+
+    `cameras` maps devices to opened Parrot cameras, like the cameras from
+    `open_cameras`, or is a list of them. The `firmware` is a PLF path, file
+    or buffer. At most `parallel` cameras are updated at once, and together
+    they send at most `bandwidth` bytes per second, if given. After a
+    successful update, `verify(camera)` can check the result.
+    `progress(device, sent, size)` is called as chunks are sent.
+
+    Return a `FirmwareUpdate` by device:
+
+        cameras, failures, _, _ = open_cameras()
+        updates = rollout_firmware(cameras, 'sequoia_update.plf', parallel=8)
+        for device, update in updates.items():
+            print(device, update.response_code, update.throughput)
+    '''
+    if not hasattr(cameras, 'items'):
+        cameras = dict(enumerate(cameras))
+    limiter = None if bandwidth is None else BandwidthLimiter(bandwidth)
+    with _mapped(firmware) as plf:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = {
+                device: pool.submit(
+                    _update, device, camera, plf, limiter, verify, progress
+                )
+                for device, camera in cameras.items()
+            }
+        return {device: future.result() for device, future in futures.items()}
+
+
+def _update(device, camera, plf, limiter, verify, progress):
+    reported = [0]
+
+    def sent(count, size):
+        if limiter is not None:
+            limiter.consume(count - reported[0])
+        reported[0] = count
+        if progress is not None:
+            progress(device, count, size)
+
+    payload = Payload(plf, progress=sent)
+    start = monotonic()
+    response_code = None
+    verified = None
+    error = None
+    try:
+        with camera.session():
+            response_code = camera.send_firmware(payload).ResponseCode
+        if response_code != 'OK':
+            error = PTPError('Firmware refused: {}'.format(response_code))
+        elif verify is not None:
+            verified = bool(verify(camera))
+    except Exception as e:
+        logger.error('Could not update {}: {}'.format(device, e))
+        # The frames of the traceback hold chunks of the mapped firmware,
+        # which could not be unmapped while the error is kept.
+        e.__traceback__ = None
+        error = e
+    elapsed = monotonic() - start
+    update = FirmwareUpdate(
+        device=device,
+        response_code=response_code,
+        size=reported[0],
+        elapsed=elapsed,
+        throughput=reported[0] / elapsed if elapsed > 0 else 0.,
+        verified=verified,
+        error=error,
+    )
+    logger.info(
+        '{}: {} bytes at {:.0f} B/s, {}'
+        .format(device, update.size, update.throughput, response_code)
+    )
+    return update
@@ -0,0 +1,263 @@
+'''This module samples the sensors of Sequoia cameras into ring buffers.
+
+Each sensor is polled at its own rate by the reactor of the camera, between
+the other transactions. Values are decoded straight from the dataphase into
+preallocated columns, one `array` per value, so that long and dense traces do
+not allocate a Container per sample.
+'''
+from ...ptp import PTPError
+from ...util import BYTE_ORDER, monotonic
+from array import array
+from collections import namedtuple
+from threading import Lock
+import logging
+import struct
+
+logger = logging.getLogger(__name__)
+
+__all__ = (
+    'TELEMETRY_CHANNELS', 'TelemetryChannel', 'TelemetryDecoder',
+    'TelemetryRing', 'TelemetrySampler',
+)
+
+TelemetryChannel = namedtuple(
+    'TelemetryChannel',
+    ('operation', 'per_imu', 'typecode', 'columns', 'is_array'),
+)
+TelemetryChannel.__doc__ = '''Sensor read by a single Parrot operation.
+
+The values are `columns` of `array` type `typecode`. They are sent as a PTP
+array unless `is_array` is False. Operations that are `per_imu` take the IMU
+as parameter.
+'''
+
+TELEMETRY_CHANNELS = {
+    'sunshine': TelemetryChannel(
+        'GetSunshineValues', False, 'I',
+        ('Green0', 'Red0', 'RedEdge0', 'NIR0',
+         'Green1', 'Red1', 'RedEdge1', 'NIR1'),
+        True,
+    ),
+    'temperature': TelemetryChannel(
+        'GetTemperatureValues', False, 'i',
+        ('P7', 'P7MU', 'DDR', 'WiFi', 'IMU', 'IMUSunshine'),
+        True,
+    ),
+    'angle': TelemetryChannel(
+        'GetAngleValues', True, 'I',
+        ('Yaw', 'Pitch', 'Roll'),
+        True,
+    ),
+    'gps': TelemetryChannel(
+        'GetGpsValues', False, 'I',
+        ('LongitudeDeg', 'LongitudeMin', 'LongitudeSec',
+         'LatitudeDeg', 'LatitudeMin', 'LatitudeSec', 'Altitude'),
+        True,
+    ),
+    'imu': TelemetryChannel(
+        'GetImuValues', True, 'I',
+        ('GyroscopeX', 'GyroscopeY', 'GyroscopeZ',
+         'AccelerometerX', 'AccelerometerY', 'AccelerometerZ',
+         'MagnetometerX', 'MagnetometerY', 'MagnetometerZ',
+         'Yaw', 'Pitch', 'Roll'),
+        True,
+    ),
+    'status': TelemetryChannel(
+        'GetStatusMask', True, 'I',
+        ('StatusMask',),
+        False,
+    ),
+}
+
+
+class TelemetryDecoder(object):
+    '''Decode the dataphase of a telemetry channel into a tuple of values.'''
+
+    def __init__(self, channel, endian):
+        self.channel = channel
+        count = len(channel.columns)
+        fmt = channel.typecode * count
+        if channel.is_array:
+            # PTP arrays start with the number of elements.
+            fmt = 'I' + fmt
+        self.__struct = struct.Struct(BYTE_ORDER[endian] + fmt)
+
+    def parse(self, data):
+        if len(data) < self.__struct.size:
+            raise PTPError(
+                'Short {} dataphase: {} bytes'
+                .format(self.channel.operation, len(data))
+            )
+        values = self.__struct.unpack_from(data)
+        if self.channel.is_array:
+            if values[0] != len(self.channel.columns):
+                raise PTPError(
+                    'Unexpected {} values from {}'
+                    .format(values[0], self.channel.operation)
+                )
+            values = values[1:]
+        return values
+
+
+class TelemetryRing(object):
+    '''Ring buffer of timestamped samples, stored by column.
+
+    Columns are `array` objects allocated once for `capacity` samples. When
+    the ring is full, the oldest samples are overwritten and counted in
+    `overwritten`.
+    '''
+
+    def __init__(self, columns, typecode, capacity):
+        if capacity <= 0:
+            raise ValueError('The capacity must be positive.')
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.overwritten = 0
+        self.__timestamps = array('d', [0.]) * capacity
+        self.__values = [array(typecode, [0]) * capacity for _ in columns]
+        self.__next = 0
+        self.__count = 0
+        self.__lock = Lock()
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, timestamp, values):
+        with self.__lock:
+            index = self.__next
+            self.__timestamps[index] = timestamp
+            for column, value in zip(self.__values, values):
+                column[index] = value
+            self.__next = (index + 1) % self.capacity
+            if self.__count == self.capacity:
+                self.overwritten += 1
+            else:
+                self.__count += 1
+
+    def batch(self, clear=False):
+        '''Return the samples by column, oldest first.
+
+        The result maps 'Timestamp' and each column name to a new `array`,
+        which `numpy.frombuffer` can wrap without a copy. If `clear`, the
+        ring is emptied.
+        '''
+        with self.__lock:
+            start = (self.__next - self.__count) % self.capacity
+            end = start + self.__count
+            columns = [('Timestamp', self.__timestamps)]
+            columns.extend(zip(self.columns, self.__values))
+            batch = {}
+            for name, column in columns:
+                if end <= self.capacity:
+                    batch[name] = column[start:end]
+                else:
+                    batch[name] = (
+                        column[start:] + column[:end - self.capacity]
+                    )
+            if clear:
+                self.__count = 0
+            return batch
+
+
+class TelemetrySampler(object):
+    '''Sample Sequoia sensors at fixed rates into `TelemetryRing`s.
+
+    `rates` maps channels of `TELEMETRY_CHANNELS` to their rate in Hz. Each
+    channel is polled on the reactor of the camera, in the lane of that
+    camera. Polls are due at fixed multiples of their period from `start`, so
+    delays do not accumulate. A poll that comes too late skips the periods it
+    missed, which are counted in `missed`. Samples are timestamped with the
+    monotonic clock in the middle of their transaction. A session must be
+    open:
+
+        with camera.session(), camera.telemetry_sampler(
+                {'sunshine': 10, 'imu': 50}
+        ) as sampler:
+            time.sleep(60)
+            traces = sampler.batch()
+    '''
+
+    def __init__(self, camera, rates, capacity=4096, imu_id=0):
+        for name, rate in rates.items():
+            if name not in TELEMETRY_CHANNELS:
+                raise ValueError('Unknown telemetry channel {}'.format(name))
+            if rate <= 0:
+                raise ValueError(
+                    'The rate of {} must be positive.'.format(name)
+                )
+        self.rates = dict(rates)
+        self.imu_id = imu_id
+        self.missed = {name: 0 for name in rates}
+        self.errors = {name: 0 for name in rates}
+        self.rings = {
+            name: TelemetryRing(
+                TELEMETRY_CHANNELS[name].columns,
+                TELEMETRY_CHANNELS[name].typecode,
+                capacity,
+            )
+            for name in rates
+        }
+        self.__camera = camera
+        self.__tasks = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if self.__tasks:
+            return
+        start = monotonic()
+        for name, rate in self.rates.items():
+            self.__tasks.append(
+                self.__camera._reactor.call_later(
+                    0,
+                    self.__poller(name, 1. / rate, start),
+                    blocking=True,
+                    name='Telemetry {}'.format(name),
+                    # A stuck camera only holds back its own polls.
+                    group=self.__camera,
+                )
+            )
+
+    def stop(self, timeout=1):
+        '''Stop sampling, waiting at most `timeout` for running polls.'''
+        tasks, self.__tasks = self.__tasks, []
+        for task in tasks:
+            task.cancel(timeout)
+
+    def batch(self, clear=False):
+        '''Return the samples of every channel, see `TelemetryRing.batch`.'''
+        return {
+            name: ring.batch(clear=clear) for name, ring in self.rings.items()
+        }
+
+    def __poller(self, name, period, start):
+        camera = self.__camera
+        ring = self.rings[name]
+        imu_id = self.imu_id
+        due = [start]
+
+        def poll():
+            before = monotonic()
+            try:
+                values = camera.get_telemetry(name, imu_id)
+            except Exception as e:
+                logger.debug('Could not sample {}: {}'.format(name, e))
+                values = None
+                self.errors[name] += 1
+            after = monotonic()
+            if values is not None:
+                ring.append((before + after) / 2., values)
+            # Stay on the grid of due times, skipping the missed ones.
+            due[0] += period
+            if due[0] < after:
+                missed = int((after - due[0]) / period) + 1
+                self.missed[name] += missed
+                due[0] += missed * period
+            return due[0] - after
+
+        return poll
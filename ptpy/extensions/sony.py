@@ -5,24 +5,42 @@ extension. This is why inheritance is not explicit.
 '''
 from contextlib import contextmanager
 from construct import Container, Struct, Range, Computed, Enum, Array, PrefixedArray, Pass, ExprAdapter
+from ..liveview import FrameSink, LiveView
 from ..ptp import PTPError
+from ..util import BYTE_ORDER, monotonic
+from threading import Lock
 import logging
+import struct
 logger = logging.getLogger(__name__)
 
 __all__ = ('Sony',)
 
+# Live view images are fetched with GetObject on this special handle.
+LIVE_VIEW_HANDLE = 0xFFFFC002
+
 
 class SonyError(PTPError):
     pass
 
 
 class Sony(object):
-    '''This class implements Sony's PTP operations.'''
+    '''This class implements Sony's PTP operations.
+
+    Every property is described by a single GetAllDevicePropData transaction.
+    When the camera reports property changes, the snapshot is refreshed and
+    diffed against the previous one, and each changed property is announced
+    with a DevicePropChanged event.
+    '''
     def __init__(self, *args, **kwargs):
         logger.debug('Init Sony')
         super(Sony, self).__init__(*args, **kwargs)
         # TODO: expose the choice to disable automatic Sony extension
         self.__raw = False
+        self.__sessions = 0
+        self.__snapshot = None
+        self.__refresh_pending = False
+        self.__refresh_lock = Lock()
+        self.subscribe(self.__properties_changed, code='SonyPropertyChanged')
 
     @contextmanager
     def session(self):
@@ -47,7 +65,11 @@ class Sony(object):
                 raise SonyError('Could not authenticate')
             else:
                 logger.debug('Authentication done')
-            yield
+            self.__sessions += 1
+            try:
+                yield
+            finally:
+                self.__sessions -= 1
 
     def _shutdown(self):
         logger.debug('Shutdown Sony')
@@ -271,6 +293,7 @@ class Sony(object):
         self._SonyPropDesc = self._SonyPropDesc()
         self._SonyDeviceInfo = self._SonyDeviceInfo()
         self._SonyAllPropDesc = self._SonyAllPropDesc()
+        self._SonyLiveViewHeader = struct.Struct(BYTE_ORDER[endian] + 'II')
 
     def event(self, wait=False):
         '''Check Sony or PTP events
@@ -310,6 +333,112 @@ class Sony(object):
         response = self.recv(ptp)
         return self._parse_if_data(response, self._SonyAllPropDesc)
 
+    def refresh_properties(self):
+        '''Refresh the knowledge of every property in one transaction.
+
+        Properties whose description changed since the previous snapshot are
+        announced with a DevicePropChanged event from the 'Sony' source.
+        Return the codes of the changed properties.
+        '''
+        snapshot = self.__take_snapshot()
+        previous = self.__snapshot
+        self.__snapshot = snapshot
+        self._learn_properties(snapshot)
+        if previous is None:
+            return []
+        changed = [
+            code for code, desc in snapshot.items()
+            if previous.get(code) != desc
+        ]
+        received_at = monotonic()
+        for code in changed:
+            self._event_received(
+                Container(
+                    EventCode='DevicePropChanged',
+                    Parameter=[self._code(code, self._PropertyCode)],
+                    PropertyCode=code,
+                    Value=snapshot[code].CurrentValue,
+                ),
+                'Sony',
+                received_at,
+            )
+        return changed
+
+    def _describe_properties(self, props):
+        '''Describe all properties from a single bulk snapshot.'''
+        snapshot = self.__take_snapshot()
+        self.__snapshot = snapshot
+        missing = [p for p in props if p not in snapshot]
+        if missing:
+            logger.debug('Not in the snapshot: {}'.format(missing))
+        return dict(snapshot)
+
+    def __take_snapshot(self):
+        descs = self.get_all_device_prop_data()
+        if not isinstance(descs, list):
+            raise SonyError(
+                'Could not get all properties: {}'.format(descs.ResponseCode)
+            )
+        return {desc.PropertyCode: desc for desc in descs}
+
+    def __properties_changed(self, event):
+        '''Refresh the snapshot once per burst of change notifications.'''
+        if not self.__sessions or self.__snapshot is None:
+            return
+        with self.__refresh_lock:
+            if self.__refresh_pending:
+                return
+            self.__refresh_pending = True
+        # Event callbacks must not run transactions themselves.
+        self._reactor.call_later(
+            0, self.__refresh, blocking=True, name='SonyRefresh', group=self
+        )
+
+    def __refresh(self):
+        with self.__refresh_lock:
+            self.__refresh_pending = False
+        if self.__sessions:
+            self.refresh_properties()
+
+    def live_view_jpeg(self, data):
+        '''Return the JPEG in a live view dataset, without copying it.
+
+        The dataset starts with the offset and the size of the image. Return
+        None if there is no image.
+        '''
+        header = self._SonyLiveViewHeader
+        if len(data) < header.size:
+            return None
+        offset, size = header.unpack_from(data, 0)
+        if size == 0 or offset < header.size or offset + size > len(data):
+            return None
+        return memoryview(data)[offset:offset + size]
+
+    def live_view(self, **kwargs):
+        '''
+        Return a `LiveView` streaming live view images from Sony cameras.
+
+        Live view needs an open session. Frames are fetched as fast as the
+        camera produces them, streamed into reused buffers, and only the
+        latest one is kept. Keyword arguments are given to `LiveView`:
+
+            with camera.session(), camera.live_view() as live_view:
+                for frame in live_view.frames(timeout=2):
+                    show(frame.data)
+                print(live_view.stats.fps)
+        '''
+        kwargs.setdefault('name', 'SonyLiveView')
+        sink = FrameSink()
+        return LiveView(lambda: self.__live_view_frame(sink), **kwargs)
+
+    def __live_view_frame(self, sink):
+        sink.rewind()
+        response = self.get_object(LIVE_VIEW_HANDLE, sink=sink)
+        if response.ResponseCode != 'OK' or not response.get('DataLength'):
+            # The camera has no new frame yet.
+            return None
+        return self.live_view_jpeg(sink.getbuffer())
+
     def set_control_device_A(self, device_property, value_payload):
         code = self._code(device_property, self._PropertyCode)
         ptp = Container(
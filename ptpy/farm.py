@@ -0,0 +1,479 @@
+'''This module manages many cameras connected to the same host.
+
+It exports the `open_cameras` function, which brings up a set of devices
+concurrently, and the CameraFarm class. A farm discovers USB PTP cameras, opens
+them in parallel and drives each one from its own worker thread. Commands are
+queued to a worker and their results are surfaced as futures. Cameras that are
+unplugged are detached from their worker and re-attached to it when they come
+back.
+'''
+from __future__ import absolute_import
+from . import PTPy
+from .ptp import PTPError
+from .transports.usb import find_usb_cameras
+from .util import monotonic
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from six.moves.queue import Queue, Empty
+from threading import Thread, Event, Lock, RLock
+import atexit
+import logging
+import usb.core
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('BringUp', 'BringUpFailure', 'CameraFarm', 'open_cameras')
+__author__ = 'Luis Mario Domenzain'
+
+
+def _usb_location(device):
+    '''Identify a USB device by where it is plugged in.'''
+    return (device.bus, device.address)
+
+
+def _unplugged(exception):
+    '''Whether an exception means the device is gone.'''
+    return (
+        isinstance(exception, usb.core.USBError) and
+        exception.errno == 19
+    )
+
+
+BringUp = namedtuple('BringUp', ('cameras', 'failures', 'timings', 'elapsed'))
+BringUp.__doc__ = '''Cameras opened by device, failures and time spent.'''
+
+BringUpFailure = namedtuple('BringUpFailure', ('device', 'error', 'elapsed'))
+BringUpFailure.__doc__ = '''Device that could not be opened and why.'''
+
+
+def _release(future):
+    '''Shut down a camera that was opened too late to be used.'''
+    if not future.cancelled() and future.exception() is None:
+        future.result()._shutdown()
+
+
+def open_cameras(
+        devices=None,
+        max_workers=8,
+        timeout=30.,
+        name=None,
+        **camera_kwargs
+):
+    '''Open several cameras concurrently.
+
+    Each of `devices` is given to `PTPy` by one of at most `max_workers`
+    threads. If `devices` is `None` all USB cameras (matching `name` if given)
+    are used. A device that takes longer than `timeout` seconds to open is
+    reported as failed. Its thread is abandoned: it is a daemon thread, so it
+    does not keep the interpreter alive, and the camera is shut down if it
+    eventually opens. Another thread takes over the remaining devices.
+
+    Return a `BringUp` with the opened cameras by device, the failures and the
+    time each camera took to open. The whole bring-up takes about as long as
+    the slowest camera, as long as there are enough workers:
+
+        cameras, failures, timings, elapsed = open_cameras()
+    '''
+    beginning = monotonic()
+    devices = list(
+        find_usb_cameras(name=name) if devices is None else devices
+    )
+    cameras = {}
+    failures = []
+    timings = {}
+    if not devices:
+        return BringUp(cameras, failures, timings, 0.)
+
+    started = {}
+    lock = Lock()
+    queue = Queue()
+    futures = {}
+    for device in devices:
+        futures[device] = Future()
+        queue.put(device)
+
+    def bring_up():
+        while True:
+            try:
+                device = queue.get(block=False)
+            except Empty:
+                return
+            future = futures[device]
+            with lock:
+                started[device] = monotonic()
+            try:
+                camera = PTPy(device=device, **camera_kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(camera)
+
+    def spawn():
+        thread = Thread(name='OpenCameras', target=bring_up)
+        # Devices that never answer must not keep the interpreter alive.
+        thread.daemon = True
+        thread.start()
+
+    for _ in range(min(max_workers, len(devices))):
+        spawn()
+    pending = {future: device for device, future in futures.items()}
+    while pending:
+        done, _ = wait(
+            list(pending),
+            timeout=0.1,
+            return_when=FIRST_COMPLETED,
+        )
+        now = monotonic()
+        for future in done:
+            device = pending.pop(future)
+            with lock:
+                elapsed = now - started[device]
+            try:
+                cameras[device] = future.result()
+                timings[device] = elapsed
+            except Exception as e:
+                logger.error('Could not open {}: {}'.format(device, e))
+                failures.append(BringUpFailure(device, e, elapsed))
+        for future, device in list(pending.items()):
+            with lock:
+                start = started.get(device)
+            if future.done() or start is None or now - start < timeout:
+                continue
+            logger.error('Timed out opening {}'.format(device))
+            del pending[future]
+            future.add_done_callback(_release)
+            failures.append(BringUpFailure(
+                device,
+                PTPError('Timed out after {}s'.format(timeout)),
+                now - start,
+            ))
+            if not queue.empty():
+                # Replace the thread stuck with this device.
+                spawn()
+
+    return BringUp(cameras, failures, timings, monotonic() - beginning)
+
+
+class _CameraWorker(object):
+    '''Run commands for a single camera in a dedicated thread.
+
+    When the session or a command fails for another reason than an unplug,
+    the worker waits `retry_delay` seconds before trying again, doubling the
+    delay up to `max_retry_delay` while the failures go on.
+    '''
+
+    def __init__(
+            self, key, session=True, retry_delay=0.5, max_retry_delay=30.
+    ):
+        self.key = key
+        self.location = None
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.__session = session
+        self.__camera = None
+        self.__commands = Queue()
+        self.__attached = Event()
+        self.__shutdown = Event()
+        self.__lock = RLock()
+        self.__thread = Thread(
+            name='Farm-{}'.format(key),
+            target=self.__run,
+        )
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    @property
+    def camera(self):
+        return self.__camera if self.__attached.is_set() else None
+
+    @property
+    def attached(self):
+        return self.__attached.is_set()
+
+    def attach(self, camera, location):
+        '''Serve queued and future commands with `camera`.'''
+        with self.__lock:
+            logger.info('Attach {} at {}'.format(self.key, location))
+            self.__camera = camera
+            self.location = location
+            self.__attached.set()
+
+    def detach(self):
+        '''Stop serving commands until a camera is attached again.'''
+        with self.__lock:
+            if not self.__attached.is_set():
+                return
+            logger.warning('Detach {} from {}'.format(self.key, self.location))
+            self.__attached.clear()
+            camera = self.__camera
+            self.__camera = None
+            self.location = None
+        try:
+            camera._shutdown()
+        except Exception as e:
+            logger.debug('Ignoring shutdown error {}'.format(e))
+
+    def submit(self, fn, *args, **kwargs):
+        '''Queue `fn(camera, *args, **kwargs)` and return its future.'''
+        future = Future()
+        self.__commands.put((future, fn, args, kwargs))
+        return future
+
+    def stop(self, timeout=2):
+        self.__shutdown.set()
+        self.__commands.put(None)
+        if self.__thread.is_alive():
+            self.__thread.join(timeout)
+        self.detach()
+        # Fail whatever was never run.
+        while True:
+            try:
+                item = self.__commands.get(block=False)
+            except Empty:
+                break
+            if item is not None and item[0].set_running_or_notify_cancel():
+                item[0].set_exception(
+                    RuntimeError('Camera farm was stopped')
+                )
+
+    def __run(self):
+        delay = self.retry_delay
+        while not self.__shutdown.is_set():
+            if not self.__attached.wait(0.5):
+                continue
+            camera = self.__camera
+            if camera is None:
+                continue
+            try:
+                if self.__session:
+                    with camera.session():
+                        self.__serve(camera)
+                else:
+                    self.__serve(camera)
+            except Exception as e:
+                if _unplugged(e) or camera._disconnected:
+                    self.detach()
+                    continue
+                logger.error(
+                    '{}: {}, retrying in {:.1f}s'.format(self.key, e, delay)
+                )
+                # Do not hammer a camera that keeps failing.
+                self.__shutdown.wait(delay)
+                delay = min(2 * delay, self.max_retry_delay)
+                continue
+            delay = self.retry_delay
+
+    def __serve(self, camera):
+        '''Run commands while the same camera stays attached.'''
+        while (
+                not self.__shutdown.is_set() and
+                self.__attached.is_set() and
+                self.__camera is camera
+        ):
+            if camera._disconnected:
+                self.detach()
+                return
+            try:
+                item = self.__commands.get(timeout=0.5)
+            except Empty:
+                continue
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(camera, *args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+                if _unplugged(e) or camera._disconnected:
+                    self.detach()
+                    return
+
+
+class CameraFarm(object):
+    '''Discover, open and drive every USB PTP camera on the host.
+
+    Each camera is identified by its serial number and served by one worker
+    thread. Commands are callables that take the camera as first argument:
+
+        from ptpy.farm import CameraFarm
+        with CameraFarm() as farm:
+            futures = farm.map(lambda camera: camera.initiate_capture())
+            for serial, future in futures.items():
+                print(serial, future.result().ResponseCode)
+
+    When `session` is set, workers keep a session open on their camera. Unless
+    `scan_interval` is `None`, the USB bus is rescanned periodically so that
+    unplugged cameras are detached and cameras plugged (back) in are attached.
+    Commands for a detached camera wait until it is attached again. Devices
+    that fail to open are retried after a delay that doubles with each
+    failure, up to `max_retry_interval` seconds, since opening them may reset
+    them.
+    '''
+
+    def __init__(
+            self,
+            name=None,
+            session=True,
+            max_open_workers=8,
+            open_timeout=30.,
+            scan_interval=2.,
+            max_retry_interval=60.,
+            **camera_kwargs
+    ):
+        self.__name = name
+        self.__session = session
+        self.__max_open_workers = max_open_workers
+        self.__open_timeout = open_timeout
+        self.__scan_interval = scan_interval
+        self.__max_retry_interval = max_retry_interval
+        self.__camera_kwargs = camera_kwargs
+        self.__workers = {}
+        # Failure count and next attempt of devices that did not open.
+        self.__failures = {}
+        self.__lock = RLock()
+        self.__shutdown = Event()
+        self.__monitor = None
+        self.__exit_handler = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        '''Open all available cameras and watch the bus for changes.'''
+        self.__shutdown.clear()
+        self.scan()
+        if self.__scan_interval is not None and self.__monitor is None:
+            self.__monitor = Thread(
+                name='FarmMonitor',
+                target=self.__monitor_bus,
+            )
+            self.__monitor.daemon = True
+            if not self.__exit_handler:
+                atexit.register(self.stop)
+                self.__exit_handler = True
+            self.__monitor.start()
+
+    def stop(self):
+        '''Stop every worker and release all cameras.'''
+        self.__shutdown.set()
+        if self.__monitor is not None and self.__monitor.is_alive():
+            self.__monitor.join(2 * self.__scan_interval)
+        self.__monitor = None
+        with self.__lock:
+            workers = list(self.__workers.values())
+            # Workers are started anew with the farm.
+            self.__workers = {}
+        for worker in workers:
+            worker.stop()
+
+    @property
+    def cameras(self):
+        '''Attached cameras by serial number.'''
+        with self.__lock:
+            return {
+                key: worker.camera
+                for key, worker in self.__workers.items()
+                if worker.attached
+            }
+
+    def submit(self, key, fn, *args, **kwargs):
+        '''Run `fn(camera, *args, **kwargs)` on camera `key`. Return a future.'''
+        with self.__lock:
+            try:
+                worker = self.__workers[key]
+            except KeyError:
+                raise KeyError('No camera {} in farm'.format(key))
+        return worker.submit(fn, *args, **kwargs)
+
+    def map(self, fn, *args, **kwargs):
+        '''Run `fn` on all attached cameras. Return futures by serial number.'''
+        with self.__lock:
+            workers = [w for w in self.__workers.values() if w.attached]
+        return {w.key: w.submit(fn, *args, **kwargs) for w in workers}
+
+    def scan(self):
+        '''Detach missing cameras and attach new ones. Return new serials.'''
+        present = {
+            _usb_location(device): device
+            for device in find_usb_cameras(name=self.__name)
+        }
+        with self.__lock:
+            held = {
+                w.location: w for w in self.__workers.values() if w.attached
+            }
+        for location, worker in held.items():
+            camera = worker.camera
+            if location not in present or camera is None or (
+                    camera._disconnected
+            ):
+                worker.detach()
+        now = monotonic()
+        with self.__lock:
+            # Forget failures of devices that were unplugged.
+            for location in list(self.__failures):
+                if location not in present:
+                    del self.__failures[location]
+            new = [
+                dev for loc, dev in present.items()
+                if loc not in held and
+                self.__failures.get(loc, (0, now))[1] <= now
+            ]
+        return self.__attach_all(new) if new else []
+
+    def __failed(self, location):
+        '''Remember a device that did not open and back off from it.'''
+        with self.__lock:
+            count = self.__failures.get(location, (0, 0))[0] + 1
+            delay = min(
+                (self.__scan_interval or 2.) * 2 ** (count - 1),
+                self.__max_retry_interval,
+            )
+            self.__failures[location] = (count, monotonic() + delay)
+        logger.warning(
+            'Retrying {}:{} in {:.0f}s'.format(location[0], location[1], delay)
+        )
+
+    def __attach_all(self, devices):
+        attached = []
+        bring_up = open_cameras(
+            devices,
+            max_workers=self.__max_open_workers,
+            timeout=self.__open_timeout,
+            **self.__camera_kwargs
+        )
+        for failure in bring_up.failures:
+            self.__failed(_usb_location(failure.device))
+        for device, camera in bring_up.cameras.items():
+            location = _usb_location(device)
+            try:
+                info = camera.get_device_info()
+            except Exception as e:
+                logger.error('Could not identify camera at {}: {}'.format(
+                    location, e
+                ))
+                camera._shutdown()
+                self.__failed(location)
+                continue
+            key = info.SerialNumber or '{}:{}'.format(*location)
+            with self.__lock:
+                self.__failures.pop(location, None)
+                worker = self.__workers.get(key)
+                if worker is None:
+                    worker = _CameraWorker(key, session=self.__session)
+                    self.__workers[key] = worker
+            worker.attach(camera, location)
+            attached.append(key)
+        return attached
+
+    def __monitor_bus(self):
+        while not self.__shutdown.wait(self.__scan_interval):
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error('Bus scan failed: {}'.format(e))
@@ -0,0 +1,237 @@
+'''This module triggers captures at a fixed cadence on one or many cameras.
+
+Captures are due at fixed multiples of the interval from the start, measured
+with a monotonic clock, so the time a capture takes does not push the next one
+back. When a capture overruns its slot, the missed slots are either skipped or
+caught up with right away. Each camera is triggered from its own thread, on the
+same grid of due times, and the delay between each due time and the actual
+trigger is recorded as jitter.
+
+Without an interval, cameras are triggered as soon as their previous capture
+is complete, which measures the rate they can sustain.
+'''
+from __future__ import absolute_import
+from .util import monotonic
+from array import array
+from collections import namedtuple
+from threading import Event, Lock, Thread
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('IntervalCapture', 'IntervalStats', 'OVERRUN_POLICIES')
+__author__ = 'Luis Mario Domenzain'
+
+OVERRUN_POLICIES = ('skip', 'catch_up')
+
+IntervalStats = namedtuple(
+    'IntervalStats',
+    ('captures', 'failed', 'skipped', 'rate', 'mean_jitter', 'max_jitter'),
+)
+IntervalStats.__doc__ = '''Captures of a camera, its achieved rate (Hz) and
+the jitter of its triggers (s).'''
+
+
+def _initiate_capture(camera):
+    return camera.initiate_capture()
+
+
+class _Schedule(object):
+    '''Triggers and their jitter for one camera.'''
+
+    def __init__(self):
+        self.captures = 0
+        self.failed = 0
+        self.skipped = 0
+        self.first = None
+        self.last = None
+        self.jitter = array('d')
+
+
+class IntervalCapture(object):
+    '''Trigger `cameras` every `interval` seconds.
+
+    `cameras` is a camera, a list of cameras or a dict of cameras by key, as
+    from `open_cameras`. Each camera captures `count` times, or until
+    stopped, with `trigger(camera)`, which defaults to `initiate_capture`.
+    When a capture overruns, the `overrun` policy either skips the missed
+    slots or triggers them right away to catch up.
+
+    If `wait_for_complete`, a capture only ends with its CaptureComplete
+    event, waiting at most `complete_timeout` seconds. Without `interval`,
+    cameras capture back to back, waiting for completion unless told not to,
+    and `stats` gives the rate each camera sustains. Sessions must be open:
+
+        with camera.session():
+            with IntervalCapture(camera, interval=2, count=100) as timelapse:
+                timelapse.wait()
+            print(timelapse.stats())
+    '''
+
+    def __init__(
+            self,
+            cameras,
+            interval=None,
+            count=None,
+            overrun='skip',
+            trigger=_initiate_capture,
+            wait_for_complete=None,
+            complete_timeout=30.,
+    ):
+        if overrun not in OVERRUN_POLICIES:
+            raise ValueError(
+                'Unknown overrun policy {}. Use one of {}.'
+                .format(overrun, OVERRUN_POLICIES)
+            )
+        if interval is not None and interval <= 0:
+            raise ValueError('The interval must be positive.')
+        if not hasattr(cameras, 'items'):
+            if not isinstance(cameras, (list, tuple)):
+                cameras = [cameras]
+            cameras = dict(enumerate(cameras))
+        self.cameras = cameras
+        self.interval = interval
+        self.count = count
+        self.overrun = overrun
+        self.trigger = trigger
+        self.wait_for_complete = (
+            interval is None if wait_for_complete is None
+            else wait_for_complete
+        )
+        self.complete_timeout = complete_timeout
+        self.__schedules = {key: _Schedule() for key in cameras}
+        self.__lock = Lock()
+        self.__shutdown = Event()
+        self.__threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self.__threads)
+
+    def start(self):
+        if self.running:
+            return
+        self.__shutdown.clear()
+        # All cameras share the same grid of due times.
+        start = monotonic()
+        self.__threads = [
+            Thread(
+                name='IntervalCapture {}'.format(key),
+                target=self.__run,
+                args=(key, camera, start),
+            )
+            for key, camera in self.cameras.items()
+        ]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        '''Stop triggering, waiting at most `timeout` for running captures.
+        '''
+        self.__shutdown.set()
+        self.wait(timeout)
+
+    def wait(self, timeout=None):
+        '''Wait for every camera to be done, at most `timeout` seconds.'''
+        deadline = None if timeout is None else monotonic() + timeout
+        for thread in self.__threads:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - monotonic())
+            thread.join(remaining)
+        return not self.running
+
+    def jitter(self, key):
+        '''Return the trigger delays of a camera, in seconds, as an `array`.
+        '''
+        with self.__lock:
+            return array('d', self.__schedules[key].jitter)
+
+    def stats(self, key=None):
+        '''Return the `IntervalStats` of a camera, or a dict of all of them.
+        '''
+        if key is None:
+            return {key: self.stats(key) for key in self.cameras}
+        with self.__lock:
+            schedule = self.__schedules[key]
+            jitter = schedule.jitter
+            rate = 0.
+            if schedule.captures > 1 and schedule.last > schedule.first:
+                rate = (
+                    (schedule.captures - 1) /
+                    (schedule.last - schedule.first)
+                )
+            return IntervalStats(
+                captures=schedule.captures,
+                failed=schedule.failed,
+                skipped=schedule.skipped,
+                rate=rate,
+                mean_jitter=sum(jitter) / len(jitter) if jitter else 0.,
+                max_jitter=max(jitter) if jitter else 0.,
+            )
+
+    def __run(self, key, camera, start):
+        schedule = self.__schedules[key]
+        interval = self.interval
+        due = start
+        triggered = 0
+        while self.count is None or triggered < self.count:
+            if interval is not None:
+                if self.__shutdown.wait(max(0, due - monotonic())):
+                    return
+            elif self.__shutdown.is_set():
+                return
+            triggered += 1
+            now = monotonic()
+            ok = self.__capture(camera)
+            with self.__lock:
+                schedule.jitter.append(now - due if interval else 0.)
+                if ok:
+                    schedule.captures += 1
+                    if schedule.first is None:
+                        schedule.first = now
+                    schedule.last = now
+                else:
+                    schedule.failed += 1
+            if interval is None:
+                due = monotonic()
+                continue
+            due += interval
+            late = monotonic() - due
+            if late > 0 and self.overrun == 'skip':
+                skipped = int(late / interval) + 1
+                due += skipped * interval
+                with self.__lock:
+                    schedule.skipped += skipped
+                logger.debug('{} skipped {} captures'.format(key, skipped))
+
+    def __capture(self, camera):
+        '''Trigger a capture. Return whether it succeeded.'''
+        try:
+            response = self.trigger(camera)
+            if response is None or response.ResponseCode != 'OK':
+                logger.warning('Capture failed: {}'.format(
+                    getattr(response, 'ResponseCode', response)
+                ))
+                return False
+            if self.wait_for_complete:
+                complete = camera.wait_for_event(
+                    'CaptureComplete',
+                    transaction_id=response.TransactionID,
+                    timeout=self.complete_timeout,
+                )
+                if complete is None:
+                    logger.warning('Capture did not complete in time')
+                    return False
+        except Exception as e:
+            logger.error('Capture failed: {}'.format(e))
+            return False
+        return True
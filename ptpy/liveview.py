@@ -0,0 +1,291 @@
+'''This module implements a live view engine shared by vendor extensions.
+
+A `LiveView` fetches frames from a camera in a dedicated thread, as fast as the
+camera produces them. Only the latest frame is kept, so a slow consumer skips
+frames instead of stalling the camera. Frames are memoryviews on the received
+dataphase, so the image is never copied by the engine. Dataphases can be
+received into a `FrameSink`, whose buffers are reused across frames.
+
+Extensions provide the camera specific parts: how to fetch a frame, how to
+start and stop live view and what to do between frames, such as polling
+events.
+'''
+from __future__ import absolute_import
+from .util import monotonic
+from collections import deque, namedtuple
+from threading import Condition, Event, Thread
+import logging
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('Frame', 'FrameBuffer', 'FrameSink', 'LiveView', 'LiveViewStats')
+__author__ = 'Luis Mario Domenzain'
+
+Frame = namedtuple(
+    'Frame', ('number', 'data', 'requested_at', 'received_at')
+)
+Frame.__doc__ = '''Live view image and the monotonic times it was fetched.'''
+
+LiveViewStats = namedtuple(
+    'LiveViewStats',
+    ('frames', 'dropped', 'not_ready', 'errors', 'fps', 'latency',
+     'mean_latency'),
+)
+LiveViewStats.__doc__ = '''Live view counters, rate and latencies (seconds).'''
+
+
+class FrameBuffer(object):
+    '''Hold the latest frame for consumers.
+
+    Putting a frame never waits. The frame a consumer holds stays valid
+    while the next one is written, since frames are not modified in place.
+    Frames that are replaced before anyone got them are counted as dropped.
+    '''
+
+    def __init__(self):
+        self.__frame = None
+        self.__taken = True
+        self.__dropped = 0
+        self.__closed = False
+        self.__condition = Condition()
+
+    @property
+    def dropped(self):
+        return self.__dropped
+
+    def put(self, frame):
+        with self.__condition:
+            if not self.__taken:
+                self.__dropped += 1
+            self.__frame = frame
+            self.__taken = False
+            self.__condition.notify_all()
+
+    def get(self, after=None, timeout=None):
+        '''Return the latest frame newer than frame number `after`.
+
+        Return None on timeout or once the buffer is closed.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.__condition:
+            while (
+                    self.__frame is None or
+                    (after is not None and self.__frame.number <= after)
+            ):
+                if self.__closed:
+                    return None
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                self.__condition.wait(remaining)
+            self.__taken = True
+            return self.__frame
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+
+
+class FrameSink(object):
+    '''Receive dataphases into buffers reused from one frame to the next.
+
+    Pass it as the `sink` of a receive after `rewind`, then take the data
+    with `getbuffer`. A buffer is only reused once no consumer holds a view
+    of it, so frames handed out are never overwritten. At most `count`
+    buffers are kept.
+    '''
+
+    def __init__(self, count=3):
+        self.__buffers = deque(maxlen=count)
+        self.__buffer = None
+        self.__size = 0
+
+    def rewind(self):
+        '''Start receiving a new frame into a free buffer.'''
+        self.__size = 0
+        for buffer in self.__buffers:
+            try:
+                # Resizing fails while a view of the buffer is held.
+                buffer.append(0)
+                buffer.pop()
+            except BufferError:
+                continue
+            self.__buffer = buffer
+            return
+        self.__buffer = bytearray()
+        self.__buffers.append(self.__buffer)
+
+    def write(self, data):
+        end = self.__size + len(data)
+        missing = end - len(self.__buffer)
+        if missing > 0:
+            self.__buffer.extend(b'\0' * missing)
+        self.__buffer[self.__size:end] = data
+        self.__size = end
+        return len(data)
+
+    def getbuffer(self):
+        '''Return a view of the data received since `rewind`.'''
+        return memoryview(self.__buffer)[:self.__size]
+
+
+class LiveView(object):
+    '''Fetch live view frames in a dedicated thread.
+
+    `fetch()` returns the image data of a frame, or None if the camera has
+    none ready. The optional `setup()` and `teardown()` are called in the
+    live view thread when it starts and stops, and `between_frames()` after
+    every fetch. If the camera is not ready, the next fetch is attempted after
+    `retry` seconds. Frame rate is measured over the last `window` seconds.
+
+        with camera.live_view() as live_view:
+            for frame in live_view.frames(timeout=1):
+                show(frame.data)
+    '''
+
+    def __init__(
+            self,
+            fetch,
+            setup=None,
+            teardown=None,
+            between_frames=None,
+            name='LiveView',
+            retry=0.01,
+            window=2.,
+            max_errors=10,
+    ):
+        self.__fetch = fetch
+        self.__setup = setup
+        self.__teardown = teardown
+        self.__between_frames = between_frames
+        self.__name = name
+        self.__retry = retry
+        self.__window = window
+        self.__max_errors = max_errors
+        self.__buffer = FrameBuffer()
+        self.__shutdown = Event()
+        self.__thread = None
+        self.__received = deque()
+        self.__frames = 0
+        self.__not_ready = 0
+        self.__errors = 0
+        self.__latency = 0.
+        self.__total_latency = 0.
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def running(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.__shutdown.clear()
+        self.__buffer = FrameBuffer()
+        self.__thread = Thread(name=self.__name, target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=2):
+        self.__shutdown.set()
+        if self.__thread is not None and self.__thread.is_alive():
+            self.__thread.join(timeout)
+        self.__buffer.close()
+
+    def latest(self, after=None, timeout=None):
+        '''Return the latest frame, newer than frame number `after` if given.
+        '''
+        return self.__buffer.get(after=after, timeout=timeout)
+
+    def frames(self, timeout=None):
+        '''Iterate over new frames, skipping those the consumer was too slow
+        for. Stop after `timeout` seconds without a frame or once stopped.
+        '''
+        number = None
+        while True:
+            frame = self.__buffer.get(after=number, timeout=timeout)
+            if frame is None:
+                return
+            number = frame.number
+            yield frame
+
+    @property
+    def stats(self):
+        received = list(self.__received)
+        fps = 0.
+        if len(received) > 1 and received[-1] > received[0]:
+            fps = (len(received) - 1) / (received[-1] - received[0])
+        return LiveViewStats(
+            frames=self.__frames,
+            dropped=self.__buffer.dropped,
+            not_ready=self.__not_ready,
+            errors=self.__errors,
+            fps=fps,
+            latency=self.__latency,
+            mean_latency=(
+                self.__total_latency / self.__frames if self.__frames else 0.
+            ),
+        )
+
+    def __run(self):
+        try:
+            if self.__setup is not None:
+                self.__setup()
+        except Exception as e:
+            logger.error('Could not start live view: {}'.format(e))
+            self.__buffer.close()
+            return
+        try:
+            self.__loop()
+        finally:
+            try:
+                if self.__teardown is not None:
+                    self.__teardown()
+            except Exception as e:
+                logger.error('Could not stop live view: {}'.format(e))
+            self.__buffer.close()
+
+    def __loop(self):
+        errors = 0
+        while not self.__shutdown.is_set():
+            requested_at = monotonic()
+            try:
+                data = self.__fetch()
+                errors = 0
+            except Exception as e:
+                logger.error('Live view frame failed: {}'.format(e))
+                self.__errors += 1
+                errors += 1
+                if errors >= self.__max_errors:
+                    logger.error('Too many live view errors, stopping.')
+                    return
+                data = None
+            received_at = monotonic()
+            if data is None:
+                self.__not_ready += 1
+            else:
+                self.__frames += 1
+                self.__latency = received_at - requested_at
+                self.__total_latency += self.__latency
+                self.__received.append(received_at)
+                while received_at - self.__received[0] > self.__window:
+                    self.__received.popleft()
+                self.__buffer.put(
+                    Frame(self.__frames, data, requested_at, received_at)
+                )
+            if self.__between_frames is not None:
+                try:
+                    self.__between_frames()
+                except Exception as e:
+                    logger.error('Between frames: {}'.format(e))
+            if data is None:
+                self.__shutdown.wait(self.__retry)
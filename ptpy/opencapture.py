@@ -0,0 +1,168 @@
+'''This module streams the objects of an open capture as they are added.
+
+During an open capture, the camera keeps capturing and announces each object
+with an ObjectAdded event for the transaction of InitiateOpenCapture. A worker
+thread downloads the objects as soon as they are announced, while the capture
+goes on, and hands them to the consumer. At most `read_ahead` downloaded
+objects wait for the consumer, which bounds memory use, until the capture is
+closed: the objects announced by then are all kept for the consumer.
+'''
+from __future__ import absolute_import
+from .ptp import PTPError
+from .util import monotonic, object_filename
+from collections import deque
+from construct import Container
+from six.moves.queue import Queue
+from threading import Condition, Thread
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('OpenCapture',)
+__author__ = 'Luis Mario Domenzain'
+
+
+class OpenCapture(object):
+    '''Download the objects added during the open capture `transaction_id`.
+
+    Objects are Containers with their `ObjectHandle`, `ObjectInfo` and
+    either their `Data` or, with a `directory`, the `Path` they were written
+    to in chunks. Use it through `PTP.open_capture`:
+
+        with camera.open_capture() as capture:
+            for obj in capture.objects(timeout=5):
+                print(obj.ObjectInfo.Filename, len(obj.Data))
+    '''
+
+    def __init__(self, camera, transaction_id, read_ahead=4, directory=None):
+        self.transaction_id = transaction_id
+        self.directory = directory
+        self.downloaded = 0
+        self.failed = []
+        self.__camera = camera
+        self.__read_ahead = read_ahead
+        self.__handles = Queue()
+        self.__objects = deque()
+        self.__condition = Condition()
+        self.__finished = False
+        self.__draining = False
+        self.__subscription = None
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        if self.directory is not None and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Objects added before the subscription are delivered as well.
+        self.__subscription = self.__camera.subscribe(
+            self.__object_added,
+            code='ObjectAdded',
+            transaction_id=self.transaction_id,
+        )
+        self.__thread = Thread(name='OpenCapture', target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def close(self, timeout=5):
+        '''Stop after the objects announced so far, waiting at most `timeout`.
+
+        The objects are all downloaded and kept, past the read ahead, so that
+        they can still be iterated over once the capture is closed.
+        '''
+        if self.__subscription is not None:
+            self.__camera.unsubscribe(self.__subscription)
+            self.__subscription = None
+        with self.__condition:
+            self.__draining = True
+            self.__condition.notify_all()
+        self.__handles.put(None)
+        if self.__thread is not None:
+            self.__thread.join(timeout)
+
+    def objects(self, timeout=5):
+        '''Iterate over downloaded objects as they arrive.
+
+        Stop after `timeout` seconds without an object or once the capture
+        is over and every object was handed out. A `timeout` of None waits
+        until the capture is closed.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            with self.__condition:
+                while not self.__objects and not self.__finished:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - monotonic()
+                        if remaining <= 0:
+                            return
+                    self.__condition.wait(remaining)
+                if not self.__objects:
+                    return
+                obj = self.__objects.popleft()
+                self.__condition.notify_all()
+            if timeout is not None:
+                deadline = monotonic() + timeout
+            yield obj
+
+    def __object_added(self, event):
+        parameter = event.Parameter
+        handle = parameter[0] if isinstance(parameter, list) else parameter
+        self.__handles.put(handle)
+
+    def __run(self):
+        try:
+            while True:
+                handle = self.__handles.get()
+                if handle is None:
+                    return
+                try:
+                    obj = self.__download(handle)
+                except Exception as e:
+                    logger.error('Could not download {}: {}'.format(handle, e))
+                    self.failed.append((handle, e))
+                    continue
+                self.downloaded += 1
+                self.__put(obj)
+        finally:
+            with self.__condition:
+                self.__finished = True
+                self.__condition.notify_all()
+
+    def __download(self, handle):
+        camera = self.__camera
+        info = camera.get_object_info(handle)
+        obj = Container(ObjectHandle=handle, ObjectInfo=info)
+        if self.directory is None:
+            response = camera.get_object(handle)
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not get object {}: {}'
+                    .format(handle, response.ResponseCode)
+                )
+            obj['Data'] = response.Data
+            return obj
+        name = object_filename(
+            info.Filename if info is not None else None, handle
+        )
+        obj['Path'] = os.path.join(self.directory, name)
+        size = info.ObjectCompressedSize if info is not None else None
+        camera.download_object(
+            handle,
+            obj.Path,
+            # Objects past 4GB do not fit in ObjectInfo.
+            size=None if size == 0xFFFFFFFF else size,
+        )
+        return obj
+
+    def __put(self, obj):
+        '''Wait for room for an object, unless the capture is closed.'''
+        with self.__condition:
+            while (
+                    len(self.__objects) >= self.__read_ahead and
+                    not self.__draining
+            ):
+                self.__condition.wait()
+            self.__objects.append(obj)
+            self.__condition.notify_all()
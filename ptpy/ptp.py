@@ -15,9 +15,15 @@ from construct import (
     Int64un, Int8sb, Int8sl, Int8sn, Int8ub, Int8ul, Int8un, Pass,
     PrefixedArray, Struct, Switch,
     )
+from .busy import BusyPolicy
+from .events import EventStream
+from .reactor import shared_reactor
+from .util import as_payload, monotonic
+from collections import deque, namedtuple
 from contextlib import contextmanager
 from dateutil.parser import parse as iso8601
 from datetime import datetime
+from threading import Condition, Lock, RLock
 import logging
 import six
 
@@ -41,6 +47,11 @@ class PTPUnimplemented(PTPError):
     pass
 
 
+_Subscription = namedtuple(
+    '_Subscription', ('callback', 'code', 'parameters', 'transaction_id')
+)
+
+
 class PTP(object):
     '''Implement bare PTP device. Vendor specific devices should extend it.'''
     # Base PTP protocol transaction elements
@@ -711,12 +722,38 @@ class PTP(object):
 
     def __init__(self, *args, **kwargs):
         logger.debug('Init PTP')
+        # Event sources of transports and extensions are served by a reactor,
+        # shared by all cameras unless one is given.
+        self._reactor = kwargs.pop('reactor', None) or shared_reactor()
         # Session and transaction helpers
         # -------------------------------
         self._session = 0
         self.__session_open = False
         self.__transaction_id = 1
         self.__has_the_knowledge = False
+        self.__prop_desc = {}
+        self.__transfers = 0
+        self.__transfers_lock = Lock()
+        self.__operations = 0
+        self.__operation_lock = RLock()
+        self.__pollers = []
+        self.__poll_triggers = None
+        # Operations answered DeviceBusy are only retried with a policy.
+        self.busy_policy = kwargs.pop('busy_policy', None)
+        if self.busy_policy is True:
+            self.busy_policy = BusyPolicy()
+        # Event stream, subscriptions and waiters
+        # ---------------------------------------
+        self.__event_stream = EventStream(
+            maxlen=kwargs.pop('event_queue_size', 1024),
+            policy=kwargs.pop('event_policy', 'drop_oldest'),
+        )
+        self.__subscriptions = []
+        self.__event_condition = Condition()
+        self.__events_received = 0
+        self.__recent_events = deque(
+            maxlen=kwargs.pop('event_history', 64)
+        )
         super(PTP, self).__init__(*args, **kwargs)
 
     @property
@@ -783,46 +820,432 @@ class PTP(object):
             yield
 
     @contextmanager
-    def open_capture(self):
+    def open_capture(
+            self,
+            storage_id=0,
+            object_format=0,
+            read_ahead=4,
+            directory=None,
+            complete_timeout=5,
+    ):
         '''
         Manage open capture with context manager.
 
-        This allows easier open capture with automatic closing
+        This allows easier open capture with automatic closing. Yield an
+        `OpenCapture` whose objects are downloaded in the background while the
+        capture goes on. On exit the capture is terminated and the objects
+        announced until CaptureComplete, or `complete_timeout`, are still
+        downloaded and kept, so they can be iterated over after the block:
+
+            with camera.open_capture() as capture:
+                for obj in capture.objects(timeout=5):
+                    print(obj.ObjectInfo.Filename)
         '''
-        # TODO: implement!
+        # The open capture helpers need PTP to be defined.
+        from .opencapture import OpenCapture
+        with self.session():
+            response = self.initiate_open_capture(storage_id, object_format)
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not initiate open capture: {}'
+                    .format(response.ResponseCode)
+                )
+            transaction_id = response.TransactionID
+            capture = OpenCapture(
+                self,
+                transaction_id,
+                read_ahead=read_ahead,
+                directory=directory,
+            )
+            capture.start()
+            try:
+                yield capture
+            finally:
+                try:
+                    self.terminate_open_capture(transaction_id)
+                    self.wait_for_event(
+                        'CaptureComplete',
+                        transaction_id=transaction_id,
+                        timeout=complete_timeout,
+                    )
+                finally:
+                    capture.close(complete_timeout)
 
     # Transport-specific functions
     # ----------------------------
     def send(self, ptp_container, payload):
         '''Operation with dataphase from initiator to responder'''
+        payload = as_payload(payload)
         try:
-            return super(PTP, self).send(ptp_container, payload)
+            response = self.__retry_if_busy(
+                ptp_container,
+                lambda: super(PTP, self).send(ptp_container, payload),
+                replayable=lambda: payload.replayable,
+                transfer=True,
+            )
         except Exception as e:
             logger.error(e)
             raise e
+        self.__kick_pollers(ptp_container)
+        return response
+
+    def recv(self, ptp_container, sink=None):
+        '''Operation with dataphase from responder to initiator
 
-    def recv(self, ptp_container):
-        '''Operation with dataphase from responder to initiator'''
+        If a file-like `sink` is given, the data is written to it as it
+        arrives and the response only carries its `DataLength`.
+        '''
+        # Transports without streaming are only asked for it when needed.
+        kwargs = {} if sink is None else {'sink': sink}
         try:
-            return super(PTP, self).recv(ptp_container)
+            response = self.__retry_if_busy(
+                ptp_container,
+                lambda: super(PTP, self).recv(ptp_container, **kwargs),
+                transfer=True,
+            )
         except Exception as e:
             logger.error(e)
             raise e
+        self.__kick_pollers(ptp_container)
+        return response
+
+    def mesg(self, ptp_container, retry=True):
+        '''Operation with no dataphase
 
-    def mesg(self, ptp_container):
-        '''Operation with no dataphase'''
+        Probes whose DeviceBusy is an answer are sent with `retry=False`, so
+        that they are neither retried nor accounted for by the `busy_policy`.
+        '''
         try:
-            return super(PTP, self).mesg(ptp_container)
+            response = self.__retry_if_busy(
+                ptp_container,
+                lambda: super(PTP, self).mesg(ptp_container),
+                retry=retry,
+            )
         except Exception as e:
             logger.error(e)
             raise e
+        self.__kick_pollers(ptp_container)
+        return response
+
+    def __retry_if_busy(
+            self,
+            ptp_container,
+            operation,
+            replayable=None,
+            transfer=False,
+            retry=True,
+    ):
+        '''Run `operation`, retrying it while the device is busy.
+
+        Retries follow the `busy_policy`. Data sent from a stream is only
+        retried while it can be sent again. Each attempt is tracked as a
+        `transfer` if it has a dataphase, so that polls run during backoff.
+        '''
+        with self.__operation(transfer):
+            response = operation()
+        policy = self.busy_policy
+        if (
+                not retry or
+                policy is None or
+                response.ResponseCode != 'DeviceBusy'
+        ):
+            return response
+        name = self._name(ptp_container.OperationCode, self._OperationCode)
+        start = monotonic()
+        deadline = start + policy.timeout_for(name)
+        delays = policy.delays()
+        retries = 0
+        while (
+                response.ResponseCode == 'DeviceBusy' and
+                monotonic() < deadline and
+                (replayable is None or replayable())
+        ):
+            self._wait_while_busy(policy, next(delays), deadline)
+            if self._ready() is False:
+                continue
+            if self.__session_open:
+                ptp_container['TransactionID'] = self._transaction
+            with self.__operation(transfer):
+                response = operation()
+            retries += 1
+        waited = monotonic() - start
+        logger.debug(
+            '{} busy for {:.3f}s over {} retries'.format(name, waited, retries)
+        )
+        policy.record(
+            name, retries, waited, response.ResponseCode == 'DeviceBusy'
+        )
+        return response
+
+    def _ready(self):
+        '''Probe whether the device is ready, through the transport.
+
+        Extensions with their own probe fall back on this one. Return None
+        when readiness is unknown.
+        '''
+        ready = getattr(super(PTP, self), '_ready', None)
+        return None if ready is None else ready()
+
+    def _wait_while_busy(self, policy, delay, deadline):
+        '''Wait up to `delay` seconds, or until a readiness event arrives.
+
+        Readiness events are the `events` of the `BusyPolicy` given.
+        '''
+        end = min(monotonic() + delay, deadline)
+        while True:
+            remaining = end - monotonic()
+            if remaining <= 0:
+                return
+            event = self.wait_for_event(timeout=remaining)
+            if event is not None and event.EventCode in policy.events:
+                return
+
+    @contextmanager
+    def __transfer(self):
+        '''Keep track of operations with a dataphase.'''
+        with self.__transfers_lock:
+            self.__transfers += 1
+        try:
+            yield
+        finally:
+            with self.__transfers_lock:
+                self.__transfers -= 1
+
+    @property
+    def _transfer_in_flight(self):
+        '''Whether an operation with a dataphase is running.
+
+        Event polls yield to these instead of competing for the device.
+        '''
+        return self.__transfers > 0
+
+    @contextmanager
+    def __operation(self, transfer=False):
+        '''Hold the operation lock while a transaction runs.
+
+        Transactions with a dataphase are also tracked as a `transfer`.
+        '''
+        with self.__operation_lock:
+            self.__operations += 1
+            try:
+                if transfer:
+                    with self.__transfer():
+                        yield
+                else:
+                    yield
+            finally:
+                self.__operations -= 1
+
+    @property
+    def _operation_lock(self):
+        '''Lock held while any transaction runs.
+
+        Holding it keeps other threads from starting a transaction, so
+        work that must be fresh when it reaches the device is checked
+        once it is acquired.
+        '''
+        return self.__operation_lock
+
+    @property
+    def _operation_in_flight(self):
+        '''Whether a transaction, with or without a dataphase, is running.'''
+        return self.__operations > 0
+
+    def _poll_triggers(self):
+        '''Operations after which events are expected soon.
+
+        Extensions add their own to the set returned by their parent.
+        '''
+        return {
+            'InitiateCapture',
+            'InitiateOpenCapture',
+            'TerminateOpenCapture',
+            'SetDevicePropValue',
+            'ResetDevicePropValue',
+        }
+
+    def _add_poller(self, poller):
+        '''Kick an `AdaptivePoller` after operations that trigger events.'''
+        self.__pollers.append(poller)
+
+    def __kick_pollers(self, ptp_container):
+        if not self.__pollers:
+            return
+        if self.__poll_triggers is None:
+            self.__poll_triggers = self._poll_triggers()
+        operation = self._name(
+            ptp_container.OperationCode, self._OperationCode
+        )
+        if operation in self.__poll_triggers:
+            for poller in self.__pollers:
+                poller.kick()
+
+    def _shutdown(self):
+        try:
+            super(PTP, self)._shutdown()
+        finally:
+            self.__event_stream.close()
+
+    # Event stream
+    # ------------
+    @property
+    def event_stream(self):
+        '''Events from all sources, in the order in which they were received.
+
+        Each event carries its `Source` and the monotonic time at which it
+        was received, `ReceivedAt`. See `EventStream`.
+        '''
+        return self.__event_stream
 
     def event(self, wait=False):
+        '''Check event.
+
+        If `wait` this function is blocking. Otherwise it may return None.
+        '''
+        return self.__event_stream.get(block=wait)
+
+    def events(self, timeout=None):
+        '''Iterate over events, stopping after `timeout` seconds without any.
+        '''
+        while True:
+            evt = self.__event_stream.get(timeout=timeout)
+            if evt is None:
+                return
+            yield evt
+
+    # Event subscriptions
+    # -------------------
+    def subscribe(
+            self, callback, code=None, parameters=None, transaction_id=None
+    ):
+        '''Call `callback(event)` for every matching event.
+
+        Events can be matched by `code` (name or number), `transaction_id` and
+        their first `parameters`, where `None` matches any value. Events for
+        `transaction_id` that were already received are delivered right away.
+
+        Callbacks are run in the thread receiving events and should return
+        quickly. Return a subscription to cancel with `unsubscribe`:
+
+            camera.subscribe(print, code='ObjectAdded')
+        '''
+        subscription = _Subscription(
+            callback, code, parameters, transaction_id
+        )
+        with self.__event_condition:
+            self.__subscriptions.append(subscription)
+            received = (
+                [e for e in self.__recent_events
+                 if self.__matches(e, subscription)]
+                if transaction_id is not None else []
+            )
+        for event in received:
+            self.__notify(subscription, event)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''Stop calling back a subscription.'''
+        with self.__event_condition:
+            try:
+                self.__subscriptions.remove(subscription)
+            except ValueError:
+                pass
+
+    def wait_for_event(
+            self, code=None, transaction_id=None, parameters=None, timeout=None
+    ):
+        '''Block until a matching event is received and return it.
+
+        Events are matched as in `subscribe`. The first event for
+        `transaction_id` is returned even if it arrived before the call, so
+        no events are lost between an operation and the wait:
+
+            capture = camera.initiate_capture()
+            camera.wait_for_event(
+                'CaptureComplete',
+                transaction_id=capture.TransactionID,
+                timeout=10,
+            )
+
+        Return None if `timeout` seconds elapse first.
+        '''
+        wanted = _Subscription(None, code, parameters, transaction_id)
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.__event_condition:
+            if transaction_id is not None:
+                for event in self.__recent_events:
+                    if self.__matches(event, wanted):
+                        return event
+            seen = self.__events_received
+            while True:
+                new = self.__events_received - seen
+                seen = self.__events_received
+                if new > len(self.__recent_events):
+                    logger.debug(
+                        'Missed {} events while waiting'
+                        .format(new - len(self.__recent_events))
+                    )
+                recent = list(self.__recent_events)
+                for event in recent[max(0, len(recent) - new):] if new else []:
+                    if self.__matches(event, wanted):
+                        return event
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                self.__event_condition.wait(remaining)
+
+    def _event_received(self, event, source, received_at=None):
+        '''Hand a received event to the stream, subscribers and waiters.
+
+        Transports and extensions call this for every event they receive,
+        with a name for its `source` and the `monotonic` time it arrived at.
+        '''
+        if received_at is None:
+            received_at = monotonic()
+        event['ReceivedAt'] = received_at
+        event['Source'] = source
+        with self.__event_condition:
+            self.__recent_events.append(event)
+            self.__events_received += 1
+            subscriptions = list(self.__subscriptions)
+            self.__event_condition.notify_all()
+        for subscription in subscriptions:
+            if self.__matches(event, subscription):
+                self.__notify(subscription, event)
+        # A full stream may block, without holding back waiters.
+        self.__event_stream.put(event, source, received_at)
+
+    def __notify(self, subscription, event):
         try:
-            return super(PTP, self).event(wait=wait)
+            subscription.callback(event)
         except Exception as e:
-            logger.error(e)
-            raise e
+            logger.error('Event callback failed: {}'.format(e))
+
+    def __matches(self, event, subscription):
+        '''Whether an event passes the filters of a subscription.'''
+        code = subscription.code
+        if code is not None and event.EventCode not in (
+                code, self._name(code, self._EventCode)
+        ):
+            return False
+        if (
+                subscription.transaction_id is not None and
+                getattr(event, 'TransactionID', None) !=
+                subscription.transaction_id
+        ):
+            return False
+        if subscription.parameters is not None:
+            parameter = getattr(event, 'Parameter', [])
+            if not isinstance(parameter, list):
+                parameter = [parameter]
+            if len(parameter) < len(subscription.parameters):
+                return False
+            for expected, actual in zip(subscription.parameters, parameter):
+                if expected is not None and expected != actual:
+                    return False
+        return True
 
     # Operation-specific methods and helpers
     # --------------------------------------
@@ -863,14 +1286,12 @@ class PTP(object):
         '''Initialise an internal representation of device behaviour.'''
         logger.debug('Gathering info about all device properties')
         self.__device_info = self.get_device_info()
-        self.__prop_desc = {}
         with self.session():
-            for p in self.__device_info.DevicePropertiesSupported:
-                # TODO: Update __prop_desc with arrival of events
-                # transparently.
-                self.__prop_desc[p] = self.get_device_prop_desc(p)
-                # TODO: Get info regarding ObjectHandles here. And update as
-                # events are received. This should be transparent for the user.
+            # TODO: Get info regarding ObjectHandles here. And update as
+            # events are received. This should be transparent for the user.
+            self.__prop_desc = self._describe_properties(
+                self.__device_info.DevicePropertiesSupported
+            )
 
         self.__has_the_knowledge = True
 
@@ -878,10 +1299,23 @@ class PTP(object):
         '''Update an internal representation of device behaviour.'''
         logger.debug('Gathering info about extra device properties')
         with self.session():
-            for p in props:
-                self.__prop_desc[p] = self.get_device_prop_desc()
+            self._learn_properties(self._describe_properties(props))
+        for p in props:
+            if p not in self.__device_info.DevicePropertiesSupported:
                 self.__device_info.DevicePropertiesSupported.append(p)
 
+    def _describe_properties(self, props):
+        '''Return the descriptions of `props`, keyed by property.
+
+        Extensions that can describe every property in a single transaction
+        should override this.
+        '''
+        return {p: self.get_device_prop_desc(p) for p in props}
+
+    def _learn_properties(self, descriptions):
+        '''Update the knowledge of device properties with `descriptions`.'''
+        self.__prop_desc.update(descriptions)
+
     def open_session(self):
         self._session += 1
         self._transaction = 1
@@ -1198,28 +1632,34 @@ class PTP(object):
 
         return self.send(ptp, objectinfo)
 
-    def send_object(self, bytes_data):
+    def send_object(self, bytes_data, progress=None):
         '''Send object to responder.
 
         The object should correspond to the latest SendObjectInfo interaction
-        between Initiator and Responder.
+        between Initiator and Responder. It can be bytes, a file, an mmap or a
+        `Payload`, and is streamed in chunks. `progress(sent, size)` is called
+        as they are sent.
         '''
+        payload = as_payload(bytes_data, progress=progress)
         ptp = Container(
             OperationCode='SendObject',
             SessionID=self._session,
             TransactionID=self._transaction,
             Parameter=[]
         )
-        response = self.send(ptp, bytes_data)
-        if response.ResponseCode != 'OK':
-            response = self.send(ptp, bytes_data)
+        response = self.send(ptp, payload)
+        if response.ResponseCode != 'OK' and payload.replayable:
+            response = self.send(ptp, payload)
         return response
 
-    def get_object(self, handle):
+    def get_object(self, handle, sink=None):
         '''Retrieve object from responder.
 
         The object should correspond to a previous GetObjectInfo interaction
         between Initiator and Responder in the same session.
+
+        If a file-like `sink` is given, the object is written to it as it
+        arrives instead of being held in memory.
         '''
         ptp = Container(
             OperationCode='GetObject',
@@ -1227,7 +1667,7 @@ class PTP(object):
             TransactionID=self._transaction,
             Parameter=[handle]
         )
-        return self.recv(ptp)
+        return self.recv(ptp, sink=sink)
 
     def get_partial_object(self, handle, offset, max_bytes, until_end=False):
         '''Retrieve partial object from responder.
@@ -1249,6 +1689,83 @@ class PTP(object):
         )
         return self.recv(ptp)
 
+    def _get_partial_object_at(self, handle, offset, max_bytes):
+        '''Get up to `max_bytes` of an object from `offset`.
+
+        GetPartialObject cannot reach past 4GB. Extensions with 64 bit partial
+        transfers override this.
+        '''
+        if offset > 0xFFFFFFFF:
+            raise PTPError(
+                'Cannot get object {} past 4GB without 64 bit transfers.'
+                .format(handle)
+            )
+        return self.get_partial_object(
+            handle, offset, min(max_bytes, 0xFFFFFFFF)
+        )
+
+    def download_object(
+            self,
+            handle,
+            destination,
+            size=None,
+            chunk_size=8 << 20,
+            between_chunks=None,
+    ):
+        '''Write an object to `destination` chunk by chunk.
+
+        `destination` is a path or a writable file. At most `chunk_size`
+        bytes are held in memory and `between_chunks()` is called after each
+        chunk. Without a `size` it is taken from the ObjectInfo. If that is
+        unknown too, the download ends with the first short or empty chunk.
+        Return the number of bytes written.
+        '''
+        if isinstance(destination, six.string_types):
+            with open(destination, 'wb') as f:
+                return self.download_object(
+                    handle, f, size, chunk_size, between_chunks
+                )
+        if size is None:
+            size = self.__object_size(handle)
+        written = 0
+        while size is None or written < size:
+            wanted = chunk_size if size is None else min(
+                chunk_size, size - written
+            )
+            response = self._get_partial_object_at(handle, written, wanted)
+            if size is None and written and response.ResponseCode != 'OK':
+                # Some cameras refuse to read from the end of the object.
+                break
+            if response.ResponseCode != 'OK':
+                raise PTPError(
+                    'Could not get object {} at {}: {}'
+                    .format(handle, written, response.ResponseCode)
+                )
+            data = getattr(response, 'Data', b'')
+            destination.write(data)
+            written += len(data)
+            if between_chunks is not None:
+                between_chunks()
+            if len(data) < wanted:
+                if size is not None:
+                    raise PTPError(
+                        'Object {} ended after {} of {} bytes.'
+                        .format(handle, written, size)
+                    )
+                break
+        return written
+
+    def __object_size(self, handle):
+        '''Return the size of an object, or None if it is unknown.'''
+        try:
+            info = self.get_object_info(handle)
+        except Exception as e:
+            logger.debug('No ObjectInfo for {}: {}'.format(handle, e))
+            return None
+        size = getattr(info, 'ObjectCompressedSize', None)
+        # Objects over 4GB do not fit in ObjectCompressedSize.
+        return None if size == 0xFFFFFFFF else size
+
     def delete_object(
             self,
             handle,
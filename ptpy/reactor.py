@@ -0,0 +1,402 @@
+'''This module implements an event reactor shared by all cameras.
+
+A single thread multiplexes the event sources of every camera. PTP/IP event
+connections are watched with a selector, while USB interrupt endpoints and
+vendor polls are run as scheduled tasks. Tasks that may block, such as vendor
+polls that need a whole transaction, are run one at a time per camera by a
+small pool of lane workers shared by all cameras. A camera stuck in a long
+transfer only delays its own tasks and holds a single worker.
+
+Unless told otherwise, cameras use the reactor returned by `shared_reactor`.
+'''
+from __future__ import absolute_import
+from .util import monotonic
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from threading import Condition, Event, RLock, Thread, current_thread
+import atexit
+import heapq
+import itertools
+import logging
+import socket
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+logger = logging.getLogger(__name__)
+
+__all__ = ('AdaptivePoller', 'Reactor', 'shared_reactor')
+__author__ = 'Luis Mario Domenzain'
+
+
+class _Task(object):
+    '''Call scheduled in a reactor.
+
+    The callable may return a delay in seconds to override the interval until
+    its next call. Tasks without an interval are only called again if they
+    return a delay.
+    '''
+
+    def __init__(self, reactor, fn, interval, blocking, name, group):
+        self.fn = fn
+        self.interval = interval
+        self.blocking = blocking
+        self.group = group
+        self.name = name or getattr(fn, '__name__', 'task')
+        self.__reactor = reactor
+        self.__cancelled = False
+        self.__idle = Event()
+        self.__idle.set()
+        self.__runner = None
+        # Managed by the reactor under its lock.
+        self._generation = 0
+        self._running = False
+        self._soon = False
+
+    @property
+    def cancelled(self):
+        return self.__cancelled
+
+    def cancel(self, timeout=None):
+        '''Stop calling the task.
+
+        If `timeout` is given, wait that long for a running call to finish,
+        unless it is the task itself cancelling.
+        '''
+        self.__cancelled = True
+        self.__reactor._wake()
+        if timeout is not None and self.__runner is not current_thread():
+            self.__idle.wait(timeout)
+
+    def run_soon(self):
+        '''Call the task as soon as possible instead of at its due time.'''
+        if not self.__cancelled:
+            self.__reactor._run_soon(self)
+
+    def _run(self):
+        '''Call the task. Return the delay until the next call or None.'''
+        self.__idle.clear()
+        self.__runner = current_thread()
+        try:
+            delay = self.fn()
+        except Exception as e:
+            logger.error('{} failed: {}'.format(self.name, e))
+            delay = None
+        finally:
+            self.__runner = None
+            self.__idle.set()
+        return self.interval if delay is None else delay
+
+
+class Reactor(object):
+    '''Multiplex event sources for many cameras in a single thread.
+
+    Blocking tasks of a `group`, usually their camera, run one at a time on
+    one of at most `lanes` threads shared by all groups, which end after
+    `idle` seconds without tasks. Groups with pending tasks take turns, one
+    task each. Other blocking tasks are run by a pool of at most `workers`
+    threads. A given task is never run concurrently with itself. Readers are
+    called from the reactor thread and must not block.
+    '''
+
+    def __init__(self, workers=4, name='PTPyReactor', idle=5., lanes=8):
+        self.__name = name
+        self.__idle = idle
+        self.__selector = selectors.DefaultSelector()
+        self.__tasks = []
+        self.__counter = itertools.count()
+        self.__lock = RLock()
+        self.__shutdown = Event()
+        self.__pool = ThreadPoolExecutor(max_workers=workers)
+        # Tasks queued by group, for groups with a task queued or running.
+        self.__lanes = {}
+        # Groups waiting for a lane worker, in turn.
+        self.__ready = deque()
+        self.__lane_ready = Condition(self.__lock)
+        self.__max_lane_workers = lanes
+        self.__lane_workers = 0
+        self.__idle_lane_workers = 0
+        # Writing to this socket pair wakes the selector up when tasks change.
+        self.__wake_reader, self.__wake_writer = socket.socketpair()
+        self.__wake_reader.setblocking(False)
+        self.__wake_writer.setblocking(False)
+        self.__selector.register(
+            self.__wake_reader,
+            selectors.EVENT_READ,
+            None,
+        )
+        self.__thread = Thread(name=name, target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def call_every(
+            self, interval, fn, blocking=False, delay=0, name=None, group=None
+    ):
+        '''Call `fn` every `interval` seconds, starting after `delay`.'''
+        task = _Task(self, fn, interval, blocking, name, group)
+        self.__schedule(task, delay)
+        return task
+
+    def call_later(self, delay, fn, blocking=False, name=None, group=None):
+        '''Call `fn` once after `delay` seconds.'''
+        task = _Task(self, fn, None, blocking, name, group)
+        self.__schedule(task, delay)
+        return task
+
+    def add_reader(self, fileobj, fn):
+        '''Call `fn` whenever `fileobj` is ready for reading.'''
+        with self.__lock:
+            self.__selector.register(fileobj, selectors.EVENT_READ, fn)
+        self._wake()
+
+    def remove_reader(self, fileobj):
+        '''Stop watching `fileobj`.'''
+        with self.__lock:
+            try:
+                self.__selector.unregister(fileobj)
+            except (KeyError, ValueError):
+                pass
+        self._wake()
+
+    def stop(self, timeout=2):
+        self.__shutdown.set()
+        self._wake()
+        if (
+                self.__thread.is_alive() and
+                self.__thread is not current_thread()
+        ):
+            self.__thread.join(timeout)
+        self.__pool.shutdown(wait=False)
+        with self.__lock:
+            self.__lane_ready.notify_all()
+
+    def _wake(self):
+        try:
+            self.__wake_writer.send(b'\0')
+        except (socket.error, OSError):
+            # The wake up is already pending.
+            pass
+
+    def _run_soon(self, task):
+        with self.__lock:
+            if task._running:
+                # Run it again right after the current call.
+                task._soon = True
+            else:
+                self.__schedule(task, 0)
+
+    def __schedule(self, task, delay):
+        '''Schedule a task, replacing its previous due time.'''
+        with self.__lock:
+            task._generation += 1
+            heapq.heappush(
+                self.__tasks,
+                (
+                    monotonic() + delay,
+                    next(self.__counter),
+                    task,
+                    task._generation,
+                )
+            )
+        self._wake()
+
+    def __execute(self, task):
+        delay = None if task.cancelled else task._run()
+        with self.__lock:
+            task._running = False
+            if task._soon:
+                task._soon = False
+                delay = 0
+            if delay is not None and not task.cancelled:
+                self.__schedule(task, delay)
+
+    def __timeout(self):
+        '''Time until the next task is due, or None.'''
+        with self.__lock:
+            if not self.__tasks:
+                return None
+            return max(0, self.__tasks[0][0] - monotonic())
+
+    def __due(self):
+        '''Pop all tasks that are due and mark them as running.'''
+        due = []
+        now = monotonic()
+        with self.__lock:
+            while self.__tasks and self.__tasks[0][0] <= now:
+                _, _, task, generation = heapq.heappop(self.__tasks)
+                if (
+                        generation != task._generation or
+                        task._running or
+                        task.cancelled
+                ):
+                    # Superseded by a newer due time.
+                    continue
+                task._running = True
+                due.append(task)
+        return due
+
+    def __run(self):
+        while not self.__shutdown.is_set():
+            try:
+                ready = self.__selector.select(self.__timeout())
+            except (OSError, ValueError) as e:
+                # A file object was closed without being removed.
+                logger.debug('Selector error: {}'.format(e))
+                self.__prune()
+                continue
+            for key, _ in ready:
+                if key.fileobj is self.__wake_reader:
+                    self.__drain()
+                    continue
+                try:
+                    key.data()
+                except Exception as e:
+                    logger.error('Reader {} failed: {}'.format(key.fd, e))
+            for task in self.__due():
+                if not task.blocking:
+                    self.__execute(task)
+                elif task.group is not None:
+                    self.__lane(task)
+                else:
+                    try:
+                        self.__pool.submit(self.__execute, task)
+                    except RuntimeError:
+                        # The pool is shutting down.
+                        return
+
+    def __lane(self, task):
+        '''Queue a task in the lane of its group.'''
+        with self.__lock:
+            lane = self.__lanes.get(task.group)
+            if lane is not None:
+                # The group is already waiting for a worker or running.
+                lane.append(task)
+                return
+            self.__lanes[task.group] = deque([task])
+            self.__ready.append(task.group)
+            if self.__idle_lane_workers:
+                self.__lane_ready.notify()
+            elif self.__lane_workers < self.__max_lane_workers:
+                self.__lane_workers += 1
+                thread = Thread(
+                    name='{} lane'.format(self.__name),
+                    target=self.__serve_lanes,
+                )
+                thread.daemon = True
+                thread.start()
+
+    def __serve_lanes(self):
+        '''Run one task of each group in turn, until idle.'''
+        while True:
+            with self.__lock:
+                if not self.__ready and not self.__shutdown.is_set():
+                    self.__idle_lane_workers += 1
+                    self.__lane_ready.wait(self.__idle)
+                    self.__idle_lane_workers -= 1
+                if not self.__ready or self.__shutdown.is_set():
+                    self.__lane_workers -= 1
+                    return
+                group = self.__ready.popleft()
+                task = self.__lanes[group].popleft()
+            self.__execute(task)
+            with self.__lock:
+                if self.__lanes[group]:
+                    # Back in line behind the other groups.
+                    self.__ready.append(group)
+                else:
+                    del self.__lanes[group]
+
+    def __drain(self):
+        try:
+            while self.__wake_reader.recv(4096):
+                pass
+        except (socket.error, OSError):
+            pass
+
+    def __prune(self):
+        '''Remove closed file objects from the selector.'''
+        with self.__lock:
+            for key in list(self.__selector.get_map().values()):
+                if key.fileobj is self.__wake_reader:
+                    continue
+                try:
+                    closed = key.fileobj.fileno() < 0
+                except (socket.error, OSError, ValueError):
+                    closed = True
+                if closed:
+                    self.__selector.unregister(key.fileobj)
+
+
+class AdaptivePoller(object):
+    '''Pace a periodic poll to the activity it finds.
+
+    Polls run every `min_interval` seconds for `fast_for` seconds after a
+    `kick` and right after a poll that found something. Otherwise the interval
+    grows by a factor of `backoff` up to `max_interval`. Attributes can be
+    tuned at any time.
+
+    The polled function returns `next_delay` to the reactor:
+
+        poller = AdaptivePoller(0.05, 1.)
+        def poll():
+            return poller.next_delay(found=bool(check()))
+        poller.task = reactor.call_every(poller.min_interval, poll)
+    '''
+
+    def __init__(self, min_interval, max_interval, backoff=2., fast_for=2.):
+        if not 0 < min_interval <= max_interval:
+            raise ValueError(
+                'Poll intervals must verify 0 < min_interval <= max_interval.'
+            )
+        if backoff < 1:
+            raise ValueError('Poll backoff cannot be less than 1.')
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.fast_for = fast_for
+        self.task = None
+        self.__interval = min_interval
+        self.__fast_until = 0
+        self.__lock = RLock()
+
+    @property
+    def interval(self):
+        return self.__interval
+
+    def kick(self):
+        '''Poll right away and keep polling fast for a while.'''
+        with self.__lock:
+            self.__interval = self.min_interval
+            self.__fast_until = monotonic() + self.fast_for
+        task = self.task
+        if task is not None:
+            task.run_soon()
+
+    def next_delay(self, found=False):
+        '''Return the delay until the next poll after one that `found` some.
+        '''
+        with self.__lock:
+            if found or monotonic() < self.__fast_until:
+                self.__interval = self.min_interval
+            else:
+                self.__interval = min(
+                    self.max_interval,
+                    max(self.min_interval, self.__interval * self.backoff),
+                )
+            return self.__interval
+
+
+_shared = None
+_shared_lock = RLock()
+
+
+def shared_reactor():
+    '''Return the reactor shared by all cameras, starting it if needed.'''
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = Reactor()
+            atexit.register(_shared.stop)
+        return _shared
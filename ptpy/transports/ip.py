@@ -6,19 +6,17 @@ support more operations.
 '''
 from __future__ import absolute_import
 from ..ptp import PTPError
-from ..util import _main_thread_alive
+from ..util import as_payload, monotonic
 from construct import (
     Array, Bytes, Container, Debugger, Embedded, Enum, ExprAdapter, Int16ul,
     Int32ul, Int64ul, Int8ul, Pass, Range, RepeatUntil, Struct, Switch,
 )
-from six.moves.queue import Queue
 import six
 import sys
 import socket
 import logging
 from contextlib import contextmanager
-from threading import Thread, Event, Lock
-from time import sleep, time
+from threading import Event, Lock
 import atexit
 
 # TODO: Deal with timeouts equivalent to those in the USB transport
@@ -71,7 +69,7 @@ def create_connection(address):
 
 class IPTransport(object):
     '''Implement IP transport.'''
-    def __init__(self, device=None):
+    def __init__(self, device=None, **kwargs):
         '''Instantiate the first available PTP device over IP'''
         self.__setup_constructors()
         logger.debug('Init IP')
@@ -91,8 +89,6 @@ class IPTransport(object):
         self.__check_session_lock = Lock()
         self.__transaction_lock = Lock()
 
-        self.__event_queue = Queue()
-
         atexit.register(self._shutdown)
 
     def _shutdown(self):
@@ -101,6 +97,10 @@ class IPTransport(object):
         except Exception as e:
             logger.error(e)
 
+    def _ready(self):
+        '''PTP/IP offers no readiness probe besides events.'''
+        return None
+
     @contextmanager
     def __implicit_session(self):
         '''Manage implicit sessions with responder'''
@@ -137,22 +137,14 @@ class IPTransport(object):
 
         self.__implicit_session_open.set()
 
-        # Prepare Event and Probe threads
-        self.__event_proc = Thread(
-            name='EvtPolling',
-            target=self.__poll_events
-        )
-        self.__event_proc.daemon = False
-
-        self.__ping_pong_proc = Thread(
+        # Events are read as soon as the reactor sees them arrive.
+        self._reactor.add_reader(self.__evtcon, self.__events_ready)
+        self.__ping_pong_task = self._reactor.call_every(
+            10,
+            self.__ping_pong,
+            delay=10,
             name='PingPong',
-            target=self.__ping_pong
         )
-        self.__ping_pong_proc.daemon = False
-
-        # Launch Event and Probe threads
-        self.__event_proc.start()
-        self.__ping_pong_proc.start()
 
     def __close_implicit_session(self):
         '''Terminate implicit session with responder'''
@@ -161,11 +153,9 @@ class IPTransport(object):
         if not self.__implicit_session_open.is_set():
             return
 
-        # Only join running threads.
-        if self.__event_proc.is_alive():
-            self.__event_proc.join(2)
-        if self.__ping_pong_proc.is_alive():
-            self.__ping_pong_proc.join(2)
+        # Stop watching the connections before closing them.
+        self._reactor.remove_reader(self.__evtcon)
+        self.__ping_pong_task.cancel(timeout=2)
 
         logger.debug('Close connections for {}'.format(repr(self.__dev)))
         try:
@@ -454,8 +444,12 @@ class IPTransport(object):
         response['SessionID'] = self.session_id
         return response
 
-    def __recv(self, event=False, wait=False, raw=False):
-        '''Helper method for receiving packets.'''
+    def __recv(self, event=False, wait=False, raw=False, sink=None):
+        '''Helper method for receiving packets.
+
+        Data payloads are written to the file-like `sink` as they arrive, if
+        given.
+        '''
         hdrlen = self.__Header.sizeof()
         with self.__implicit_session():
             ip = (
@@ -475,7 +469,7 @@ class IPTransport(object):
 
                 if len(ipdata) == 0 and not event:
                     raise PTPError('Command connection dropped')
-                elif event:
+                elif len(ipdata) == 0:
                     return None
 
                 # Read a single entire header
@@ -508,17 +502,20 @@ class IPTransport(object):
                 if header.Type == 'StartData':
                     expected = response.TotalDataLength
                     current_transaction = response.TransactionID
+                    datalen = 0
                 elif (
-                        header.Type == 'Data' and
+                        header.Type in ['Data', 'EndData'] and
                         response.TransactionID == current_transaction
                 ):
-                    data += response.Data
-                elif (
+                    if sink is None:
+                        data += response.Data
+                    else:
+                        sink.write(response.Data)
+                    datalen += len(response.Data)
+                if (
                         header.Type == 'EndData' and
                         response.TransactionID == current_transaction
                 ):
-                    data += response.Data
-                    datalen = len(data)
                     if datalen != expected:
                         logger.warning(
                             '{} data than expected {}/{}'
@@ -528,7 +525,11 @@ class IPTransport(object):
                                 expected
                             )
                         )
-                    response['Data'] = data
+                    if sink is None:
+                        response['Data'] = data
+                    else:
+                        response['DataLength'] = datalen
+                        del response['Data']
                     response['Type'] = 'Data'
                     return response
 
@@ -549,49 +550,85 @@ class IPTransport(object):
         while ip.sendall(packet) is not None:
             logger.debug('Failed to send {} packet'.format(ptp_container.Type))
 
-    def __send_request(self, ptp_container):
+    def __send_request(self, ptp_container, dataphase='In'):
         '''Send PTP request without checking answer.'''
         # Don't modify original container to keep abstraction barrier.
         ptp = Container(**ptp_container)
 
         # Send unused parameters always
-        ptp['Parameter'] += [0] * (5 - len(ptp.Parameter))
+        ptp['Parameter'] = ptp.Parameter + [0] * (5 - len(ptp.Parameter))
 
         # Send request
         ptp['Type'] = 'Command'
-        ptp['DataphaseInfo'] = 'In'
+        ptp['DataphaseInfo'] = dataphase
         ptp['Payload'] = self.__Command.build(ptp)
         self.__send(ptp)
 
-    def __send_data(self, ptp_container, data):
-        '''Send data without checking answer.'''
-        # Don't modify original container to keep abstraction barrier.
-        ptp = Container(**ptp_container)
-        # Send data
-        ptp['Type'] = 'Data'
-        ptp['DataphaseInfo'] = 'Out'
-        ptp['Payload'] = data
-        self.__send(ptp)
+    def __send_data(self, ptp_container, payload):
+        '''Stream a dataphase without checking answer.
+
+        StartData announces the length, each chunk goes in a Data packet and
+        the last one in an EndData packet.
+        '''
+        transaction_id = ptp_container.TransactionID
+        self.__send(Container(
+            Type='StartData',
+            Payload=self.__StartData.build(Container(
+                TransactionID=transaction_id,
+                TotalDataLength=payload.size,
+            )),
+        ))
+        ip = actual_socket(self.__cmdcon)
+        previous = None
+        # Up to 1MB per packet
+        for chunk in payload.chunks(2**20):
+            if previous is not None:
+                self.__send_chunk(ip, 'Data', transaction_id, previous)
+                payload.advance(len(previous))
+            previous = chunk
+        self.__send_chunk(ip, 'EndData', transaction_id, previous or b'')
+        payload.advance(len(previous or b''))
+
+    def __send_chunk(self, ip, packet_type, transaction_id, chunk):
+        header = self.__Header.build(Container(
+            Length=(
+                self.__Header.sizeof() +
+                self._TransactionID.sizeof() +
+                len(chunk)
+            ),
+            Type=packet_type,
+        ))
+        # Send the chunk on its own to avoid copying it.
+        ip.sendall(header + self._TransactionID.build(transaction_id))
+        ip.sendall(chunk)
 
     # Actual implementation
     # ---------------------
     def send(self, ptp_container, data):
-        '''Transfer operation with dataphase from initiator to responder'''
+        '''Transfer operation with dataphase from initiator to responder
+
+        The `data` can be bytes, a file, an mmap or a `Payload`.
+        '''
         logger.debug('SEND {}{}'.format(
             ptp_container.OperationCode,
             ' ' + str(list(map(hex, ptp_container.Parameter)))
             if ptp_container.Parameter else '',
         ))
+        data = as_payload(data)
         with self.__implicit_session():
             with self.__transaction_lock:
-                self.__send_request(ptp_container)
+                self.__send_request(ptp_container, dataphase='Out')
                 self.__send_data(ptp_container, data)
                 # Get response and sneak in implicit SessionID and missing
                 # parameters.
                 return self.__recv()
 
-    def recv(self, ptp_container):
-        '''Transfer operation with dataphase from responder to initiator.'''
+    def recv(self, ptp_container, sink=None):
+        '''Transfer operation with dataphase from responder to initiator.
+
+        The data is written to the file-like `sink` as it arrives, if given,
+        and only its `DataLength` is returned.
+        '''
         logger.debug('RECV {}{}'.format(
             ptp_container.OperationCode,
             ' ' + str(list(map(hex, ptp_container.Parameter)))
@@ -600,8 +637,11 @@ class IPTransport(object):
         with self.__implicit_session():
             with self.__transaction_lock:
                 self.__send_request(ptp_container)
-                dataphase = self.__recv()
-                if hasattr(dataphase, 'Data'):
+                dataphase = self.__recv(sink=sink)
+                if (
+                        hasattr(dataphase, 'Data') or
+                        hasattr(dataphase, 'DataLength')
+                ):
                     response = self.__recv()
                     if (
                             (ptp_container.TransactionID != dataphase.TransactionID) or
@@ -612,7 +652,10 @@ class IPTransport(object):
                         raise PTPError(
                             'Dataphase does not match with requested operation'
                         )
-                    response['Data'] = dataphase.Data
+                    if sink is None:
+                        response['Data'] = dataphase.Data
+                    else:
+                        response['DataLength'] = dataphase.DataLength
                     return response
                 else:
                     return dataphase
@@ -640,54 +683,73 @@ class IPTransport(object):
 
         return response
 
-    def event(self, wait=False):
-        '''Check event.
+    def __events_ready(self):
+        '''Hand a readable event connection over to the camera worker.
 
-        If `wait` this function is blocking. Otherwise it may return None.
+        Reading a whole event may block, which the reactor thread must not.
         '''
-        evt = None
-        ipdata = None
-        timeout = None if wait else 0.001
-        if not self.__event_queue.empty():
-            ipdata = self.__event_queue.get(block=not wait, timeout=timeout)
-        if ipdata is not None:
-            evt = self.__parse_response(ipdata)
-
-        return evt
+        self._reactor.remove_reader(self.__evtcon)
+        self._reactor.call_later(
+            0,
+            self.__poll_events,
+            blocking=True,
+            name='IPEvtPolling',
+            group=self,
+        )
 
     def __poll_events(self):
-        '''Poll events, adding them to a queue.'''
-        logger.debug('Start')
-        while (
+        '''Read an available event, adding it to the event stream.
+
+        Return a delay to try again later, or None once the reactor watches
+        the event connection again.
+        '''
+        if (
+                self.__implicit_session_shutdown.is_set() or
+                not self.__implicit_session_open.is_set()
+        ):
+            return
+        if not self.event_stream.accepting:
+            # Leave events in the socket until the consumer catches up.
+            return 0.05
+        try:
+            evt = self.__recv(event=True, wait=False, raw=True)
+            received_at = monotonic()
+        except Exception as e:
+            if (
+                    getattr(e, 'errno', None) == 9 and
+                    not self.__implicit_session_open.is_set()
+            ):
+                return
+            # Keep watching the connection, or events would stop for good.
+            logger.error('Event polling exception: {}'.format(e))
+            self.__resume_events()
+            return
+        if evt is None:
+            # The event connection was closed by the responder.
+            logger.debug('Event connection dropped')
+            return
+        logger.debug('Event received')
+        try:
+            self._event_received(
+                self.__parse_response(evt), 'IP', received_at
+            )
+        finally:
+            self.__resume_events()
+
+    def __resume_events(self):
+        if (
                 not self.__implicit_session_shutdown.is_set() and
-                self.__implicit_session_open.is_set() and
-                _main_thread_alive()
+                self.__implicit_session_open.is_set()
         ):
-            try:
-                evt = self.__recv(event=True, wait=False, raw=True)
-            except OSError as e:
-                if e.errno == 9 and not self.__implicit_session_open.is_set():
-                    break
-                else:
-                    raise e
-            if evt is not None:
-                logger.debug('Event queued')
-                self.__event_queue.put(evt)
-            sleep(5e-3)
-        logger.debug('Stop')
+            self._reactor.add_reader(self.__evtcon, self.__events_ready)
 
     def __ping_pong(self):
-        '''Poll events, adding them to a queue.'''
-        logger.debug('Start')
-        last = time()
-        while (
-                not self.__implicit_session_shutdown.is_set() and
-                self.__implicit_session_open.is_set() and
-                _main_thread_alive()
+        '''Keep the connection alive.'''
+        if (
+                self.__implicit_session_shutdown.is_set() or
+                not self.__implicit_session_open.is_set()
         ):
-            if time() - last > 10:
-                logger.debug('PING')
-                # TODO: implement Ping Pong
-                last = time()
-            sleep(0.10)
-        logger.debug('Stop')
+            self.__ping_pong_task.cancel()
+            return
+        logger.debug('PING')
+        # TODO: implement Ping Pong
@@ -15,13 +15,14 @@ from usb.util import (
     ENDPOINT_OUT, ENDPOINT_IN,
 )
 from ..ptp import PTPError
-from ..util import _main_thread_alive
+from ..reactor import AdaptivePoller
+from ..util import as_payload, monotonic
 from construct import (
     Bytes, Container, Embedded, Enum, ExprAdapter, Int16ul, Int32ul, Pass,
     Range, Struct,
 )
-from threading import Thread, Event, RLock
-from six.moves.queue import Queue
+from contextlib import contextmanager
+from threading import Event, RLock
 from hexdump import hexdump
 
 logger = logging.getLogger(__name__)
@@ -32,6 +33,11 @@ __author__ = 'Luis Mario Domenzain'
 
 PTP_USB_CLASS = 6
 
+# When to reset the device after claiming it. Resetting forces a
+# re-enumeration which costs seconds, but recovers devices left in a bad state,
+# e.g. by a process that died mid-transaction.
+RESET_POLICIES = ('always', 'never', 'on_failure')
+
 
 class find_class(object):
     def __init__(self, class_, name=None):
@@ -67,8 +73,29 @@ def find_usb_cameras(name=None):
 class USBTransport(object):
     '''Implement USB transport.'''
     def __init__(self, *args, **kwargs):
+        '''Instantiate the first available PTP device over USB
+
+        The `reset_policy` decides whether the device is reset after being
+        claimed: `'always'` (default), `'never'` or `'on_failure'` of a
+        GetDeviceInfo health check answered within `health_timeout` ms.
+        '''
         device = kwargs.get('device', None)
-        '''Instantiate the first available PTP device over USB'''
+        self.__reset_policy = kwargs.get('reset_policy', 'always')
+        self.__health_timeout = kwargs.get('health_timeout', 500)
+        # The interrupt endpoint is polled by the reactor with a short read
+        # `event_timeout` (ms) every `event_interval` (s) after operations
+        # that trigger events, backing off to `event_max_interval` (s) while
+        # idle.
+        self.__event_timeout = kwargs.get('event_timeout', 5)
+        self.__event_poller = AdaptivePoller(
+            kwargs.get('event_interval', 0.01),
+            kwargs.get('event_max_interval', 0.2),
+        )
+        if self.__reset_policy not in RESET_POLICIES:
+            raise ValueError(
+                'Unknown reset policy {}. Use one of {}.'
+                .format(self.__reset_policy, RESET_POLICIES)
+            )
         logger.debug('Init USB')
         self.__setup_constructors()
         # If no device is specified, find all devices claiming to be Cameras
@@ -89,10 +116,8 @@ class USBTransport(object):
             else find_usb_cameras(name=name)
         )
         self.__claimed = False
-        self.__acquire_camera(devs)
-
-        self.__event_queue = Queue()
-        self.__event_shutdown = Event()
+        # Cleared once the device turns out not to answer Get Device Status.
+        self.__device_status = True
         # Locks for different end points.
         self.__inep_lock = RLock()
         self.__intep_lock = RLock()
@@ -100,14 +125,23 @@ class USBTransport(object):
         # Slightly redundant transaction lock to avoid catching other request's
         # response
         self.__transaction_lock = RLock()
+        self.__acquire_camera(devs)
 
-        self.__event_proc = Thread(
+        self.__event_shutdown = Event()
+        self.__disconnected = Event()
+
+        # Blocking on the interrupt endpoint is left to the camera worker of
+        # the reactor.
+        self.__event_task = self._reactor.call_every(
+            self.__event_poller.min_interval,
+            self.__poll_events,
+            blocking=True,
             name='EvtPolling',
-            target=self.__poll_events
+            group=self,
         )
-        self.__event_proc.daemon = False
+        self.__event_poller.task = self.__event_task
+        self._add_poller(self.__event_poller)
         atexit.register(self._shutdown)
-        self.__event_proc.start()
 
     def __available_cameras(self, devs):
         for dev in devs:
@@ -146,7 +180,13 @@ class USBTransport(object):
             except Exception as e:
                 logger.warn('Failed to claim PTP device: {}'.format(e))
                 continue
-            self.__dev.reset()
+            if self.__reset_policy == 'always':
+                self.__dev.reset()
+            elif self.__reset_policy == 'on_failure' and not self._healthy():
+                logger.info(
+                    'Resetting unresponsive {}'.format(repr(self.__dev))
+                )
+                self.__dev.reset()
             break
         else:
             message = (
@@ -160,9 +200,8 @@ class USBTransport(object):
         self.__event_shutdown.set()
         # Free USB resource on shutdown.
 
-        # Only join a running thread.
-        if self.__event_proc.is_alive():
-            self.__event_proc.join(2)
+        # Only wait for a running poll.
+        self.__event_task.cancel(timeout=2)
 
         try:
             if self.__claimed:
@@ -171,6 +210,69 @@ class USBTransport(object):
         except Exception as e:
             logger.warn(e)
 
+    @contextmanager
+    def __timeout(self, timeout):
+        '''Temporarily use `timeout` ms for all transfers.'''
+        previous = self.__dev.default_timeout
+        self.__dev.default_timeout = timeout
+        try:
+            yield
+        finally:
+            self.__dev.default_timeout = previous
+
+    def _healthy(self, timeout=None):
+        '''Whether the device answers GetDeviceInfo promptly.
+
+        This is meant to be cheap enough to decide if a device needs a reset
+        and works outside of sessions. `timeout` is in milliseconds.
+        '''
+        ptp = Container(
+            OperationCode='GetDeviceInfo',
+            SessionID=0,
+            TransactionID=0,
+            Parameter=[]
+        )
+        timeout = self.__health_timeout if timeout is None else timeout
+        try:
+            with self.__transaction_lock, self.__timeout(timeout):
+                self.__send_request(ptp)
+                response = self.__recv()
+                if hasattr(response, 'Data'):
+                    response = self.__recv()
+        except Exception as e:
+            logger.debug('Health check failed: {}'.format(e))
+            return False
+        return (
+            getattr(response, 'ResponseCode', None) == 'OK' and
+            response.TransactionID == 0
+        )
+
+    def _ready(self):
+        '''Whether the device is ready according to Get Device Status.
+
+        This still image class request goes through the control endpoint, so
+        it can be sent while an operation is pending. Return None when the
+        device does not implement it.
+        '''
+        if not self.__device_status:
+            return None
+        try:
+            status = self.__dev.ctrl_transfer(
+                0xA1, 0x67, 0, self.__intf.bInterfaceNumber, 20
+            )
+        except usb.core.USBError as e:
+            logger.debug('No Get Device Status: {}'.format(e))
+            self.__device_status = False
+            return None
+        if len(status) < 4:
+            return None
+        code = status[2] | status[3] << 8
+        if code == 0x2001:
+            return True
+        if code == 0x2019:
+            return False
+        return None
+
     # Helper methods.
     # ---------------------
     def __setup_device(self, dev):
@@ -319,8 +421,27 @@ class USBTransport(object):
             response['Data'] = transaction.Payload
         return response
 
-    def __recv(self, event=False, wait=False, raw=False):
-        '''Helper method for receiving data.'''
+    def __parse_data(self, usbdata):
+        '''Parse a dataphase whose length is not in its header.'''
+        size = self.__Header.sizeof()
+        command = self.__CommandHeader.parse(bytearray(usbdata[0:size]))
+        payload = usbdata[size:]
+        return Container(
+            SessionID=self.session_id,
+            TransactionID=command.TransactionID,
+            OperationCode=command.OperationCode,
+            Data=payload.tobytes() if six.PY3 else payload.tostring(),
+        )
+
+    def __recv(
+            self, event=False, wait=False, raw=False, timeout=None, sink=None
+    ):
+        '''Helper method for receiving data.
+
+        The `timeout` in milliseconds applies to reading the header. Data
+        payloads are written to the file-like `sink` as they are read, if
+        given.
+        '''
         # TODO: clear stalls automatically
         ep = self.__intep if event else self.__inep
         lock = self.__intep_lock if event else self.__inep_lock
@@ -337,7 +458,8 @@ class USBTransport(object):
                     )
                 try:
                     usbdata += ep.read(
-                        ep.wMaxPacketSize
+                        ep.wMaxPacketSize,
+                        timeout,
                     )
                 except usb.core.USBError as e:
                     # Return None on timeout or busy for events
@@ -383,42 +505,98 @@ class USBTransport(object):
                     'Expected Response, Event or Data but received {}'
                     .format(header.Type)
                 )
-            while len(usbdata) < header.Length:
-                usbdata += ep.read(
-                    min(
-                        header.Length - len(usbdata),
-                        # Up to 64kB
-                        64 * 2**10
+            if header.Type == 'Data' and sink is not None:
+                return self.__stream_data(ep, header, usbdata, sink)
+            if header.Length == 0xFFFFFFFF:
+                # Dataphases over 4GB have an unknown length and end with a
+                # short packet.
+                short = len(usbdata) % ep.wMaxPacketSize != 0
+                while not short:
+                    chunk = ep.read(64 * 2**10)
+                    usbdata += chunk
+                    short = len(chunk) < 64 * 2**10
+            else:
+                while len(usbdata) < header.Length:
+                    usbdata += ep.read(
+                        min(
+                            header.Length - len(usbdata),
+                            # Up to 64kB
+                            64 * 2**10
+                        )
                     )
-                )
         if raw:
             return usbdata
+        elif header.Length == 0xFFFFFFFF:
+            return self.__parse_data(usbdata)
         else:
             return self.__parse_response(usbdata)
 
+    def __stream_data(self, ep, header, usbdata, sink):
+        '''Write a dataphase to `sink` chunk by chunk, as it is read.
+
+        Return the dataphase with its `DataLength` instead of its `Data`.
+        '''
+        size = self.__Header.sizeof()
+        command = self.__CommandHeader.parse(bytearray(usbdata[0:size]))
+        chunk = usbdata[size:]
+        received = len(usbdata)
+        read, wanted = received, ep.wMaxPacketSize
+        written = 0
+        while True:
+            sink.write(chunk)
+            written += len(chunk)
+            if header.Length == 0xFFFFFFFF:
+                # Dataphases over 4GB have an unknown length and end with a
+                # short packet.
+                if read < wanted or read % ep.wMaxPacketSize != 0:
+                    break
+                wanted = 64 * 2**10
+            elif received < header.Length:
+                # Up to 64kB
+                wanted = min(header.Length - received, 64 * 2**10)
+            else:
+                break
+            chunk = ep.read(wanted)
+            read = len(chunk)
+            received += read
+        return Container(
+            SessionID=self.session_id,
+            TransactionID=command.TransactionID,
+            OperationCode=command.OperationCode,
+            DataLength=written,
+        )
+
     def __send(self, ptp_container, event=False):
         '''Helper method for sending data.'''
         ep = self.__intep if event else self.__outep
         lock = self.__intep_lock if event else self.__outep_lock
         transaction = self.__CommandTransaction.build(ptp_container)
         with lock:
+            self.__write(ep, transaction)
+
+    def __write(self, ep, chunk):
+        '''Write a chunk, retrying once if the device is busy.'''
+        if isinstance(chunk, memoryview):
+            # PyUSB only copies bytes efficiently.
+            chunk = chunk.tobytes()
+        sent = 0
+        retried = False
+        while sent < len(chunk):
             try:
-                sent = 0
-                while sent < len(transaction):
-                    sent = ep.write(
-                        # Up to 64kB
-                        transaction[sent:(sent + 64*2**10)]
-                    )
+                sent += ep.write(chunk[sent:])
             except usb.core.USBError as e:
-                # Ignore timeout or busy device once.
-                if (
+                # Retry timeout or busy device once.
+                if not retried and (
                         (e.errno is None and
                          ('timeout' in e.strerror.decode() or
                           'busy' in e.strerror.decode())) or
                         (e.errno == 110 or e.errno == 16 or e.errno == 5)
                 ):
                     logger.warning('Ignored USBError {}'.format(e.errno))
-                    ep.write(transaction)
+                    retried = True
+                    continue
+                logger.error(e)
+                raise e
 
     def __send_request(self, ptp_container):
         '''Send PTP request without checking answer.'''
@@ -439,14 +617,28 @@ class USBTransport(object):
         ptp['Payload'] = self.__Param.build(ptp.Parameter)
         self.__send(ptp)
 
-    def __send_data(self, ptp_container, data):
-        '''Send data without checking answer.'''
-        # Don't modify original container to keep abstraction barrier.
-        ptp = Container(**ptp_container)
-        # Send data
-        ptp['Type'] = 'Data'
-        ptp['Payload'] = data
-        self.__send(ptp)
+    def __send_data(self, ptp_container, payload):
+        '''Stream a dataphase without checking answer.
+
+        The header goes out with the first chunk, since a short packet would
+        end the transfer. Dataphases over 4GB have an unknown length.
+
+        The OUT endpoint is only held while a chunk is written, so progress
+        callbacks, which may throttle the transfer, run between chunks.
+        '''
+        header = self.__CommandHeader.build(Container(
+            Length=min(self.__Header.sizeof() + payload.size, 0xFFFFFFFF),
+            Type='Data',
+            OperationCode=ptp_container.OperationCode,
+            TransactionID=ptp_container.TransactionID,
+        ))
+        prefix = len(header)
+        # Up to 64kB
+        for chunk in payload.chunks(64 * 2**10, prefix=header):
+            with self.__outep_lock:
+                self.__write(self.__outep, chunk)
+            payload.advance(len(chunk) - prefix)
+            prefix = 0
 
     @property
     def _dev(self):
@@ -456,10 +648,19 @@ class USBTransport(object):
     def _dev(self, value):
         raise ValueError('Read-only property')
 
+    @property
+    def _disconnected(self):
+        '''Whether the device was unplugged while in use.'''
+        return self.__disconnected.is_set()
+
     # Actual implementation
     # ---------------------
     def send(self, ptp_container, data):
-        '''Transfer operation with dataphase from initiator to responder'''
+        '''Transfer operation with dataphase from initiator to responder
+
+        The `data` can be bytes, a file, an mmap or a `Payload`.
+        '''
+        data = as_payload(data)
         datalen = len(data)
         logger.debug('SEND {} {} bytes{}'.format(
             ptp_container.OperationCode,
@@ -482,8 +683,12 @@ class USBTransport(object):
         ))
         return response
 
-    def recv(self, ptp_container):
-        '''Transfer operation with dataphase from responder to initiator.'''
+    def recv(self, ptp_container, sink=None):
+        '''Transfer operation with dataphase from responder to initiator.
+
+        The data is written to the file-like `sink` as it arrives, if given,
+        and only its `DataLength` is returned.
+        '''
         logger.debug('RECV {}{}'.format(
             ptp_container.OperationCode,
             ' ' + str(list(map(hex, ptp_container.Parameter)))
@@ -491,8 +696,8 @@ class USBTransport(object):
         ))
         with self.__transaction_lock:
             self.__send_request(ptp_container)
-            dataphase = self.__recv()
-            if hasattr(dataphase, 'Data'):
+            dataphase = self.__recv(sink=sink)
+            if hasattr(dataphase, 'Data') or hasattr(dataphase, 'DataLength'):
                 response = self.__recv()
                 if not (ptp_container.SessionID ==
                         dataphase.SessionID ==
@@ -529,7 +734,10 @@ class USBTransport(object):
                         )
                     )
 
-                response['Data'] = dataphase.Data
+                if sink is None:
+                    response['Data'] = dataphase.Data
+                else:
+                    response['DataLength'] = dataphase.DataLength
             else:
                 response = dataphase
 
@@ -563,39 +771,43 @@ class USBTransport(object):
         ))
         return response
 
-    def event(self, wait=False):
-        '''Check event.
+    def __poll_events(self):
+        '''Poll one event, adding it to the event stream.
 
-        If `wait` this function is blocking. Otherwise it may return None.
+        Poll again right away after an event, since more may be pending, and
+        back off while there are none.
         '''
-        evt = None
-        usbdata = None
-        if wait:
-            usbdata = self.__event_queue.get(block=True)
-        elif not self.__event_queue.empty():
-            usbdata = self.__event_queue.get(block=False)
-
-        if usbdata is not None:
-            evt = self.__parse_response(usbdata)
-
-        return evt
-
-    def __poll_events(self):
-        '''Poll events, adding them to a queue.'''
-        while not self.__event_shutdown.is_set() and _main_thread_alive():
-            try:
-                evt = self.__recv(event=True, wait=False, raw=True)
-                if evt is not None:
-                    logger.debug('Event queued')
-                    self.__event_queue.put(evt)
-            except usb.core.USBError as e:
-                logger.error(
-                    '{} polling exception: {}'.format(repr(self.__dev), e)
-                )
-                # check if disconnected
-                if e.errno == 19:
-                    break
-            except Exception as e:
-                logger.error(
-                    '{} polling exception: {}'.format(repr(self.__dev), e)
-                )
+        if self.__event_shutdown.is_set():
+            self.__event_task.cancel()
+            return
+        if not self.event_stream.accepting:
+            # Leave events on the camera until the consumer catches up.
+            return self.__event_poller.next_delay()
+        try:
+            evt = self.__recv(
+                event=True,
+                wait=False,
+                raw=True,
+                timeout=self.__event_timeout,
+            )
+            received_at = monotonic()
+        except usb.core.USBError as e:
+            logger.error(
+                '{} polling exception: {}'.format(repr(self.__dev), e)
+            )
+            # check if disconnected
+            if e.errno == 19:
+                self.__disconnected.set()
+                self.__event_task.cancel()
+            return self.__event_poller.next_delay()
+        except Exception as e:
+            logger.error(
+                '{} polling exception: {}'.format(repr(self.__dev), e)
+            )
+            return self.__event_poller.next_delay()
+        if evt is None:
+            return self.__event_poller.next_delay()
+        logger.debug('Event received')
+        self._event_received(self.__parse_response(evt), 'USB', received_at)
+        self.__event_poller.next_delay(found=True)
+        return 0
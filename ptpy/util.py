@@ -1,8 +1,142 @@
 '''This module holds general utilities'''
-from threading import enumerate as threading_enumerate
+import os
 
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock in the standard library.
+    from time import time as monotonic
+
+# Prefixes of `struct` formats for each PTP endianness.
+BYTE_ORDER = {'little': '<', 'big': '>', 'native': '='}
+
+
+class Payload(object):
+    '''Dataphase sent in chunks from bytes, a file, an mmap or an iterator.
+
+    Only about one chunk is held in memory at a time. The `size` of buffers
+    and seekable files is found when not given. Iterators of chunks need it,
+    since it is sent before the data. `progress(sent, size)` is called as
+    chunks are written:
+
+        camera.send_object(Payload(open('IMG_0001.JPG', 'rb'), progress=log))
+    '''
+
+    def __init__(self, data, size=None, progress=None):
+        self.data = data
+        self.progress = progress
+        self.__view = None
+        self.__start = None
+        self.__sent = 0
+        try:
+            self.__view = memoryview(data)
+        except TypeError:
+            pass
+        if self.__view is not None:
+            size = len(self.__view) if size is None else size
+        elif hasattr(data, 'read'):
+            try:
+                self.__start = data.tell()
+                if size is None:
+                    data.seek(0, 2)
+                    size = data.tell() - self.__start
+                    data.seek(self.__start)
+            except (AttributeError, IOError, OSError, ValueError):
+                # Pipes and sockets cannot be measured nor rewound.
+                self.__start = None
+        if size is None:
+            raise ValueError('The size of streamed payloads must be given.')
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def replayable(self):
+        '''Whether the payload can be sent again.'''
+        return (
+            self.__sent == 0 or
+            self.__view is not None or
+            self.__start is not None
+        )
+
+    def chunks(self, chunk_size, prefix=b''):
+        '''Yield the payload after `prefix` in chunks of `chunk_size` bytes.
+
+        Every chunk but the last has exactly `chunk_size` bytes, so they can
+        be aligned to packets. Report sent bytes with `advance`.
+        '''
+        if not self.replayable:
+            raise ValueError('Streamed payloads can only be sent once.')
+        self.__sent = 0
+        pending = bytearray(prefix)
+        remaining = self.size
+        for piece in self.__pieces(chunk_size - len(prefix), chunk_size):
+            if len(piece) > remaining:
+                raise ValueError('Payload longer than {}.'.format(self.size))
+            remaining -= len(piece)
+            if not pending and len(piece) == chunk_size:
+                yield piece
+                continue
+            pending += piece
+            while len(pending) >= chunk_size:
+                chunk = bytes(pending[:chunk_size])
+                del pending[:chunk_size]
+                yield chunk
+        if remaining:
+            raise ValueError(
+                'Payload shorter than {} by {}.'.format(self.size, remaining)
+            )
+        if pending or not self.size:
+            yield bytes(pending)
+
+    def advance(self, count):
+        '''Account for `count` bytes of the payload being sent.'''
+        self.__sent += count
+        if self.progress is not None:
+            self.progress(self.__sent, self.size)
+
+    def __pieces(self, first, chunk_size):
+        if self.__view is not None:
+            view = self.__view[:self.size]
+            offset = 0
+            while offset < len(view):
+                size = first if offset == 0 else chunk_size
+                yield view[offset:offset + size]
+                offset += size
+        elif hasattr(self.data, 'read'):
+            if self.__start is not None:
+                self.data.seek(self.__start)
+            size = first
+            while True:
+                piece = self.data.read(size)
+                if not piece:
+                    return
+                yield piece
+                size = chunk_size
+        else:
+            for piece in self.data:
+                yield piece
+
+
+def as_payload(data, size=None, progress=None):
+    '''Wrap `data` in a `Payload` unless it already is one.'''
+    if isinstance(data, Payload):
+        if progress is not None:
+            data.progress = progress
+        return data
+    return Payload(data, size=size, progress=progress)
+
+
+def object_filename(name, handle):
+    '''Return a file name for an object, from the `name` the camera gave.
+
+    Directories are dropped, so objects cannot be written outside of the
+    download directory. Objects without a usable name are named after their
+    `handle`.
+    '''
+    name = os.path.basename((name or '').replace('\\', '/'))
+    if name in ('', '.', '..'):
+        name = 'IMG_{:08X}'.format(handle)
+    return name
 
-def _main_thread_alive():
-    return any(
-        (i.name == "MainThread") and i.is_alive() for i in
-        threading_enumerate())
@@ -0,0 +1,138 @@
+'''Fake PyUSB device answering PTP containers, for transport tests.'''
+from collections import deque
+from construct import Int32ul, Range
+from threading import Lock
+import array
+import pytest
+import struct
+import usb.core
+
+try:
+    Range(0, 5, Int32ul).build([])
+    RANGE_BUILD = True
+except AttributeError:
+    # construct 2.8 looks for collections.Sequence, gone from Python 3.10.
+    RANGE_BUILD = False
+
+requires_range_build = pytest.mark.skipif(
+    not RANGE_BUILD, reason='This construct cannot build PTP parameters.'
+)
+
+HEADER = struct.Struct('<IHHI')
+COMMAND, DATA, RESPONSE, EVENT = 1, 2, 3, 4
+
+
+def container(kind, code, transaction_id, payload=b'', length=None):
+    '''Build a USB PTP container, with an explicit `length` if given.'''
+    if length is None:
+        length = HEADER.size + len(payload)
+    return HEADER.pack(length, kind, code, transaction_id) + payload
+
+
+def response(code, transaction_id, *parameters):
+    return container(
+        RESPONSE,
+        code,
+        transaction_id,
+        struct.pack('<{}I'.format(len(parameters)), *parameters),
+    )
+
+
+class FakeEndpoint(object):
+    def __init__(self, address, attributes, packet=512):
+        self.bEndpointAddress = address
+        self.bmAttributes = attributes
+        self.wMaxPacketSize = packet
+        self.transfers = deque()
+        self.written = []
+        self.__lock = Lock()
+        self.on_write = None
+
+    def read(self, size, timeout=None):
+        with self.__lock:
+            if not self.transfers:
+                raise usb.core.USBError('Operation timed out', errno=110)
+            transfer = self.transfers[0]
+            data = transfer['data'][:size]
+            del transfer['data'][:size]
+            if not transfer['data']:
+                # Transfers of whole packets end with a zero length packet.
+                if transfer['zlp'] and data:
+                    transfer['zlp'] = False
+                else:
+                    self.transfers.popleft()
+            return array.array('B', data)
+
+    def write(self, data, timeout=None):
+        data = bytes(data)
+        self.written.append(data)
+        if self.on_write is not None:
+            self.on_write(data)
+        return len(data)
+
+    def queue(self, data):
+        with self.__lock:
+            self.transfers.append({
+                'data': bytearray(data),
+                'zlp': len(data) % self.wMaxPacketSize == 0,
+            })
+
+
+class FakeInterface(list):
+    bInterfaceClass = 6
+    bInterfaceNumber = 0
+
+
+class FakeContext(object):
+    '''Stand in for the PyUSB context claiming interfaces.'''
+
+    def managed_claim_interface(self, device, interface):
+        pass
+
+    def managed_release_interface(self, device, interface):
+        pass
+
+
+class FakeUSBDevice(object):
+    '''PTP device calling `responder(code, transaction_id, parameters)`.
+
+    The responder returns the transfers to queue on the bulk IN endpoint.
+    Without one, commands are never answered.
+    '''
+
+    def __init__(self, responder=None):
+        self.responder = responder
+        self.resets = 0
+        self.commands = []
+        self.default_timeout = 1000
+        self._ctx = FakeContext()
+        self.inep = FakeEndpoint(0x81, 2)
+        self.outep = FakeEndpoint(0x02, 2)
+        self.intep = FakeEndpoint(0x83, 3)
+        self.outep.on_write = self.__command
+        self.interface = FakeInterface([self.inep, self.outep, self.intep])
+
+    def __iter__(self):
+        return iter([[self.interface]])
+
+    def is_kernel_driver_active(self, interface):
+        return False
+
+    def reset(self):
+        self.resets += 1
+
+    def ctrl_transfer(self, *args):
+        raise usb.core.USBError('Pipe error', errno=32)
+
+    def __command(self, data):
+        length, kind, code, transaction_id = HEADER.unpack_from(data)
+        if kind != COMMAND:
+            return
+        count = (length - HEADER.size) // 4
+        parameters = list(
+            struct.unpack_from('<{}I'.format(count), data, HEADER.size)
+        )
+        self.commands.append((code, transaction_id, parameters))
+        if self.responder is not None:
+            for transfer in self.responder(code, transaction_id, parameters):
+                self.inep.queue(transfer)
@@ -1,4 +1,5 @@
 #! /usr/bin/env python
+from ptpy.busy import BusyPolicy
 from time import sleep, time
 from .test_sequoia import TestSequoia
 import pytest
@@ -11,77 +12,48 @@ number_of_cameras = 5
 # TODO: Put this function in a separate module of test helpers.
 def initiate_capture(sequoia):
     '''Initiate capture.'''
-    capture_response = sequoia.initiate_capture()
-    # If the device is doing something else, try again ten times waiting a
-    # second.
-    tries = 0
-    while capture_response.ResponseCode != 'OK' and tries < 10:
-        tries += 1
-        sleep(1)
+    # If the device is doing something else, retry for up to ten seconds.
+    policy = sequoia.busy_policy
+    sequoia.busy_policy = policy or BusyPolicy(timeout=10)
+    try:
         capture_response = sequoia.initiate_capture()
+    finally:
+        sequoia.busy_policy = policy
     if capture_response.ResponseCode != 'OK':
         print(capture_response)
         assert capture_response.ResponseCode == 'OK', \
-            'Could not initiate capture after 10 tries.'
+            'Could not initiate capture within 10 seconds.'
     return capture_response
 
 
 def set_valid_mask(sequoia, mask):
     '''Set PhotoSensorEnableMask. Return false when invalid.'''
-    enable_response = sequoia.set_device_prop_value(
-        'PhotoSensorEnableMask',
-        sequoia._UInt32.build(mask)
-    )
+    result = sequoia.apply_sensor_configuration(mask)
     # If the combination of enabled cameras is invalid, skip it.
-    if enable_response.ResponseCode == 'InvalidDevicePropValue':
+    if result.ResponseCode == 'InvalidDevicePropValue':
         return False
-    # If the device is busy, try again ten times waiting a second.
-    tries = 0
-    while enable_response.ResponseCode != 'OK' and tries < 10:
-        tries += 1
-        sleep(1)
-        enable_response = sequoia.set_device_prop_value(
-            'PhotoSensorEnableMask',
-            sequoia._UInt32.build(mask)
-        )
-    if enable_response.ResponseCode != 'OK':
-        print(enable_response)
-        assert enable_response.ResponseCode == 'OK', \
-            'Could not set PhotoSensorEnableMask {}'.format(bin(mask))
+    assert result.ResponseCode == 'OK', \
+        'Could not set PhotoSensorEnableMask {}'.format(bin(mask))
     return True
 
 
 def set_keep_on(sequoia, mask):
     '''Turn masked sensors on'''
-    set_valid_mask(sequoia, mask)
-    tries = 0
+    result = sequoia.apply_sensor_configuration(mask, keep_on=True)
+    assert result.ResponseCode == 'OK', \
+        'Could not turn sensors on: {}'.format(result.ResponseCode)
     keep_on = sequoia.get_device_prop_desc('PhotoSensorsKeepOn')
-    while keep_on.CurrentValue != 1 and tries < 10:
-        tries += 1
-        sleep(1)
-        sequoia.set_device_prop_value(
-            'PhotoSensorsKeepOn',
-            sequoia._UInt32.build(1)
-        )
-        keep_on = sequoia.get_device_prop_desc('PhotoSensorsKeepOn')
-    assert keep_on.CurrentValue == 1, \
-        'Could not turn sensors on after 10 tries (10 s).'
+    assert keep_on.CurrentValue == 1, 'Sensors were not kept on.'
 
 
 def unset_keep_on(sequoia):
-    '''Turn masked sensors on'''
-    tries = 0
+    '''Turn masked sensors off'''
+    mask = sequoia.get_device_prop_desc('PhotoSensorEnableMask').CurrentValue
+    result = sequoia.apply_sensor_configuration(mask, keep_on=False)
+    assert result.ResponseCode == 'OK', \
+        'Could not turn sensors off: {}'.format(result.ResponseCode)
     keep_on = sequoia.get_device_prop_desc('PhotoSensorsKeepOn')
-    while keep_on.CurrentValue != 0 and tries < 10:
-        tries += 1
-        sleep(1)
-        sequoia.set_device_prop_value(
-            'PhotoSensorsKeepOn',
-            sequoia._UInt32.build(0)
-        )
-        keep_on = sequoia.get_device_prop_desc('PhotoSensorsKeepOn')
-    assert keep_on.CurrentValue == 0, \
-        'Could not turn sensors off after 10 tries (10 s).'
+    assert keep_on.CurrentValue == 0, 'Sensors were not turned off.'
 
 
 class TestSequoiaEnableCapture(TestSequoia):
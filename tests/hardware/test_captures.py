@@ -1,4 +1,4 @@
-from time import time
+from time import sleep
 from .test_camera import TestCamera
 import pytest
 
@@ -10,21 +10,22 @@ class TestCapture(TestCamera):
             pytest.skip('InitiateCapture is not supported by camera.')
 
         with camera.session():
-            tic = time()
-            print('Clearing all events (10s)')
-            while time() - tic < 10:
-                evt = camera.event()
             print('Initiating capture')
             capture = camera.initiate_capture()
             codes = []
-            tic = time()
+            subscription = camera.subscribe(
+                lambda evt: codes.append(evt.EventCode),
+                transaction_id=capture.TransactionID,
+            )
             print('Waiting for capture events (10s)')
-            while time() - tic < 10:
-                evt = camera.event()
-                if evt:
-                    print(evt)
-                    if evt.TransactionID == capture.TransactionID:
-                        codes.append(evt.EventCode)
+            camera.wait_for_event(
+                'CaptureComplete',
+                transaction_id=capture.TransactionID,
+                timeout=10,
+            )
+            # Give stray ObjectAdded events a chance to arrive.
+            sleep(1)
+            camera.unsubscribe(subscription)
 
             assert 'CaptureComplete' in codes, 'No CaptureComplete received.'
             assert 'ObjectAdded' in codes,\
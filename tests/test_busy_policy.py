@@ -0,0 +1,96 @@
+'''Check how operations answered with DeviceBusy are retried.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.busy import BusyPolicy
+from ptpy.ptp import PTP
+
+
+class FakeTransport(object):
+    '''Answer DeviceBusy to the first `busy` operations.'''
+
+    def __init__(self, busy=0, ready=None, **kwargs):
+        self._set_endian('little')
+        self.busy = busy
+        self.ready = ready
+        self.transactions = []
+
+    def _ready(self):
+        return self.ready.pop(0) if self.ready else None
+
+    def mesg(self, ptp_container):
+        self.transactions.append(ptp_container.TransactionID)
+        if self.busy:
+            self.busy -= 1
+            return Container(ResponseCode='DeviceBusy')
+        return Container(ResponseCode='OK')
+
+    def recv(self, ptp_container):
+        return FakeTransport.mesg(self, ptp_container)
+
+
+class Camera(PTP, FakeTransport):
+    pass
+
+
+def capture(camera):
+    return camera.mesg(Container(
+        OperationCode='InitiateCapture',
+        SessionID=0,
+        TransactionID=0,
+        Parameter=[],
+    ))
+
+
+class TestBusyPolicy(object):
+    def test_off_by_default(self):
+        camera = Camera(busy=1)
+        assert capture(camera).ResponseCode == 'DeviceBusy'
+
+    def test_retries_with_backoff(self):
+        policy = BusyPolicy(initial_delay=0.001, max_delay=0.004)
+        camera = Camera(busy=3, busy_policy=policy)
+        assert capture(camera).ResponseCode == 'OK'
+        stats = policy.stats('InitiateCapture')
+        assert stats.busy == 1
+        assert stats.retries == 3
+        assert stats.gave_up == 0
+        assert 0.007 <= stats.waited < 1
+        assert list(zip(range(4), policy.delays())) == [
+            (0, 0.001), (1, 0.002), (2, 0.004), (3, 0.004)
+        ]
+
+    def test_waits_for_readiness_probe(self):
+        policy = BusyPolicy(initial_delay=0.001)
+        camera = Camera(busy=1, ready=[False, False], busy_policy=policy)
+        assert capture(camera).ResponseCode == 'OK'
+        # The operation is only sent again once the probe stops saying busy.
+        assert len(camera.transactions) == 2
+        assert policy.stats('InitiateCapture').retries == 1
+
+    def test_gives_up(self):
+        policy = BusyPolicy(timeouts={'InitiateCapture': 0.01})
+        camera = Camera(busy=1000, busy_policy=policy)
+        assert capture(camera).ResponseCode == 'DeviceBusy'
+        assert policy.stats('InitiateCapture').gave_up == 1
+
+    def test_not_in_flight_during_backoff(self):
+        camera = Camera(busy=2, busy_policy=BusyPolicy(initial_delay=0.001))
+        wait_while_busy = camera._wait_while_busy
+        in_flight = []
+
+        def wait(*args):
+            in_flight.append(
+                (camera._transfer_in_flight, camera._operation_in_flight)
+            )
+            wait_while_busy(*args)
+        camera._wait_while_busy = wait
+        response = camera.recv(Container(
+            OperationCode='GetObject',
+            SessionID=0,
+            TransactionID=0,
+            Parameter=[1],
+        ))
+        assert response.ResponseCode == 'OK'
+        # Polls are free to run while the operation backs off.
+        assert in_flight == [(False, False), (False, False)]
+        assert not camera._transfer_in_flight
@@ -0,0 +1,154 @@
+'''Check that objects are downloaded in chunks and streamed to files.'''
+from .context import ptpy  # noqa
+from .fake_usb import (
+    DATA, FakeUSBDevice, container, requires_range_build, response,
+)
+from construct import Container
+from io import BytesIO
+from ptpy.ptp import PTP, PTPError
+from ptpy.transports.usb import USBTransport
+import pytest
+
+
+class FakeTransport(object):
+    '''Camera holding a single object, `data`.
+
+    Reads from the end of the object are answered `at_end`, with no data.
+    '''
+
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.data = b''
+        self.at_end = 'OK'
+        self.reads = []
+
+    def recv(self, ptp_container):
+        kwargs = {}
+        code = 'OK'
+        if ptp_container.OperationCode == 'GetPartialObject':
+            _, offset, size = ptp_container.Parameter
+            self.reads.append((offset, size))
+            if offset >= len(self.data):
+                code = self.at_end
+            if code == 'OK':
+                kwargs['Data'] = self.data[offset:offset + size]
+        else:
+            code = 'OperationNotSupported'
+        return Container(
+            ResponseCode=code,
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            **kwargs
+        )
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(PTP, FakeTransport):
+    pass
+
+
+class TestDownloadObject(object):
+    def test_size(self):
+        camera = Camera()
+        camera.data = b'0123456789'
+        destination = BytesIO()
+        assert camera.download_object(1, destination, 10, chunk_size=4) == 10
+        assert destination.getvalue() == camera.data
+        assert camera.reads == [(0, 4), (4, 4), (8, 2)]
+
+    def test_truncated(self):
+        camera = Camera()
+        camera.data = b'01234'
+        with pytest.raises(PTPError):
+            camera.download_object(1, BytesIO(), 10, chunk_size=4)
+
+    def test_size_from_object_info(self):
+        camera = Camera()
+        camera.data = b'01234567'
+        camera.get_object_info = lambda handle: Container(
+            ObjectCompressedSize=8
+        )
+        destination = BytesIO()
+        assert camera.download_object(1, destination, chunk_size=4) == 8
+        # No read past the end of the object.
+        assert camera.reads == [(0, 4), (4, 4)]
+
+    @pytest.mark.parametrize('at_end', ['OK', 'InvalidParameter'])
+    def test_unknown_size(self, at_end):
+        camera = Camera()
+        # A multiple of the chunk size ends with an empty or refused read.
+        camera.data = b'01234567'
+        camera.at_end = at_end
+        destination = BytesIO()
+        assert camera.download_object(1, destination, chunk_size=4) == 8
+        assert destination.getvalue() == camera.data
+
+    def test_unknown_size_short_chunk(self):
+        camera = Camera()
+        camera.data = b'0123456'
+        camera.at_end = 'InvalidParameter'
+        assert camera.download_object(1, BytesIO(), chunk_size=4) == 7
+        assert len(camera.reads) == 2
+
+    def test_refused(self):
+        camera = Camera()
+        camera.at_end = 'InvalidParameter'
+        with pytest.raises(PTPError):
+            camera.download_object(1, BytesIO(), chunk_size=4)
+
+
+class USBCamera(PTP, USBTransport):
+    pass
+
+
+def object_responder(payload, length=None):
+    def respond(code, transaction_id, parameters):
+        return [
+            container(DATA, code, transaction_id, payload, length),
+            response(0x2001, transaction_id),
+        ]
+    return respond
+
+
+@requires_range_build
+class TestUSBSink(object):
+    def stream(self, payload, length=None):
+        device = FakeUSBDevice(object_responder(payload, length))
+        camera = USBCamera(device=device, reset_policy='never')
+        sink = BytesIO()
+        try:
+            result = camera.get_object(1, sink=sink)
+        finally:
+            camera._shutdown()
+        return result, sink.getvalue()
+
+    def test_known_length(self):
+        payload = bytes(bytearray(range(256))) * 600
+        result, received = self.stream(payload)
+        assert result.ResponseCode == 'OK'
+        assert result.DataLength == len(payload)
+        assert not hasattr(result, 'Data')
+        assert received == payload
+
+    @pytest.mark.parametrize('size', [1000, 512 * 300 - 12])
+    def test_unknown_length(self, size):
+        # Dataphases over 4GB end with a short or zero length packet.
+        payload = b'\xff' * size
+        result, received = self.stream(payload, length=0xFFFFFFFF)
+        assert result.ResponseCode == 'OK'
+        assert result.DataLength == size
+        assert received == payload
+
+    @pytest.mark.parametrize('size', [1000, 512 * 300 - 12])
+    def test_unknown_length_in_memory(self, size):
+        payload = b'\xff' * size
+        device = FakeUSBDevice(object_responder(payload, length=0xFFFFFFFF))
+        camera = USBCamera(device=device, reset_policy='never')
+        try:
+            result = camera.get_object(1)
+        finally:
+            camera._shutdown()
+        assert result.ResponseCode == 'OK'
+        assert bytes(result.Data) == payload
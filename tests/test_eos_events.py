@@ -0,0 +1,94 @@
+'''Check and benchmark the EOS event parser on synthetic EOSGetEvent data.
+
+Run `python -m tests.test_eos_events` from the repository root to print the
+benchmark alone.
+'''
+from .context import ptpy  # noqa
+from ptpy.extensions.canon import Canon
+from ptpy.ptp import PTP
+from timeit import timeit
+import pytest
+import struct
+
+
+def eos_record(code, payload=b''):
+    return struct.pack('<II', 8 + len(payload), code) + payload
+
+
+def property_dump(camera):
+    '''Emulate the burst of records that follows a mode change.'''
+    records = []
+    codes = camera._EOSPropertyCode.encoding
+    for name, data_type in sorted(camera._EOSDataTypeCode.items()):
+        if data_type not in (None, 'UInt32', 'Int32') or name not in codes:
+            continue
+        code = struct.pack('<I', codes[name])
+        records.append(eos_record(0xC18A, code + bytes(bytearray(range(64)))))
+        records.append(eos_record(0xC189, code + struct.pack('<i', -3)))
+    # Captures sent to the host.
+    transfer = struct.pack('<IH6xI4x', 0x9000001, 0x3801, 6543210)
+    records.append(eos_record(0xC186, transfer + b'IMG_0001.JPG\0\0\0\0'))
+    # Records without a decoder, such as ObjectAdded.
+    records.extend(eos_record(0xC181, bytes(bytearray(60))) for _ in range(20))
+    records.append(eos_record(0))
+    return b''.join(records)
+
+
+@pytest.fixture(scope='module')
+def canon():
+    camera = type('Canon', (Canon, PTP), {})()
+    camera._set_endian('little')
+    return camera
+
+
+class TestEOSEventParser(object):
+    def test_same_as_construct(self, canon):
+        data = property_dump(canon)
+        fast = canon._EOSEventParser.parse(data)
+        slow = canon._EOSEventRecords.parse(data)
+        assert slow[-1].EventCode == 'EmptyEvent'
+        assert len(fast) == len(slow) - 1,\
+            'The terminating record should not be returned.'
+        for new, old in zip(fast, slow):
+            assert new.Bytes == old.Bytes
+            assert new.EventCode == old.EventCode
+            if isinstance(old.Record, list):
+                assert bytearray(new.Record) == bytearray(old.Record)
+            else:
+                for key, value in old.Record.items():
+                    assert new[key] == value
+
+    def test_request_object_transfer(self, canon):
+        records = canon._EOSEventParser.parse(property_dump(canon))
+        transfer, = [
+            r for r in records if r.EventCode == 'RequestObjectTransfer'
+        ]
+        assert transfer.ObjectHandle == 0x9000001
+        assert transfer.ObjectCompressedSize == 6543210
+        assert transfer.Filename == 'IMG_0001.JPG'
+
+    def test_truncated(self, canon):
+        data = property_dump(canon)
+        records = canon._EOSEventParser.parse(data[:-30])
+        assert len(records) == len(canon._EOSEventParser.parse(data)) - 1
+
+    def test_faster_than_construct(self, canon):
+        fast, slow = benchmark(canon, number=5)
+        assert fast < slow
+
+
+def benchmark(canon, number=20):
+    data = property_dump(canon)
+    fast = timeit(lambda: canon._EOSEventParser.parse(data), number=number)
+    slow = timeit(lambda: canon._EOSEventRecords.parse(data), number=number)
+    print(
+        '{} bytes: {:.3f} ms with the parser, {:.3f} ms with construct'
+        .format(len(data), 1e3 * fast / number, 1e3 * slow / number)
+    )
+    return fast, slow
+
+
+if __name__ == '__main__':
+    camera = type('Canon', (Canon, PTP), {})()
+    camera._set_endian('little')
+    benchmark(camera)
@@ -0,0 +1,114 @@
+'''Check how EOS captures are downloaded to the host.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.canon import Canon
+from ptpy.ptp import PTP
+from ptpy.util import object_filename
+import os
+import struct
+import time
+
+
+class FakeTransport(object):
+    '''EOS camera whose CaptureDestination starts as `destination`.'''
+
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.destination = None
+        self.destinations = []
+        self.completed = []
+
+    def __respond(self, ptp_container, **kwargs):
+        return Container(
+            ResponseCode='OK',
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            **kwargs
+        )
+
+    def mesg(self, ptp_container):
+        operation = ptp_container.OperationCode
+        if (
+                operation == 'EOSRequestDevicePropValue' and
+                self.destination is not None
+        ):
+            # Unknown property types are reported as bytes.
+            self._event_received(Container(
+                EventCode='DevicePropChanged',
+                PropertyCode='CaptureDestination',
+                Value=list(bytearray(struct.pack('<I', self.destination))),
+            ), 'EOS')
+        elif operation == 'EOSTransferComplete':
+            self.completed.append(ptp_container.Parameter[0])
+        return self.__respond(ptp_container)
+
+    def send(self, ptp_container, payload):
+        data = b''.join(bytes(c) for c in payload.chunks(1 << 10))
+        _, code, value = struct.unpack('<III', data)
+        self.destinations.append(value)
+        return self.__respond(ptp_container)
+
+    def recv(self, ptp_container):
+        return self.__respond(ptp_container, Data=b'JPEG')
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(Canon, PTP, FakeTransport):
+    pass
+
+
+def request(handle, name):
+    return Container(
+        EventCode='RequestObjectTransfer',
+        ObjectHandle=handle,
+        ObjectCompressedSize=0,
+        Filename=name,
+    )
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+class TestObjectFilename(object):
+    def test_names(self):
+        assert object_filename('IMG_0001.JPG', 1) == 'IMG_0001.JPG'
+        assert object_filename('../../IMG_0001.JPG', 1) == 'IMG_0001.JPG'
+        assert object_filename('C:\\DCIM\\IMG_0001.JPG', 1) == 'IMG_0001.JPG'
+        assert object_filename('/etc/passwd', 1) == 'passwd'
+        for name in ('', None, '..', 'DCIM/..', '.'):
+            assert object_filename(name, 0x2A) == 'IMG_0000002A'
+
+
+class TestEOSTransfers(object):
+    def test_download(self, tmpdir):
+        camera = Camera()
+        camera.destination = 2
+        directory = str(tmpdir.join('shots'))
+        with camera.eos_capture_to_host(directory) as transfers:
+            camera._event_received(request(1, '../IMG_0001.JPG'), 'EOS')
+            camera._event_received(request(2, '..'), 'EOS')
+            assert len(transfers.wait(count=2, timeout=2)) == 2
+        assert sorted(os.listdir(directory)) == [
+            'IMG_00000002', 'IMG_0001.JPG'
+        ]
+        assert not os.path.exists(str(tmpdir.join('IMG_0001.JPG')))
+        assert camera.completed == [1, 2]
+        # The destination the camera had is restored.
+        assert camera.destinations == [4, 2]
+
+    def test_unknown_destination(self, tmpdir, caplog):
+        camera = Camera()
+        transfers = camera.eos_capture_to_host(str(tmpdir))
+        start = time.time()
+        transfers.start()
+        assert time.time() - start < 2
+        transfers.stop()
+        transfers.stop()
+        assert camera.destinations == [4]
+        assert 'CaptureDestination is unknown' in caplog.text
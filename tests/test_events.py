@@ -0,0 +1,219 @@
+'''Check event subscriptions, waiters and the event stream.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.events import EventStream
+from ptpy.ptp import PTP
+from threading import Thread
+import pytest
+import six
+import time
+
+
+class FakeTransport(object):
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(PTP, FakeTransport):
+    pass
+
+
+def event(code, transaction_id=0, *parameters):
+    return Container(
+        EventCode=code,
+        TransactionID=transaction_id,
+        Parameter=list(parameters),
+    )
+
+
+def deliver_later(camera, events, delay=0.05):
+    '''Deliver events to a camera, or put them in a stream, from a thread.'''
+    def deliver():
+        time.sleep(delay)
+        for evt in events:
+            if isinstance(camera, EventStream):
+                camera.put(evt, 'Test')
+            else:
+                camera._event_received(evt, 'Test')
+    thread = Thread(target=deliver)
+    thread.start()
+    return thread
+
+
+class TestSubscriptions(object):
+    def test_filters(self):
+        camera = Camera()
+        added, changed = [], []
+        # Codes can be given by number.
+        camera.subscribe(added.append, code=0x4002)
+        camera.subscribe(
+            changed.append, code='DevicePropChanged', parameters=[0x5007]
+        )
+        camera._event_received(event('ObjectAdded', 3, 1), 'Test')
+        camera._event_received(event('DevicePropChanged', 0, 0x5007), 'Test')
+        camera._event_received(event('DevicePropChanged', 0, 0x500E), 'Test')
+        camera._event_received(event('ObjectAdded', 4, 2), 'Test')
+        assert [e.Parameter for e in added] == [[1], [2]]
+        assert [e.Parameter for e in changed] == [[0x5007]]
+        assert added[0].Source == 'Test'
+
+    def test_replays_transaction(self):
+        camera = Camera()
+        camera._event_received(event('ObjectAdded', 7, 1), 'Test')
+        camera._event_received(event('ObjectAdded', 8, 2), 'Test')
+        received = []
+        camera.subscribe(received.append, transaction_id=7)
+        camera._event_received(event('CaptureComplete', 7), 'Test')
+        assert [e.EventCode for e in received] == [
+            'ObjectAdded', 'CaptureComplete'
+        ]
+
+    def test_unsubscribe(self):
+        camera = Camera()
+        received = []
+        subscription = camera.subscribe(received.append)
+        camera._event_received(event('ObjectAdded'), 'Test')
+        camera.unsubscribe(subscription)
+        camera.unsubscribe(subscription)
+        camera._event_received(event('ObjectAdded'), 'Test')
+        assert len(received) == 1
+
+    def test_failing_callback(self):
+        camera = Camera()
+        received = []
+        camera.subscribe(lambda e: 1 / 0)
+        camera.subscribe(received.append)
+        camera._event_received(event('ObjectAdded'), 'Test')
+        assert len(received) == 1
+
+
+class TestWaitForEvent(object):
+    def test_waits(self):
+        camera = Camera()
+        thread = deliver_later(camera, [
+            event('ObjectAdded', 5, 1),
+            event('CaptureComplete', 5),
+        ])
+        found = camera.wait_for_event('CaptureComplete', timeout=2)
+        thread.join()
+        assert found.TransactionID == 5
+
+    def test_transaction_received_before(self):
+        camera = Camera()
+        camera._event_received(event('CaptureComplete', 9), 'Test')
+        found = camera.wait_for_event(
+            'CaptureComplete', transaction_id=9, timeout=0
+        )
+        assert found.TransactionID == 9
+
+    def test_ignores_older_events(self):
+        camera = Camera()
+        camera._event_received(event('CaptureComplete', 9), 'Test')
+        assert camera.wait_for_event('CaptureComplete', timeout=0.05) is None
+
+    def test_timeout(self):
+        camera = Camera()
+        thread = deliver_later(camera, [event('ObjectAdded', 5, 1)])
+        start = time.time()
+        assert camera.wait_for_event('CaptureComplete', timeout=0.2) is None
+        assert 0.2 <= time.time() - start < 1
+        thread.join()
+
+    @pytest.mark.parametrize('policy', ['drop_oldest', 'block'])
+    def test_many_events_unread_stream(self, policy, caplog):
+        camera = Camera(event_policy=policy)
+        events = [event('ObjectAdded', 0, i) for i in range(1100)]
+        thread = deliver_later(camera, events + [event('CaptureComplete')])
+        found = camera.wait_for_event('CaptureComplete', timeout=2)
+        thread.join(1)
+        assert found is not None
+        assert not thread.is_alive()
+        # Nobody read the stream: it kept the latest events, quietly.
+        assert len(camera.event_stream) == 1024
+        assert camera.event_stream.dropped == 0
+        assert 'dropped' not in caplog.text
+
+    def test_full_stream_does_not_hold_back_waiters(self):
+        camera = Camera(event_queue_size=4, event_policy='block')
+        assert camera.event() is None
+        events = [event('ObjectAdded', 0, i) for i in range(5)]
+        thread = deliver_later(camera, events)
+        found = camera.wait_for_event('ObjectAdded', parameters=[4], timeout=2)
+        assert found is not None
+        # The fifth event waits for room in the stream.
+        assert thread.is_alive()
+        assert camera.event().Parameter == [0]
+        thread.join(1)
+        assert [e.Parameter for e in camera.events(timeout=0)] == [
+            [1], [2], [3], [4]
+        ]
+
+
+class TestEventStream(object):
+    def test_drop_oldest(self):
+        stream = EventStream(maxlen=2)
+        assert stream.get(block=False) is None
+        for code in ('A', 'B', 'C'):
+            stream.put(event(code), 'Test')
+        assert stream.dropped == 1
+        assert [stream.get().EventCode for _ in range(2)] == ['B', 'C']
+
+    def test_coalesce(self):
+        stream = EventStream(maxlen=2, policy='coalesce')
+        assert stream.get(block=False) is None
+        stream.put(event('DevicePropChanged', 0, 0x5007), 'Test')
+        stream.put(event('ObjectAdded', 0, 1), 'Test')
+        stream.put(event('DevicePropChanged', 0, 0x5007), 'Late')
+        assert stream.coalesced == 1
+        assert [e.EventCode for e in (stream.get(), stream.get())] == [
+            'ObjectAdded', 'DevicePropChanged'
+        ]
+
+    def test_block(self):
+        stream = EventStream(maxlen=1, policy='block')
+        # Sources are not held back before a consumer attaches.
+        stream.put(event('Unread'), 'Test')
+        assert stream.accepting
+        assert stream.get().EventCode == 'Unread'
+        stream.put(event('A'), 'Test')
+        assert not stream.accepting
+        thread = Thread(target=stream.put, args=(event('B'), 'Test'))
+        thread.start()
+        time.sleep(0.05)
+        assert len(stream) == 1
+        assert stream.get().EventCode == 'A'
+        thread.join(1)
+        assert stream.get(timeout=1).EventCode == 'B'
+        assert stream.dropped == 0
+
+    def test_iteration_stops_when_closed(self):
+        stream = EventStream()
+        stream.put(event('A'), 'Test')
+        stream.close()
+        assert [e.EventCode for e in stream] == ['A']
+
+    @pytest.mark.skipif(six.PY2, reason='Asynchronous iteration is Python 3.')
+    def test_async_iteration(self):
+        import asyncio
+        stream = EventStream()
+        iterator = stream.__aiter__()
+        loop = asyncio.new_event_loop()
+
+        def anext():
+            # Futures are requested from within the running loop, as
+            # `async for` would, in a syntax Python 2 can still parse.
+            futures = []
+            loop.call_soon(lambda: futures.append(iterator.__anext__()))
+            loop.run_until_complete(asyncio.sleep(0))
+            return loop.run_until_complete(futures[0])
+        try:
+            deliver_later(stream, [event('A')])
+            assert anext().EventCode == 'A'
+            stream.close()
+            with pytest.raises(StopAsyncIteration):
+                anext()
+        finally:
+            loop.close()
@@ -0,0 +1,168 @@
+'''Check how camera farm workers serve commands and recover from failures.'''
+from .context import ptpy  # noqa
+from construct import Container
+from contextlib import contextmanager
+from ptpy import farm
+from ptpy.ptp import PTPError
+import threading
+import time
+import usb.core
+
+
+class FakeCamera(object):
+    _disconnected = False
+
+    def __init__(self, fail_session=False):
+        self.fail_session = fail_session
+        self.sessions = 0
+        self.shut_down = False
+
+    @contextmanager
+    def session(self):
+        self.sessions += 1
+        if self.fail_session:
+            raise PTPError('Session refused')
+        yield
+
+    def get_device_info(self):
+        return Container(SerialNumber='SN{}'.format(id(self)))
+
+    def _shutdown(self):
+        self.shut_down = True
+
+
+class FakeDevice(object):
+    def __init__(self, bus=1, address=2):
+        self.bus = bus
+        self.address = address
+
+
+class SlowCamera(FakeCamera):
+    '''Open after `device` seconds, or fail if it is negative.'''
+
+    opened = []
+
+    def __init__(self, device=None):
+        super(SlowCamera, self).__init__()
+        if device < 0:
+            raise PTPError('Not a camera')
+        time.sleep(device)
+        self.opened.append(self)
+
+
+class TestOpenCameras(object):
+    def test_timeout(self, monkeypatch):
+        monkeypatch.setattr(farm, 'PTPy', SlowCamera)
+        start = time.time()
+        bring_up = farm.open_cameras(
+            [0.6, 0.61, 0., -1], max_workers=2, timeout=0.2
+        )
+        # Slow devices do not hold back the others.
+        assert time.time() - start < 0.5
+        assert list(bring_up.cameras) == [0.]
+        assert sorted(f.device for f in bring_up.failures) == [-1, 0.6, 0.61]
+        stuck = [
+            t for t in threading.enumerate() if t.name == 'OpenCameras'
+        ]
+        assert stuck and all(t.daemon for t in stuck)
+        # Cameras that opened too late are released.
+        for thread in stuck:
+            thread.join(1)
+        late = [
+            c for c in SlowCamera.opened
+            if c not in bring_up.cameras.values()
+        ]
+        assert len(late) == 2
+        assert all(c.shut_down for c in late)
+
+
+class TestCameraWorker(object):
+    def test_runs_commands(self):
+        worker = farm._CameraWorker('A')
+        camera = FakeCamera()
+        worker.attach(camera, (1, 2))
+        try:
+            future = worker.submit(lambda c, x: (c, x), 3)
+            assert future.result(timeout=2) == (camera, 3)
+        finally:
+            worker.stop()
+        assert camera.shut_down
+
+    def test_backs_off_failing_sessions(self):
+        worker = farm._CameraWorker('A', retry_delay=0.1)
+        camera = FakeCamera(fail_session=True)
+        worker.attach(camera, (1, 2))
+        time.sleep(0.35)
+        worker.stop()
+        # Retries after 0.1s, then 0.2s, instead of right away.
+        assert 2 <= camera.sessions <= 3
+
+    def test_detaches_unplugged(self):
+        worker = farm._CameraWorker('A')
+        camera = FakeCamera()
+        worker.attach(camera, (1, 2))
+
+        def unplug(camera):
+            raise usb.core.USBError('No such device', errno=19)
+        try:
+            future = worker.submit(unplug)
+            assert isinstance(future.exception(timeout=2), usb.core.USBError)
+            assert not worker.attached
+            assert camera.shut_down
+            # Commands wait for the camera to be attached again.
+            future = worker.submit(lambda c: c)
+            time.sleep(0.1)
+            assert not future.done()
+            other = FakeCamera()
+            worker.attach(other, (1, 3))
+            assert future.result(timeout=2) is other
+        finally:
+            worker.stop()
+
+
+class TestCameraFarm(object):
+    def test_backs_off_failing_devices(self, monkeypatch):
+        device = FakeDevice()
+        attempts = []
+
+        def open_cameras(devices, **kwargs):
+            attempts.append(list(devices))
+            failure = farm.BringUpFailure(device, PTPError('Busy'), 0.)
+            return farm.BringUp({}, [failure], {}, 0.)
+
+        monkeypatch.setattr(farm, 'find_usb_cameras', lambda name: [device])
+        monkeypatch.setattr(farm, 'open_cameras', open_cameras)
+        cameras = farm.CameraFarm(scan_interval=0.1)
+        assert cameras.scan() == []
+        assert cameras.scan() == []
+        assert len(attempts) == 1
+        time.sleep(0.15)
+        cameras.scan()
+        assert len(attempts) == 2
+        # The delay doubled after the second failure.
+        time.sleep(0.15)
+        cameras.scan()
+        assert len(attempts) == 2
+
+    def test_attaches_new_cameras(self, monkeypatch):
+        device = FakeDevice()
+        opened = []
+        registered = []
+
+        def open_cameras(devices, **kwargs):
+            opened.append(FakeCamera())
+            return farm.BringUp({device: opened[-1]}, [], {device: 0.}, 0.)
+
+        monkeypatch.setattr(farm, 'find_usb_cameras', lambda name: [device])
+        monkeypatch.setattr(farm, 'open_cameras', open_cameras)
+        monkeypatch.setattr(farm.atexit, 'register', registered.append)
+        cameras = farm.CameraFarm(scan_interval=0.05)
+        for _ in range(2):
+            cameras.start()
+            assert list(cameras.cameras.values()) == [opened[-1]]
+            result = cameras.map(lambda c: c.sessions)
+            assert [f.result(timeout=2) for f in result.values()] == [1]
+            cameras.stop()
+            assert opened[-1].shut_down
+        assert len(opened) == 2
+        assert registered == [cameras.stop]
@@ -0,0 +1,65 @@
+'''Check the cadence of interval captures.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.interval import IntervalCapture
+import time
+
+
+class FakeCamera(object):
+    '''Take `latency` seconds per capture.'''
+
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.triggers = []
+
+    def initiate_capture(self):
+        self.triggers.append(time.time())
+        time.sleep(self.latency)
+        return Container(ResponseCode='OK', TransactionID=len(self.triggers))
+
+    def wait_for_event(self, code, transaction_id=None, timeout=None):
+        return Container(EventCode=code, TransactionID=transaction_id)
+
+
+class TestIntervalCapture(object):
+    def test_fixed_cadence(self):
+        cameras = {'a': FakeCamera(0.01), 'b': FakeCamera(0.015)}
+        timelapse = IntervalCapture(cameras, interval=0.03, count=6)
+        with timelapse:
+            assert timelapse.wait(timeout=5)
+        for key, camera in cameras.items():
+            stats = timelapse.stats(key)
+            assert stats.captures == 6
+            assert stats.skipped == 0
+            # The latency of captures does not accumulate.
+            period = (camera.triggers[-1] - camera.triggers[0]) / 5
+            assert abs(period - 0.03) < 0.005
+            assert len(timelapse.jitter(key)) == 6
+
+    def test_skips_overruns(self):
+        camera = FakeCamera(0.05)
+        timelapse = IntervalCapture(camera, interval=0.02, count=3)
+        with timelapse:
+            assert timelapse.wait(timeout=5)
+        stats = timelapse.stats(0)
+        assert stats.captures == 3
+        assert stats.skipped >= 4
+        assert stats.max_jitter < 0.02
+
+    def test_catches_up(self):
+        camera = FakeCamera(0.05)
+        timelapse = IntervalCapture(
+            camera, interval=0.02, count=3, overrun='catch_up'
+        )
+        with timelapse:
+            assert timelapse.wait(timeout=5)
+        stats = timelapse.stats(0)
+        assert stats.skipped == 0
+        assert stats.max_jitter >= 0.05
+
+    def test_max_rate(self):
+        camera = FakeCamera(0.01)
+        timelapse = IntervalCapture(camera, count=5)
+        with timelapse:
+            assert timelapse.wait(timeout=5)
+        assert 50 < timelapse.stats(0).rate <= 100
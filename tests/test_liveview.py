@@ -0,0 +1,202 @@
+'''Check the live view engine and EOS viewfinder frames.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.canon import Canon
+from ptpy.liveview import Frame, FrameBuffer, FrameSink, LiveView
+from ptpy.ptp import PTP
+from threading import Event, Thread, current_thread
+import struct
+import time
+
+
+def frame(number):
+    return Frame(number, b'', 0., 0.)
+
+
+class FakeTransport(object):
+    '''Answer viewfinder operations with `frames`, then NotReady.'''
+
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.frames = []
+        self.operations = []
+        self.threads = {}
+
+    def __respond(self, ptp_container, code='OK', **kwargs):
+        self.operations.append(ptp_container.OperationCode)
+        self.threads.setdefault(ptp_container.OperationCode, []).append(
+            current_thread()
+        )
+        return Container(
+            ResponseCode=code,
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            **kwargs
+        )
+
+    def mesg(self, ptp_container):
+        return self.__respond(ptp_container)
+
+    def send(self, ptp_container, payload):
+        return self.__respond(ptp_container)
+
+    def recv(self, ptp_container):
+        if not self.frames:
+            return self.__respond(ptp_container, 'NotReady')
+        return self.__respond(ptp_container, Data=self.frames.pop(0))
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(Canon, PTP, FakeTransport):
+    pass
+
+
+def viewfinder(jpeg):
+    '''Viewfinder dataphase with a JPEG block between two others.'''
+    return b''.join([
+        struct.pack('<II', 12, 4) + b'\0' * 4,
+        struct.pack('<II', 8 + len(jpeg), 1) + jpeg,
+        struct.pack('<II', 8, 2),
+    ])
+
+
+class TestFrameBuffer(object):
+    def test_latest(self):
+        frames = FrameBuffer()
+        for number in range(3):
+            frames.put(frame(number))
+        assert frames.get().number == 2
+        assert frames.dropped == 2
+        assert frames.get(after=2, timeout=0.05) is None
+
+    def test_waits_for_newer(self):
+        frames = FrameBuffer()
+        frames.put(frame(1))
+
+        def put_later():
+            time.sleep(0.05)
+            frames.put(frame(2))
+        Thread(target=put_later).start()
+        assert frames.get(after=1, timeout=2).number == 2
+
+    def test_close(self):
+        frames = FrameBuffer()
+        Thread(target=frames.close).start()
+        assert frames.get(timeout=2) is None
+
+
+class TestFrameSink(object):
+    def receive(self, sink, data):
+        sink.rewind()
+        for start in range(0, len(data), 4):
+            sink.write(data[start:start + 4])
+        return sink.getbuffer()
+
+    def test_reuses_free_buffers(self):
+        sink = FrameSink()
+        first = self.receive(sink, b'0123456789')
+        assert first.tobytes() == b'0123456789'
+        buffer = first.obj
+        del first
+        second = self.receive(sink, b'abc')
+        assert second.tobytes() == b'abc'
+        assert second.obj is buffer
+
+    def test_held_frames_are_not_overwritten(self):
+        sink = FrameSink(count=2)
+        held = [
+            self.receive(sink, 'frame{}'.format(n).encode())
+            for n in range(3)
+        ]
+        assert [f.tobytes() for f in held] == [
+            b'frame0', b'frame1', b'frame2'
+        ]
+
+
+class TestLiveView(object):
+    def test_frames(self):
+        numbers = iter(range(100))
+        calls = []
+
+        def fetch():
+            number = next(numbers)
+            # Every other fetch finds the camera not ready.
+            return None if number % 2 else number
+        live_view = LiveView(
+            fetch,
+            setup=lambda: calls.append('setup'),
+            teardown=lambda: calls.append('teardown'),
+            retry=0.001,
+        )
+        with live_view:
+            frames = []
+            for received in live_view.frames(timeout=1):
+                frames.append(received)
+                if len(frames) == 3:
+                    break
+        assert calls == ['setup', 'teardown']
+        assert [f.data for f in frames] == sorted(f.data for f in frames)
+        assert all(f.data % 2 == 0 for f in frames)
+        stats = live_view.stats
+        assert stats.frames >= 3
+        assert stats.not_ready >= 2
+
+    def test_stops_after_errors(self):
+        def fetch():
+            raise IOError('Unplugged')
+        live_view = LiveView(fetch, max_errors=3)
+        live_view.start()
+        assert live_view.latest(timeout=2) is None
+        assert live_view.stats.errors == 3
+        live_view.stop()
+
+    def test_failed_setup(self):
+        def setup():
+            raise IOError('Busy')
+        live_view = LiveView(lambda: b'', setup=setup)
+        live_view.start()
+        assert list(live_view.frames(timeout=2)) == []
+        assert live_view.stats.frames == 0
+
+
+class TestEOSLiveView(object):
+    def test_viewfinder_jpeg(self):
+        camera = Camera()
+        jpeg = camera.eos_viewfinder_jpeg(viewfinder(b'\xff\xd8JPEG'))
+        assert isinstance(jpeg, memoryview)
+        assert jpeg.tobytes() == b'\xff\xd8JPEG'
+        assert camera.eos_viewfinder_jpeg(struct.pack('<II', 8, 2)) is None
+
+    def test_live_view(self):
+        camera = Camera()
+        camera.frames = [viewfinder(b'\xff\xd8JPEG')]
+        with camera.eos_live_view(retry=0.001) as live_view:
+            received = live_view.latest(timeout=2)
+        assert received.data.tobytes() == b'\xff\xd8JPEG'
+        operations = camera.operations
+        assert operations[:2] == [
+            'EOSInitiateViewfinder', 'EOSSetDevicePropValueEx'
+        ]
+        assert operations[-2:] == [
+            'EOSSetDevicePropValueEx', 'EOSTerminateViewfinder'
+        ]
+
+    def test_polls_in_camera_lane(self):
+        camera = Camera(poll_min_interval=0.01, poll_max_interval=0.02)
+        with camera.session():
+            # Keep the lane of the camera busy, as a long transfer would.
+            release = Event()
+            camera._reactor.call_later(
+                0, lambda: release.wait(2), blocking=True, group=camera
+            )
+            time.sleep(0.05)
+            camera.threads.pop('EOSGetEvent', None)
+            camera._eos_poll_if_due()
+            release.set()
+            deadline = time.time() + 2
+            while 'EOSGetEvent' not in camera.threads:
+                assert time.time() < deadline
+                time.sleep(0.005)
+        assert current_thread() not in camera.threads['EOSGetEvent']
@@ -0,0 +1,66 @@
+'''Check the GetObjPropList parser on a synthetic MTP listing.'''
+from .context import ptpy  # noqa
+from datetime import datetime
+from ptpy.extensions.microsoft import Microsoft
+from ptpy.ptp import PTP
+import pytest
+import struct
+
+
+def element(handle, code, data_type, value):
+    return struct.pack('<IHH', handle, code, data_type) + value
+
+
+def string(text):
+    encoded = (text + u'\x00').encode('utf-16-le') if text else b''
+    return struct.pack('<B', len(encoded) // 2) + encoded
+
+
+def listing(elements):
+    return struct.pack('<I', len(elements)) + b''.join(elements)
+
+
+@pytest.fixture(scope='module')
+def mtp():
+    camera = type('Microsoft', (Microsoft, PTP), {})()
+    camera._set_endian('little')
+    return camera
+
+
+@pytest.fixture
+def data():
+    return listing([
+        element(1, 0xDC07, 0xFFFF, string(u'DCIM')),
+        element(1, 0xDC02, 0x0004, struct.pack('<H', 0x3001)),
+        element(2, 0xDC07, 0xFFFF, string(u'IMG_0001.JPG')),
+        element(2, 0xDC02, 0x0004, struct.pack('<H', 0x3801)),
+        element(2, 0xDC04, 0x0008, struct.pack('<Q', 5 << 30)),
+        element(2, 0xDC09, 0xFFFF, string(u'20240102T030405')),
+        element(2, 0xDC0B, 0x0006, struct.pack('<I', 1)),
+        element(3, 0xDC04, 0x4006, struct.pack('<III', 2, 7, 8)),
+        element(3, 0xDC08, 0xFFFF, string(u'')),
+        element(3, 0x1234, 0x000A, struct.pack('<QQ', 1, 2)),
+    ])
+
+
+class TestObjPropList(object):
+    def test_columns(self, mtp, data):
+        objects = mtp._ObjectPropListParser.parse(data)
+        assert list(objects.handles) == [1, 2, 3]
+        assert objects['ObjectFileName'] == [u'DCIM', u'IMG_0001.JPG', None]
+        assert objects['ObjectFormat'] == ['Association', 'EXIF_JPEG', None]
+        assert objects['ObjectSize'] == [None, 5 << 30, [7, 8]]
+        assert objects['DateModified'][1] == datetime(2024, 1, 2, 3, 4, 5)
+        assert objects['DateCreated'][2] is None
+        assert objects[0x1234][2] == (2 << 64) | 1
+
+    def test_row(self, mtp, data):
+        row = mtp._ObjectPropListParser.parse(data).row(2)
+        assert row.ObjectHandle == 2
+        assert row.ParentObject == 1
+        assert 'DateCreated' not in row
+
+    def test_truncated(self, mtp, data):
+        objects = mtp._ObjectPropListParser.parse(data[:-5])
+        assert list(objects.handles) == [1, 2, 3]
+        assert 0x1234 not in objects.properties
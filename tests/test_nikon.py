@@ -0,0 +1,183 @@
+'''Check Nikon captures to SDRAM against a fake camera.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.busy import BusyPolicy
+from ptpy.extensions.nikon import Nikon
+from ptpy.ptp import PTP
+from threading import Thread, current_thread
+import time
+
+
+class FakeTransport(object):
+    '''Nikon camera busy for the first `busy` DeviceReady operations.
+
+    DeviceReady is then answered `ready`, and the first `capture_busy`
+    captures are answered DeviceBusy.
+    '''
+
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.busy = 0
+        self.ready = 'OK'
+        self.capture_busy = 0
+        self.threads = {}
+        self.added = []
+        self.operations = []
+
+    def __respond(self, ptp_container, code='OK', **kwargs):
+        self.operations.append(
+            (ptp_container.OperationCode, ptp_container.Parameter)
+        )
+        self.threads.setdefault(ptp_container.OperationCode, []).append(
+            current_thread()
+        )
+        return Container(
+            ResponseCode=code,
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            **kwargs
+        )
+
+    def mesg(self, ptp_container):
+        operation = ptp_container.OperationCode
+        if operation == 'AFCaptureSDRAM':
+            for added in self.added:
+                self._event_received(added, 'Nikon')
+        elif operation == 'DeviceReady':
+            if self.busy:
+                self.busy -= 1
+                return self.__respond(ptp_container, 'DeviceBusy')
+            return self.__respond(ptp_container, self.ready)
+        return self.__respond(ptp_container)
+
+    def recv(self, ptp_container):
+        operation = ptp_container.OperationCode
+        if operation == 'InitiateCapture' and self.capture_busy:
+            self.capture_busy -= 1
+            return self.__respond(ptp_container, 'DeviceBusy')
+        if operation == 'GetLiveViewImg':
+            return self.__respond(ptp_container, Data=b'HEAD\xff\xd8JPEG')
+        return self.__respond(ptp_container, Data=b'JPEG')
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(Nikon, PTP, FakeTransport):
+    pass
+
+
+def added_in_sdram(*parameters):
+    return Container(
+        EventCode='ObjectAddedInSDRAM',
+        TransactionID=0,
+        Parameter=list(parameters),
+    )
+
+
+class TestCaptureToSDRAM(object):
+    def test_handle(self):
+        camera = Camera()
+        camera.added = [added_in_sdram(0xFFFF0002)]
+        captured = camera.capture_to_sdram(timeout=1)
+        assert captured.ObjectHandle == 0xFFFF0002
+        assert captured.Data == b'JPEG'
+        assert camera.operations[-2:] == [
+            ('GetObject', [0xFFFF0002]),
+            ('DelImageSDRAM', [0xFFFF0002]),
+        ]
+
+    def test_without_handle(self):
+        camera = Camera()
+        camera.added = [added_in_sdram()]
+        captured = camera.capture_to_sdram(timeout=1, delete=False)
+        assert captured.ObjectHandle == 0xFFFF0001
+        assert camera.operations[-1] == ('GetObject', [0xFFFF0001])
+
+    def test_nothing_added(self):
+        camera = Camera()
+        assert camera.capture_to_sdram(timeout=0.05) is None
+
+
+class TestWaitUntilReady(object):
+    def test_busy(self):
+        camera = Camera(busy_policy=BusyPolicy(initial_delay=0.01))
+        camera.busy = 3
+        assert camera.wait_until_ready().ResponseCode == 'OK'
+        assert camera.busy == 0
+
+    def test_readiness_event(self):
+        camera = Camera(
+            busy_policy=BusyPolicy(initial_delay=5, max_delay=5)
+        )
+        camera.busy = 1
+
+        def complete():
+            time.sleep(0.05)
+            camera._event_received(
+                Container(EventCode='CaptureComplete', Parameter=[]), 'Nikon'
+            )
+        Thread(target=complete).start()
+        start = time.time()
+        assert camera.wait_until_ready().ResponseCode == 'OK'
+        # Asked again on CaptureComplete, without waiting for the delay.
+        assert time.time() - start < 1
+
+    def test_timeout(self):
+        camera = Camera()
+        camera.busy = 1000
+        start = time.time()
+        response = camera.wait_until_ready(timeout=0.1)
+        assert response.ResponseCode == 'DeviceBusy'
+        assert time.time() - start < 1
+
+    def test_not_accounted_as_busy(self):
+        policy = BusyPolicy(initial_delay=0.01)
+        camera = Camera(busy_policy=policy)
+        camera.busy = 3
+        assert camera.wait_until_ready().ResponseCode == 'OK'
+        assert policy.stats() == {}
+
+
+class TestReadinessProbe(object):
+    def test_probe_while_retrying(self):
+        policy = BusyPolicy(initial_delay=0.001)
+        camera = Camera(busy_policy=policy)
+        camera.capture_busy = 1
+        camera.busy = 1
+        assert camera.initiate_capture().ResponseCode == 'OK'
+        assert [o for o, _ in camera.operations] == [
+            'InitiateCapture', 'DeviceReady', 'DeviceReady', 'InitiateCapture'
+        ]
+        # Only the capture was retried.
+        assert list(policy.stats()) == ['InitiateCapture']
+        assert policy.stats('InitiateCapture').retries == 1
+
+    def test_unsupported(self):
+        camera = Camera()
+        camera.ready = 'OperationNotSupported'
+        # Falls back on the transport, which has no probe.
+        assert camera._ready() is None
+        assert camera._ready() is None
+        assert [o for o, _ in camera.operations] == ['DeviceReady']
+
+
+class TestLiveView(object):
+    def test_without_device_ready(self):
+        camera = Camera()
+        camera.ready = 'OperationNotSupported'
+        with camera.session(), camera.live_view(retry=0.001) as live_view:
+            frame = next(live_view.frames(timeout=1), None)
+        assert frame is not None
+        assert frame.data.tobytes() == b'\xff\xd8JPEG'
+
+    def test_polls_in_camera_lane(self):
+        camera = Camera(poll_min_interval=0.01, poll_max_interval=0.02)
+        with camera.session():
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                camera._nikon_poll_if_due()
+                time.sleep(0.005)
+        polls = camera.threads['CheckEvents']
+        assert len(polls) > 3
+        assert current_thread() not in polls
@@ -0,0 +1,123 @@
+'''Check that objects of an open capture are streamed while it goes on.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.ptp import PTP
+from threading import Thread
+import pytest
+import time
+
+
+class FakeTransport(object):
+    '''Add `count` objects during an open capture.'''
+
+    def __init__(self, count=3, **kwargs):
+        self._set_endian('little')
+        self.count = count
+        self.terminated = None
+        self.announcer = None
+
+    def mesg(self, ptp_container):
+        return Container(
+            ResponseCode='OK', TransactionID=ptp_container.TransactionID
+        )
+
+    def recv(self, ptp_container):
+        response = self.mesg(ptp_container)
+        operation = ptp_container.OperationCode
+        if operation == 'InitiateOpenCapture':
+            self.announcer = Thread(
+                target=self.announce, args=(ptp_container.TransactionID,)
+            )
+            self.announcer.start()
+        elif operation == 'TerminateOpenCapture':
+            self.terminated = ptp_container.Parameter[0]
+        return response
+
+    def announce(self, transaction_id):
+        for handle in range(self.count):
+            time.sleep(0.01)
+            self._event_received(Container(
+                EventCode='ObjectAdded',
+                TransactionID=transaction_id,
+                Parameter=[handle],
+            ), 'Test')
+        self._event_received(Container(
+            EventCode='CaptureComplete',
+            TransactionID=transaction_id,
+            Parameter=[],
+        ), 'Test')
+
+
+class Camera(PTP, FakeTransport):
+    def get_object_info(self, handle):
+        return Container(
+            Filename='IMG_{}.JPG'.format(handle),
+            ObjectCompressedSize=handle + 1,
+        )
+
+    def get_object(self, handle):
+        return Container(ResponseCode='OK', Data=b'x' * (handle + 1))
+
+
+class TestOpenCapture(object):
+    def test_streams_objects(self):
+        camera = Camera(count=3)
+        with camera.open_capture() as capture:
+            objects = list(capture.objects(timeout=0.2))
+        assert [o.ObjectHandle for o in objects] == [0, 1, 2]
+        assert [len(o.Data) for o in objects] == [1, 2, 3]
+        assert camera.terminated == capture.transaction_id
+        assert capture.downloaded == 3
+
+    def test_objects_after_exit(self, tmpdir):
+        camera = Camera(count=2)
+
+        def download_object(handle, path, size=None):
+            with open(path, 'wb') as f:
+                f.write(b'y')
+        camera.download_object = download_object
+
+        with camera.open_capture(directory=str(tmpdir)) as capture:
+            camera.announcer.join()
+        paths = [o.Path for o in capture.objects()]
+        assert sorted(p.rsplit('/', 1)[-1] for p in paths) == [
+            'IMG_0.JPG', 'IMG_1.JPG'
+        ]
+
+    def test_objects_until_closed(self):
+        camera = Camera(count=1)
+        objects = []
+        with camera.open_capture() as capture:
+            consumer = Thread(
+                target=lambda: objects.extend(capture.objects())
+            )
+            consumer.start()
+            camera.announcer.join()
+        # Without a timeout, objects are handed out until the capture is over.
+        consumer.join(1)
+        assert not consumer.is_alive()
+        assert [o.ObjectHandle for o in objects] == [0]
+
+    def test_closed_when_terminate_fails(self):
+        camera = Camera(count=1)
+
+        def terminate_open_capture(transaction_id):
+            raise IOError('No such device')
+        camera.terminate_open_capture = terminate_open_capture
+        with pytest.raises(IOError):
+            with camera.open_capture() as capture:
+                camera.announcer.join()
+        start = time.time()
+        # Closed, so the objects end without waiting for the timeout.
+        assert [o.ObjectHandle for o in capture.objects(timeout=1)] == [0]
+        assert time.time() - start < 0.5
+
+    def test_close_keeps_objects_past_read_ahead(self):
+        camera = Camera(count=3)
+        start = time.time()
+        with camera.open_capture(read_ahead=1) as capture:
+            camera.announcer.join()
+        # Closing does not wait for a consumer to make room.
+        assert time.time() - start < 1
+        assert capture.downloaded == 3
+        assert [o.ObjectHandle for o in capture.objects()] == [0, 1, 2]
@@ -0,0 +1,109 @@
+'''Check how Sequoia capture sets are grouped and written to disk.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.parrot.capture import MultispectralCapture
+from threading import Thread
+import os
+
+BANDS = ('RGB.JPG', 'GRE.TIF', 'RED.TIF', 'REG.TIF', 'NIR.TIF')
+
+
+class FakeSequoia(object):
+    '''Announce an object per band after each capture, from another thread.'''
+
+    def __init__(self, complete=True):
+        self.complete = complete
+        self.subscriptions = {}
+        self.transaction = 0
+        self.handle = 0
+
+    def subscribe(self, callback, code):
+        self.subscriptions[code] = callback
+        return code
+
+    def unsubscribe(self, code):
+        self.subscriptions.pop(code, None)
+
+    def initiate_capture(self, storage_id, object_format):
+        self.transaction += 1
+        handles = range(self.handle, self.handle + len(BANDS))
+        self.handle += len(BANDS)
+        thread = Thread(target=self.announce, args=(self.transaction, handles))
+        thread.start()
+        thread.join()
+        return Container(ResponseCode='OK', TransactionID=self.transaction)
+
+    def announce(self, transaction, handles):
+        for handle in handles:
+            self.subscriptions['ObjectAdded'](Container(
+                EventCode='ObjectAdded',
+                TransactionID=transaction,
+                Parameter=[handle],
+            ))
+        if self.complete:
+            self.subscriptions['CaptureComplete'](Container(
+                EventCode='CaptureComplete',
+                TransactionID=transaction,
+                Parameter=[],
+            ))
+
+    def get_object_info(self, handle):
+        return Container(Filename='IMG_{}_{}'.format(
+            handle // len(BANDS), BANDS[handle % len(BANDS)]
+        ))
+
+    def get_object(self, handle):
+        return Container(ResponseCode='OK', Data=bytes(bytearray([handle])))
+
+
+class TestMultispectralCapture(object):
+    def test_capture_sets(self, tmpdir):
+        directory = str(tmpdir)
+        completed = []
+        with MultispectralCapture(
+                FakeSequoia(), directory, on_complete=completed.append
+        ) as capture:
+            capture.capture()
+            capture.capture()
+            sets = capture.wait(count=2, timeout=5)
+        assert sorted(s.transaction_id for s in sets) == [1, 2]
+        assert sorted(completed) == sorted(sets)
+        for capture_set in sets:
+            assert len(capture_set.paths) == len(BANDS)
+            assert capture_set.size == len(BANDS)
+            assert capture_set.elapsed >= capture_set.latency >= 0
+        assert sorted(os.listdir(directory)) == sorted(
+            'IMG_{}_{}'.format(i, band) for i in range(2) for band in BANDS
+        )
+
+    def test_objects_per_capture(self, tmpdir):
+        with MultispectralCapture(
+                FakeSequoia(complete=False),
+                str(tmpdir),
+                objects_per_capture=len(BANDS),
+        ) as capture:
+            capture.capture()
+            sets = capture.wait(count=1, timeout=5)
+        assert len(sets) == 1
+        assert len(sets[0].paths) == len(BANDS)
+
+    def test_complete_before_response(self, tmpdir):
+        camera = FakeSequoia()
+        with MultispectralCapture(camera, str(tmpdir)) as capture:
+            initiate_capture = camera.initiate_capture
+
+            def complete_first(storage_id, object_format):
+                response = initiate_capture(storage_id, object_format)
+                assert len(capture.wait(count=1, timeout=5)) == 1
+                return response
+            camera.initiate_capture = complete_first
+            capture.capture()
+            # The next capture announces its objects without a transaction.
+            camera.initiate_capture = lambda storage_id, object_format: (
+                Container(ResponseCode='OK', TransactionID=2)
+            )
+            capture.capture()
+            camera.announce(0, range(len(BANDS), 2 * len(BANDS)))
+            sets = capture.wait(count=2, timeout=5)
+        assert [s.transaction_id for s in sets] == [1, 2]
+        assert all(len(s.paths) == len(BANDS) for s in sets)
@@ -0,0 +1,123 @@
+'''Check the encoding of geotags and how the feeder coalesces them.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.parrot import Parrot
+from ptpy.extensions.parrot.geotag import GeotagEncoder, GeotagFeeder
+from ptpy.ptp import PTP
+from ptpy.transports.usb import USBTransport
+from threading import Event, RLock, Thread
+import time
+
+
+class ParrotUSB(Parrot, PTP, USBTransport):
+    pass
+
+
+def geotag(latitude=48.8788):
+    return Container(
+        ValidityMask=0x3fff,
+        Timestamp=1500000000000,
+        Latitude=latitude,
+        Longitude=2.3709,
+        Altitude=35.5,
+        Satellites=9,
+        AccuracyXY=1.25,
+        AccuracyZ=2.5,
+        NorthSpeed=-0.5,
+        EastSpeed=0.25,
+        UpSpeed=0.,
+        Roll=1.5,
+        Pitch=-2.,
+        Yaw=180.,
+    )
+
+
+class TestGeotagEncoder(object):
+    def test_round_trip(self):
+        camera = ParrotUSB.__new__(ParrotUSB)
+        camera._set_endian('little')
+        data = camera._Geotag.build(geotag())
+        assert camera._GeotagEncoder.build(geotag()) == data
+        parsed = camera._Geotag.parse(data)
+        assert parsed == camera._GeotagEncoder.parse(data)
+        assert parsed.Satellites == 9
+        assert abs(parsed.Latitude - 48.8788) < 1e-6
+        assert parsed.Yaw == 180.
+
+
+class FakeParrot(object):
+    def __init__(self):
+        self._operation_in_flight = False
+        self._operation_lock = RLock()
+        self._GeotagEncoder = GeotagEncoder('little')
+        self.sent = []
+        self.release = Event()
+
+    def set_geotag(self, data):
+        self.release.wait(2)
+        self.sent.append(self._GeotagEncoder.parse(data).Latitude)
+        return Container(ResponseCode='OK')
+
+
+class TestGeotagFeeder(object):
+    def test_coalesces_while_busy(self):
+        camera = FakeParrot()
+        with GeotagFeeder(camera) as feeder:
+            feeder.push(geotag(1.))
+            time.sleep(0.05)
+            # The first fix is being sent, the others wait for the camera.
+            for latitude in (2., 3., 4.):
+                feeder.push(geotag(latitude))
+            camera.release.set()
+            deadline = time.time() + 2
+            while feeder.stats.sent < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        assert camera.sent == [1., 4.]
+        assert feeder.stats.coalesced == 2
+
+    def test_drops_stale_fixes(self):
+        camera = FakeParrot()
+        camera.release.set()
+        with GeotagFeeder(camera, max_age=0.5) as feeder:
+            feeder.push(geotag(), timestamp=ptpy.util.monotonic() - 1)
+            time.sleep(0.1)
+        assert camera.sent == []
+        assert feeder.stats.stale == 1
+
+    def test_waits_for_any_transaction(self):
+        camera = FakeParrot()
+        camera.release.set()
+        camera._operation_in_flight = True
+        with GeotagFeeder(camera) as feeder:
+            for latitude in (1., 2., 3.):
+                feeder.push(geotag(latitude))
+            time.sleep(0.05)
+            assert camera.sent == []
+            camera._operation_in_flight = False
+            deadline = time.time() + 2
+            while not camera.sent and time.time() < deadline:
+                time.sleep(0.01)
+        assert camera.sent == [3.]
+        assert feeder.stats.coalesced == 2
+
+    def test_age_checked_once_camera_held(self):
+        camera = FakeParrot()
+        camera.release.set()
+        held, done = Event(), Event()
+
+        def transaction():
+            with camera._operation_lock:
+                held.set()
+                done.wait(2)
+        thread = Thread(target=transaction)
+        thread.start()
+        held.wait(2)
+        with GeotagFeeder(camera, max_age=0.1) as feeder:
+            feeder.push(geotag())
+            # Fresh when taken, stale once the transaction is over.
+            time.sleep(0.2)
+            done.set()
+            thread.join()
+            time.sleep(0.1)
+        assert camera.sent == []
+        assert feeder.stats.stale == 1
@@ -0,0 +1,166 @@
+'''Check how firmware is rolled out to many Parrot cameras.'''
+from .context import ptpy  # noqa
+from .fake_usb import FakeUSBDevice, requires_range_build, response
+from construct import Container
+from contextlib import contextmanager
+from ptpy.extensions.parrot import Parrot
+from ptpy.extensions.parrot.rollout import BandwidthLimiter, rollout_firmware
+from ptpy.ptp import PTP, PTPError
+from ptpy.transports.usb import USBTransport
+from threading import Lock, Thread
+import pytest
+import time
+
+PLF = bytes(bytearray(range(256))) * 64
+
+
+class FakeParrot(object):
+    '''Receive firmware in chunks of `chunk_size` and answer `response`.
+
+    With an `error`, the transfer fails with it once it has started.
+    '''
+
+    active = 0
+    most_active = 0
+    lock = Lock()
+
+    def __init__(self, response='OK', chunk_size=1024, error=None):
+        self.response = response
+        self.chunk_size = chunk_size
+        self.error = error
+        self.received = b''
+
+    @contextmanager
+    def session(self):
+        yield
+
+    def send_firmware(self, payload):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.most_active = max(cls.most_active, cls.active)
+        try:
+            for chunk in payload.chunks(self.chunk_size):
+                if self.error is not None:
+                    # Fails in the middle of the transfer.
+                    raise self.error
+                time.sleep(0.001)
+                self.received += bytes(chunk)
+                payload.advance(len(chunk))
+        finally:
+            with cls.lock:
+                cls.active -= 1
+        return Container(ResponseCode=self.response)
+
+
+@pytest.fixture(autouse=True)
+def reset_counters():
+    FakeParrot.active = FakeParrot.most_active = 0
+
+
+class TestBandwidthLimiter(object):
+    def test_rate(self):
+        limiter = BandwidthLimiter(10000, burst=1000)
+        start = time.time()
+        for _ in range(5):
+            limiter.consume(1000)
+        # The burst goes out right away, the rest at the rate.
+        assert 0.35 < time.time() - start < 1
+
+    def test_validation(self):
+        with pytest.raises(ValueError):
+            BandwidthLimiter(0)
+
+
+class TestRollout(object):
+    def test_updates(self):
+        cameras = {'A': FakeParrot(), 'B': FakeParrot()}
+        progress = []
+        updates = rollout_firmware(
+            cameras,
+            PLF,
+            verify=lambda camera: camera.received == PLF,
+            progress=lambda device, sent, size: progress.append(device),
+        )
+        for device, camera in cameras.items():
+            update = updates[device]
+            assert camera.received == PLF
+            assert update.response_code == 'OK'
+            assert update.size == len(PLF)
+            assert update.verified is True
+            assert update.error is None
+        assert set(progress) == {'A', 'B'}
+
+    def test_parallel(self):
+        cameras = [FakeParrot() for _ in range(6)]
+        updates = rollout_firmware(cameras, PLF, parallel=2)
+        assert len(updates) == 6
+        assert FakeParrot.most_active == 2
+
+    def test_mapped_file(self, tmpdir):
+        path = tmpdir.join('update.plf')
+        path.write_binary(PLF)
+        camera = FakeParrot()
+        rollout_firmware([camera], str(path))
+        assert camera.received == PLF
+
+    def test_bandwidth(self):
+        cameras = [FakeParrot(chunk_size=4096) for _ in range(2)]
+        start = time.time()
+        rollout_firmware(cameras, PLF, bandwidth=len(PLF))
+        # One second worth goes out at once, then the rest is throttled.
+        assert time.time() - start > 0.8
+
+    @pytest.mark.parametrize('mapped', [False, True])
+    def test_errors(self, mapped, tmpdir):
+        firmware = PLF
+        if mapped:
+            firmware = str(tmpdir.join('update.plf'))
+            tmpdir.join('update.plf').write_binary(PLF)
+        updates = rollout_firmware({
+            'refused': FakeParrot(response='GeneralError'),
+            'unplugged': FakeParrot(error=IOError('No such device')),
+        }, firmware)
+        refused = updates['refused']
+        assert refused.response_code == 'GeneralError'
+        assert isinstance(refused.error, PTPError)
+        unplugged = updates['unplugged']
+        assert unplugged.response_code is None
+        assert isinstance(unplugged.error, IOError)
+        assert refused.verified is unplugged.verified is None
+
+
+class ParrotUSB(Parrot, PTP, USBTransport):
+    pass
+
+
+@requires_range_build
+class TestUSBThrottling(object):
+    def test_progress_outside_endpoint_lock(self):
+        device = FakeUSBDevice(
+            lambda code, transaction_id, parameters: [
+                response(0x2001, transaction_id)
+            ]
+        )
+        camera = ParrotUSB(device=device, reset_policy='never')
+        lock = camera._USBTransport__outep_lock
+        free = []
+
+        def check():
+            if lock.acquire(False):
+                lock.release()
+                free.append(True)
+            else:
+                free.append(False)
+
+        def progress(sent, size):
+            # Throttling happens here, so other threads must get through.
+            thread = Thread(target=check)
+            thread.start()
+            thread.join()
+        try:
+            result = camera.send_firmware(PLF, progress=progress)
+        finally:
+            camera._shutdown()
+        assert result.ResponseCode == 'OK'
+        assert free and all(free)
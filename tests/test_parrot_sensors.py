@@ -0,0 +1,74 @@
+'''Check how Sequoia sensor configurations wait for the camera.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.parrot import Parrot
+from ptpy.ptp import PTP, PTPError
+from ptpy.transports.usb import USBTransport
+import pytest
+
+
+class FakeSequoia(Parrot, PTP, USBTransport):
+    '''Answer DeviceBusy a few times, then start the sensors.
+
+    The status mask is answered `status_code`.
+    '''
+    _session = 0
+    _transaction = 0
+
+    def __init__(self, busy=2, starting=2):
+        self._set_endian('little')
+        self.busy = busy
+        self.starting = starting
+        self.status_code = 'OK'
+        self.sent = []
+        self.waits = []
+
+    def send(self, ptp, data):
+        if self.busy:
+            self.busy -= 1
+            return Container(ResponseCode='DeviceBusy')
+        self.sent.append((ptp.Parameter[0], self._UInt32.parse(data)))
+        return Container(ResponseCode='OK')
+
+    def recv(self, ptp):
+        assert ptp.OperationCode == 'GetStatusMask'
+        if self.status_code != 'OK':
+            return Container(ResponseCode=self.status_code)
+        running = self.starting == 0
+        self.starting = max(0, self.starting - 1)
+        # CamNIRError, and CameraRunning once started.
+        mask = 1 << 10 | (1 << 13 if running else 0)
+        return Container(ResponseCode='OK', Data=self._UInt32.build(mask))
+
+    def wait_for_event(self, code=None, timeout=None, **kwargs):
+        self.waits.append(timeout)
+
+
+class TestSensorConfiguration(object):
+    def test_waits_while_busy(self):
+        camera = FakeSequoia()
+        result = camera.apply_sensor_configuration(0b11111, keep_on=True)
+        assert result.ResponseCode == 'OK'
+        assert camera.sent == [(0xD201, 0b11111), (0xD202, 1)]
+        assert result.Status.CameraRunning
+        assert result.Errors == ['CamNIRError']
+        # Two busy answers and two polls of the status, with growing waits.
+        assert camera.waits == [0.01, 0.02, 0.01, 0.02]
+
+    def test_times_out(self):
+        camera = FakeSequoia(busy=float('inf'))
+        with pytest.raises(PTPError):
+            camera.apply_sensor_configuration(1, timeout=0)
+
+    def test_status_mask_refused(self):
+        camera = FakeSequoia(busy=0)
+        camera.status_code = 'GeneralError'
+        with pytest.raises(PTPError):
+            camera.apply_sensor_configuration(1, keep_on=True)
+
+    def test_status_mask_busy(self):
+        camera = FakeSequoia(busy=0)
+        camera.status_code = 'DeviceBusy'
+        with pytest.raises(PTPError):
+            camera.apply_sensor_configuration(1, keep_on=True, timeout=0.05)
+        assert camera.waits
@@ -0,0 +1,86 @@
+'''Check the decoding and storage of Sequoia telemetry samples.'''
+from .context import ptpy  # noqa
+from ptpy.extensions.parrot.telemetry import (
+    TELEMETRY_CHANNELS, TelemetryDecoder, TelemetryRing, TelemetrySampler,
+)
+from ptpy.ptp import PTPError
+from ptpy.reactor import Reactor
+from threading import Event
+import pytest
+import struct
+import time
+
+
+class TestTelemetryDecoder(object):
+    def test_array(self):
+        decoder = TelemetryDecoder(TELEMETRY_CHANNELS['temperature'], 'little')
+        data = struct.pack('<I6i', 6, 40, 41, 42, -5, 30, 31)
+        assert decoder.parse(data) == (40, 41, 42, -5, 30, 31)
+
+    def test_scalar(self):
+        decoder = TelemetryDecoder(TELEMETRY_CHANNELS['status'], 'big')
+        assert decoder.parse(struct.pack('>I', 0x800)) == (0x800,)
+
+    def test_wrong_count(self):
+        decoder = TelemetryDecoder(TELEMETRY_CHANNELS['angle'], 'little')
+        with pytest.raises(PTPError):
+            decoder.parse(struct.pack('<I3I', 2, 1, 2, 3))
+        with pytest.raises(PTPError):
+            decoder.parse(struct.pack('<I2I', 3, 1, 2))
+
+
+class TestTelemetryRing(object):
+    def test_partial(self):
+        ring = TelemetryRing(('Yaw', 'Pitch'), 'I', 4)
+        ring.append(1., (10, 20))
+        ring.append(2., (11, 21))
+        batch = ring.batch()
+        assert list(batch['Timestamp']) == [1., 2.]
+        assert list(batch['Yaw']) == [10, 11]
+        assert list(batch['Pitch']) == [20, 21]
+
+    def test_wraps_around(self):
+        ring = TelemetryRing(('Yaw',), 'I', 3)
+        for i in range(5):
+            ring.append(float(i), (i,))
+        assert len(ring) == 3
+        assert ring.overwritten == 2
+        batch = ring.batch(clear=True)
+        assert list(batch['Timestamp']) == [2., 3., 4.]
+        assert list(batch['Yaw']) == [2, 3, 4]
+        assert len(ring) == 0
+        ring.append(5., (5,))
+        assert list(ring.batch()['Yaw']) == [5]
+
+
+class FakeParrot(object):
+    def __init__(self, reactor, stuck=None):
+        self._reactor = reactor
+        self.stuck = stuck
+
+    def get_telemetry(self, name, imu_id):
+        if self.stuck is not None:
+            self.stuck.wait(2)
+        return (0x800,)
+
+
+class TestTelemetrySampler(object):
+    def test_stuck_cameras(self):
+        reactor = Reactor(workers=2, idle=0.2, name='TestReactor')
+        release = Event()
+        samplers = [
+            TelemetrySampler(FakeParrot(reactor, release), {'status': 100})
+            for _ in range(4)
+        ]
+        healthy = TelemetrySampler(FakeParrot(reactor), {'status': 100})
+        try:
+            for sampler in samplers + [healthy]:
+                sampler.start()
+            time.sleep(0.2)
+            # Cameras are polled in their own lane, not in the shared pool.
+            assert len(healthy.batch()['status']['Timestamp']) >= 5
+        finally:
+            release.set()
+            for sampler in samplers + [healthy]:
+                sampler.stop()
+            reactor.stop()
@@ -0,0 +1,57 @@
+'''Check how payloads are split into chunks for streaming sends.'''
+from .context import ptpy  # noqa
+from ptpy.util import Payload
+import io
+import pytest
+
+
+DATA = bytes(bytearray(range(256))) * 40
+
+
+def sizes(chunks):
+    return [len(chunk) for chunk in chunks]
+
+
+class TestPayload(object):
+    def test_bytes_with_header(self):
+        chunks = list(Payload(DATA).chunks(4096, prefix=b'h' * 12))
+        assert sizes(chunks) == [4096, 4096, 2060]
+        assert b''.join(bytes(c) for c in chunks) == b'h' * 12 + DATA
+
+    def test_file_from_position(self):
+        f = io.BytesIO(b'skip' + DATA)
+        f.seek(4)
+        payload = Payload(f)
+        assert payload.size == len(DATA)
+        for _ in range(2):
+            assert b''.join(payload.chunks(1000)) == DATA
+        assert payload.replayable
+
+    def test_iterator(self):
+        pieces = (DATA[i:i + 333] for i in range(0, len(DATA), 333))
+        with pytest.raises(ValueError):
+            Payload(pieces)
+        pieces = (DATA[i:i + 333] for i in range(0, len(DATA), 333))
+        payload = Payload(pieces, size=len(DATA))
+        chunks = list(payload.chunks(1024))
+        assert set(sizes(chunks[:-1])) == {1024}
+        assert b''.join(chunks) == DATA
+        payload.advance(len(DATA))
+        assert not payload.replayable
+
+    def test_wrong_size(self):
+        with pytest.raises(ValueError):
+            list(Payload(iter([DATA]), size=10).chunks(1024))
+        with pytest.raises(ValueError):
+            list(Payload(iter([DATA]), size=len(DATA) + 1).chunks(1024))
+
+    def test_progress(self):
+        reports = []
+        payload = Payload(DATA, progress=lambda *p: reports.append(p))
+        for chunk in payload.chunks(4096):
+            payload.advance(len(chunk))
+        assert reports[-1] == (len(DATA), len(DATA))
+        assert len(reports) == 3
+
+    def test_empty(self):
+        assert list(Payload(b'').chunks(512, prefix=b'h')) == [b'h']
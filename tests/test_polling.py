@@ -0,0 +1,141 @@
+'''Check how event polls adapt to activity and yield to transfers.'''
+from .context import ptpy  # noqa
+from .fake_usb import EVENT, FakeUSBDevice, container, requires_range_build
+from construct import Container
+from ptpy.ptp import PTP
+from ptpy.reactor import AdaptivePoller
+from ptpy.transports.usb import USBTransport
+import pytest
+import time
+
+
+class FakeTask(object):
+    def __init__(self):
+        self.runs = 0
+
+    def run_soon(self):
+        self.runs += 1
+
+
+class FakeTransport(object):
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.in_flight = []
+
+    def __respond(self, ptp_container):
+        self.in_flight.append(self._transfer_in_flight)
+        return Container(
+            ResponseCode='OK',
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            Data=b'',
+        )
+
+    def mesg(self, ptp_container):
+        return self.__respond(ptp_container)
+
+    def recv(self, ptp_container):
+        return self.__respond(ptp_container)
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(PTP, FakeTransport):
+    pass
+
+
+def operation(camera, code):
+    return Container(
+        OperationCode=code,
+        SessionID=camera._session,
+        TransactionID=camera._transaction,
+        Parameter=[],
+    )
+
+
+class TestAdaptivePoller(object):
+    def test_backoff(self):
+        poller = AdaptivePoller(0.1, 0.5, backoff=2., fast_for=0)
+        delays = [poller.next_delay() for _ in range(4)]
+        assert delays == [0.2, 0.4, 0.5, 0.5]
+        # Finding events brings the interval back down.
+        assert poller.next_delay(found=True) == 0.1
+        assert poller.next_delay() == 0.2
+
+    def test_kick(self):
+        poller = AdaptivePoller(0.1, 1., fast_for=0.1)
+        poller.task = FakeTask()
+        for _ in range(3):
+            poller.next_delay()
+        poller.kick()
+        assert poller.task.runs == 1
+        assert poller.interval == 0.1
+        # Polls stay fast for a while after a kick.
+        assert poller.next_delay() == 0.1
+        time.sleep(0.15)
+        assert poller.next_delay() == 0.2
+
+    def test_validation(self):
+        with pytest.raises(ValueError):
+            AdaptivePoller(0, 1)
+        with pytest.raises(ValueError):
+            AdaptivePoller(2, 1)
+        with pytest.raises(ValueError):
+            AdaptivePoller(0.1, 1, backoff=0.5)
+
+
+class TestCameraPolls(object):
+    def test_triggers(self):
+        camera = Camera()
+        poller = AdaptivePoller(0.1, 1.)
+        poller.task = FakeTask()
+        camera._add_poller(poller)
+        camera.recv(operation(camera, 'GetObjectHandles'))
+        assert poller.task.runs == 0
+        camera.mesg(operation(camera, 'InitiateCapture'))
+        assert poller.task.runs == 1
+
+    def test_transfer_in_flight(self):
+        camera = Camera()
+        camera.recv(operation(camera, 'GetObjectHandles'))
+        camera.mesg(operation(camera, 'InitiateCapture'))
+        # Only operations with a data phase hold back polls.
+        assert camera.in_flight == [True, False]
+        assert not camera._transfer_in_flight
+
+
+class USBCamera(PTP, USBTransport):
+    pass
+
+
+@requires_range_build
+class TestInterruptPolls(object):
+    def test_backoff_while_idle(self):
+        device = FakeUSBDevice()
+        reads = []
+        read = device.intep.read
+
+        def counted(size, timeout=None):
+            reads.append(time.time())
+            return read(size, timeout)
+        device.intep.read = counted
+        camera = USBCamera(
+            device=device,
+            reset_policy='never',
+            event_interval=0.01,
+            event_max_interval=0.1,
+        )
+        try:
+            time.sleep(0.5)
+            # Polling every 10ms would have read about 50 times.
+            assert len(reads) < 20
+            received = []
+            camera.subscribe(received.append, code='CaptureComplete')
+            device.intep.queue(container(EVENT, 0x400D, 0))
+            deadline = time.time() + 1
+            while not received and time.time() < deadline:
+                time.sleep(0.005)
+            assert received
+        finally:
+            camera._shutdown()
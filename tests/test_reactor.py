@@ -0,0 +1,143 @@
+'''Check how the reactor schedules tasks and readers.'''
+from .context import ptpy  # noqa
+from ptpy.reactor import Reactor
+from threading import Event, Lock
+import pytest
+import socket
+import threading
+import time
+
+
+@pytest.fixture
+def reactor():
+    reactor = Reactor(idle=0.2, name='TestReactor')
+    yield reactor
+    reactor.stop()
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+class TestScheduling(object):
+    def test_call_every(self, reactor):
+        calls = []
+        task = reactor.call_every(0.01, lambda: calls.append(time.time()))
+        assert wait_until(lambda: len(calls) >= 5)
+        task.cancel(timeout=1)
+        count = len(calls)
+        time.sleep(0.05)
+        assert len(calls) == count
+
+    def test_returned_delay(self, reactor):
+        calls = []
+
+        def task():
+            calls.append(None)
+            # Tasks without interval run again when they return a delay.
+            return 0.01 if len(calls) < 3 else None
+        reactor.call_later(0, task)
+        assert wait_until(lambda: len(calls) == 3)
+        time.sleep(0.05)
+        assert len(calls) == 3
+
+    def test_run_soon(self, reactor):
+        calls = []
+        task = reactor.call_every(10, lambda: calls.append(None), delay=10)
+        time.sleep(0.02)
+        assert calls == []
+        task.run_soon()
+        assert wait_until(lambda: calls == [None])
+        task.cancel()
+
+    def test_reader(self, reactor):
+        reader, writer = socket.socketpair()
+        received = []
+        reactor.add_reader(reader, lambda: received.append(reader.recv(16)))
+        writer.send(b'event')
+        assert wait_until(lambda: received == [b'event'])
+        reactor.remove_reader(reader)
+        reader.close()
+        writer.close()
+
+
+class TestBlockingTasks(object):
+    def test_stuck_groups_do_not_stall_others(self, reactor):
+        release = Event()
+        calls = []
+        # More stuck cameras than pool workers.
+        for group in range(6):
+            reactor.call_every(
+                0.01, lambda: release.wait(2), blocking=True, group=group
+            )
+        reactor.call_every(
+            0.01, lambda: calls.append(None), blocking=True, group='free'
+        )
+        try:
+            assert wait_until(lambda: len(calls) >= 3, timeout=1)
+        finally:
+            release.set()
+
+    def test_group_runs_one_task_at_a_time(self, reactor):
+        lock = Lock()
+        overlaps = []
+        calls = []
+
+        def task():
+            if not lock.acquire(False):
+                overlaps.append(None)
+                return
+            try:
+                time.sleep(0.005)
+                calls.append(None)
+            finally:
+                lock.release()
+        for _ in range(3):
+            reactor.call_every(0, task, blocking=True, group='camera')
+        assert wait_until(lambda: len(calls) >= 20)
+        assert overlaps == []
+
+    def test_lanes_end_when_idle(self, reactor):
+        calls = []
+        reactor.call_later(
+            0, lambda: calls.append(None), blocking=True, group='camera'
+        )
+
+        def lanes():
+            return [
+                t for t in threading.enumerate()
+                if t.name == 'TestReactor lane'
+            ]
+        assert wait_until(lambda: calls and lanes())
+        assert wait_until(lambda: not lanes())
+        # A new task starts a new lane worker.
+        reactor.call_later(
+            0, lambda: calls.append(None), blocking=True, group='camera'
+        )
+        assert wait_until(lambda: len(calls) == 2)
+
+    def test_lanes_are_bounded(self):
+        reactor = Reactor(idle=0.2, name='BoundedReactor', lanes=2)
+        calls = {}
+        workers = set()
+
+        def poll(group):
+            workers.add(threading.current_thread())
+            calls[group] = calls.get(group, 0) + 1
+            time.sleep(0.002)
+        try:
+            for group in range(10):
+                reactor.call_every(
+                    0.005, lambda group=group: poll(group),
+                    blocking=True, group=group,
+                )
+            # Every camera gets its turn on the shared workers.
+            assert wait_until(
+                lambda: len(calls) == 10 and min(calls.values()) >= 3
+            )
+        finally:
+            reactor.stop()
+        assert len(workers) <= 2
@@ -0,0 +1,141 @@
+'''Check Sony property snapshots and live view against a fake camera.'''
+from .context import ptpy  # noqa
+from construct import Container
+from ptpy.extensions.sony import LIVE_VIEW_HANDLE, Sony
+from ptpy.ptp import PTP
+import struct
+import time
+
+
+def snapshot(values):
+    '''GetAllDevicePropData dataset for UInt16 properties.'''
+    return struct.pack('<Q', len(values)) + b''.join(
+        struct.pack('<HHBBHHB', code, 0x0004, 1, 1, 0, value, 0)
+        for code, value in sorted(values.items())
+    )
+
+
+class FakeTransport(object):
+    '''Sony camera with UInt16 properties `values`.'''
+
+    def __init__(self, **kwargs):
+        self._set_endian('little')
+        self.values = {0x5007: 280, 0xD21E: 100}
+        self.frames = []
+        self.operations = []
+
+    def __respond(self, ptp_container, code='OK', **kwargs):
+        self.operations.append(ptp_container.OperationCode)
+        return Container(
+            ResponseCode=code,
+            TransactionID=ptp_container.TransactionID,
+            Parameter=[],
+            **kwargs
+        )
+
+    def mesg(self, ptp_container):
+        return self.__respond(ptp_container)
+
+    def recv(self, ptp_container, sink=None):
+        if ptp_container.OperationCode == 'GetAllDevicePropData':
+            return self.__respond(ptp_container, Data=snapshot(self.values))
+        if ptp_container.OperationCode == 'GetObject':
+            assert ptp_container.Parameter == [LIVE_VIEW_HANDLE]
+            if not self.frames:
+                return self.__respond(ptp_container, 'AccessDenied')
+            frame = self.frames.pop(0)
+            # Live view frames are streamed.
+            assert sink is not None
+            for start in range(0, len(frame), 8):
+                sink.write(frame[start:start + 8])
+            return self.__respond(ptp_container, DataLength=len(frame))
+        return self.__respond(ptp_container, Data=b'')
+
+    def _shutdown(self):
+        pass
+
+
+class Camera(Sony, PTP, FakeTransport):
+    pass
+
+
+def live_view_dataset(jpeg, offset=16):
+    '''Live view dataset: the offset and size of the image, then padding.'''
+    header = struct.pack('<II', offset, len(jpeg))
+    return header + b'\0' * (offset - len(header)) + jpeg
+
+
+def property_changed():
+    return Container(
+        EventCode='SonyPropertyChanged', TransactionID=0, Parameter=[]
+    )
+
+
+class TestPropertySnapshot(object):
+    def test_describe_properties(self):
+        camera = Camera()
+        descs = camera._describe_properties(['FNumber', 'ISO'])
+        assert descs['ISO'].CurrentValue == 100
+        assert camera.operations == ['GetAllDevicePropData']
+
+    def test_refresh(self):
+        camera = Camera()
+        assert camera.refresh_properties() == []
+        received = []
+        camera.subscribe(received.append, code='DevicePropChanged')
+        camera.values[0xD21E] = 200
+        assert camera.refresh_properties() == ['ISO']
+        assert [(e.Source, e.Parameter, e.Value) for e in received] == [
+            ('Sony', [0xD21E], 200)
+        ]
+        assert camera.refresh_properties() == []
+
+    def test_notifications(self):
+        camera = Camera()
+        # Notifications outside of a session are ignored.
+        camera._event_received(property_changed(), 'Test')
+        with camera.session():
+            camera.refresh_properties()
+            camera.values[0x5007] = 400
+            received = []
+            camera.subscribe(received.append, code='DevicePropChanged')
+            for _ in range(5):
+                camera._event_received(property_changed(), 'Test')
+            deadline = time.time() + 2
+            while not received and time.time() < deadline:
+                time.sleep(0.005)
+            time.sleep(0.05)
+            # Later refreshes of the burst find nothing new.
+            assert [(e.Parameter, e.Value) for e in received] == [
+                ([0x5007], 400)
+            ]
+
+
+class TestLiveView(object):
+    def test_live_view_jpeg(self):
+        camera = Camera()
+        jpeg = camera.live_view_jpeg(live_view_dataset(b'\xff\xd8JPEG'))
+        assert isinstance(jpeg, memoryview)
+        assert jpeg.tobytes() == b'\xff\xd8JPEG'
+        assert camera.live_view_jpeg(live_view_dataset(b'')) is None
+        assert camera.live_view_jpeg(b'\0' * 4) is None
+        # Images running past the dataset are discarded.
+        truncated = live_view_dataset(b'\xff\xd8JPEG')[:-1]
+        assert camera.live_view_jpeg(truncated) is None
+
+    def test_live_view(self):
+        camera = Camera()
+        camera.frames = [
+            live_view_dataset(b'\xff\xd8ONE'),
+            live_view_dataset(b'\xff\xd8TWO'),
+        ]
+        with camera.live_view(retry=0.001) as live_view:
+            frames = []
+            for frame in live_view.frames(timeout=0.2):
+                frames.append(frame.data.tobytes())
+            stats = live_view.stats
+        assert frames[-1] == b'\xff\xd8TWO'
+        assert stats.frames == 2
+        assert stats.not_ready > 0
+        # Frames were only asked for on the live view handle.
+        assert stats.errors == 0
@@ -0,0 +1,51 @@
+'''Check when the USB transport resets the device it claims.'''
+from .context import ptpy  # noqa
+from .fake_usb import FakeUSBDevice, requires_range_build, response
+from ptpy.ptp import PTP
+from ptpy.transports.usb import USBTransport
+import pytest
+
+pytestmark = requires_range_build
+
+
+class Camera(PTP, USBTransport):
+    pass
+
+
+def healthy(code, transaction_id, parameters):
+    return [response(0x2001, transaction_id)]
+
+
+def open_camera(device, **kwargs):
+    camera = Camera(device=device, **kwargs)
+    camera._shutdown()
+    return device
+
+
+class TestResetPolicy(object):
+    def test_always(self):
+        device = open_camera(FakeUSBDevice(healthy))
+        assert device.resets == 1
+        assert device.commands == []
+
+    def test_never(self):
+        device = open_camera(FakeUSBDevice(), reset_policy='never')
+        assert device.resets == 0
+
+    def test_healthy(self):
+        device = open_camera(
+            FakeUSBDevice(healthy), reset_policy='on_failure'
+        )
+        assert device.resets == 0
+        # A single GetDeviceInfo outside of any session.
+        assert device.commands == [(0x1001, 0, [])]
+
+    def test_unresponsive(self):
+        device = open_camera(
+            FakeUSBDevice(), reset_policy='on_failure', health_timeout=10
+        )
+        assert device.resets == 1
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            Camera(device=FakeUSBDevice(), reset_policy='sometimes')